@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Ingest and query benchmarks on a synthetic corpus. Results are written as
+JSON, pass an earlier result as --baseline to compare against it.
+"""
+
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+from dataclasses import asdict, dataclass
+from itertools import accumulate
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import click
+
+from context import Knovleks, SearchSnipOptions, IdocumentType, DocPart
+from context import read_records
+
+
+@dataclass
+class CorpusConfig:
+    docs: int = 2000
+    parts: int = 10
+    part_words: int = 80
+    tags: int = 20
+    tags_per_doc: int = 2
+    vocabulary: int = 5000
+    seed: int = 1
+
+
+class SyntheticDocument(IdocumentType):
+    def parse(self):
+        pass
+
+
+class Corpus:
+    """
+    Deterministic documents with Zipf distributed words, so that there are
+    frequent, medium and rare search terms like in natural language.
+    """
+    def __init__(self, config: CorpusConfig):
+        self.config = config
+        self.words = [f"w{i}" for i in range(config.vocabulary)]
+        self.cum_weights = list(accumulate(
+            1 / rank for rank in range(1, config.vocabulary + 1)))
+        self.tags = [f"tag{i}" for i in range(config.tags)]
+
+    def _text(self, rng: random.Random) -> str:
+        return " ".join(rng.choices(self.words, cum_weights=self.cum_weights,
+                                    k=self.config.part_words))
+
+    def documents(self, revision: int = 0, changed_every: int = 0
+                  ) -> Iterator[SyntheticDocument]:
+        """
+        Generate the corpus. With `revision` > 0, the parts of every
+        `changed_every`th document are different from revision 0.
+        """
+        cfg = self.config
+        for i in range(cfg.docs):
+            changed = revision and changed_every and i % changed_every == 0
+            rng = random.Random(f"{cfg.seed}-{i}-{revision if changed else 0}")
+            tags = set(rng.sample(self.tags, min(cfg.tags_per_doc, cfg.tags)))
+            parts = [DocPart(self._text(rng), j) for j in range(cfg.parts)]
+            yield SyntheticDocument(f"/bench/doc{i}.txt", f"document {i}",
+                                    "pdf" if i % 2 else "note", tags,
+                                    parts=parts)
+
+    def query_terms(self, n: int, seed: int = 0) -> Dict[str, List[str]]:
+        """
+        Search terms by frequency class.
+        """
+        rng = random.Random(seed)
+        vocab = self.config.vocabulary
+        return {
+            "frequent": rng.choices(self.words[:max(vocab // 100, 1)], k=n),
+            "medium": rng.choices(self.words[vocab // 100:vocab // 10], k=n),
+            "rare": rng.choices(self.words[vocab // 2:], k=n),
+        }
+
+
+def latency(samples: Sequence[float]) -> Dict[str, float]:
+    ms = sorted(s * 1000 for s in samples)
+
+    def pct(p: float) -> float:
+        return ms[min(int(p / 100 * len(ms)), len(ms) - 1)]
+
+    return {"p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99),
+            "mean_ms": statistics.fmean(ms), "n": len(ms)}
+
+
+def time_calls(fn: Callable[[Any], Any], args: Sequence[Any]) -> List[float]:
+    samples = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def db_size(path: str) -> int:
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    con.close()
+    return sum(os.path.getsize(p) for p in (path, path + "-wal")
+               if os.path.exists(p))
+
+
+def bench_ingest(corpus: Corpus, db: str,
+                 compress: bool = False) -> Dict[str, Any]:
+    cfg = corpus.config
+    knov = Knovleks({}, db)
+    if compress:
+        knov.set_part_compression(True)
+    res: Dict[str, Any] = {}
+    start = time.perf_counter()
+    knov.index_documents(corpus.documents())
+    elapsed = time.perf_counter() - start
+    res["ingest"] = {"seconds": elapsed, "docs_per_second": cfg.docs / elapsed,
+                     "parts_per_second": cfg.docs * cfg.parts / elapsed}
+    for name, changed_every in (("reindex_unchanged", 0),
+                                ("reindex_10pct_changed", 10)):
+        start = time.perf_counter()
+        knov.index_documents(corpus.documents(1, changed_every))
+        elapsed = time.perf_counter() - start
+        res[name] = {"seconds": elapsed,
+                     "docs_per_second": cfg.docs / elapsed}
+    knov.close()
+    res["db_size_bytes"] = db_size(db)
+    return res
+
+
+def bench_queries(corpus: Corpus, db: str, n: int) -> Dict[str, Any]:
+    knov = Knovleks({}, db)
+    terms = corpus.query_terms(n)
+    tags = corpus.tags
+    snip = SearchSnipOptions("<b>", "</b>")
+    variants: Dict[str, Callable[[str], Any]] = {
+        "plain": lambda q: knov.search_results(q, limit=40),
+        "snippets": lambda q: knov.search_results(q, limit=40, snip=snip),
+        "tag": lambda q: knov.search_results(q, {tags[0]}, limit=40),
+        "doc_type": lambda q: knov.search_results(q, limit=40,
+                                                  doc_type="pdf"),
+        "all": lambda q: knov.search_results(q, {tags[0]}, limit=40,
+                                             doc_type="pdf", snip=snip),
+    }
+    res: Dict[str, Any] = {}
+    for variant, fn in variants.items():
+        for frequency, queries in terms.items():
+            res[f"search_{variant}_{frequency}"] = latency(
+                time_calls(fn, queries))
+    rng = random.Random(0)
+    one = [{rng.choice(tags)} for _ in range(n)]
+    two = [set(rng.sample(tags, min(2, len(tags)))) for _ in range(n)]
+    res["filter_by_tags_one"] = latency(time_calls(
+        lambda t: knov.tag_filter_results(t, limit=40), one))
+    res["filter_by_tags_two"] = latency(time_calls(
+        lambda t: knov.tag_filter_results(t, limit=40), two))
+    res["filter_by_tags_one_all"] = latency(time_calls(
+        lambda t: knov.tag_filter_results(t), one))
+    res["filter_by_tags_any"] = latency(time_calls(
+        lambda t: knov.tag_filter_results(set(), limit=40, any_tags=t), two))
+    res["filter_by_tags_exclude"] = latency(time_calls(
+        lambda t: knov.tag_filter_results(set(), limit=40, exclude_tags=t),
+        one))
+    knov.close()
+    return res
+
+
+def bench_transfer(corpus: Corpus, db: str, tmp: str) -> Dict[str, Any]:
+    """
+    Export the index to a gzip compressed dump and import it into a new one.
+    """
+    docs = corpus.config.docs
+    dump = os.path.join(tmp, "index.jsonl.gz")
+    knov = Knovleks({}, db)
+    start = time.perf_counter()
+    with io.TextIOWrapper(gzip.GzipFile(dump, "wb", compresslevel=4),
+                          encoding="utf-8") as out:
+        knov.export_index(out)
+    elapsed = time.perf_counter() - start
+    knov.close()
+    res: Dict[str, Any] = {"export": {
+        "seconds": elapsed, "docs_per_second": docs / elapsed,
+        "dump_bytes": os.path.getsize(dump)}}
+    path = os.path.join(tmp, "imported.db")
+    knov = Knovleks({}, path)
+    start = time.perf_counter()
+    with io.TextIOWrapper(gzip.GzipFile(dump, "rb"),
+                          encoding="utf-8") as lines:
+        knov.import_index(read_records(lines))
+    elapsed = time.perf_counter() - start
+    knov.close()
+    res["import"] = {"seconds": elapsed, "docs_per_second": docs / elapsed,
+                     "db_size_bytes": db_size(path)}
+    return res
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]):
+    if baseline.get("config") != current["config"]:
+        click.echo("warning: the baseline used another corpus configuration",
+                   err=True)
+    old = flatten(baseline["results"])
+    new = flatten(current["results"])
+    click.echo(f"{'metric':<48} {'baseline':>12} {'current':>12} change",
+               err=True)
+    for key in sorted(old.keys() & new.keys()):
+        if key.endswith(".n"): continue
+        change = (new[key] / old[key] - 1) * 100 if old[key] else 0.0
+        click.echo(f"{key:<48} {old[key]:>12.3f} {new[key]:>12.3f} "
+                   f"{change:+6.1f}%", err=True)
+
+
+@click.command(help=__doc__)
+@click.option("--docs", type=int, default=CorpusConfig.docs,
+              show_default=True)
+@click.option("--parts", type=int, default=CorpusConfig.parts,
+              show_default=True, help="parts per document")
+@click.option("--part-words", type=int, default=CorpusConfig.part_words,
+              show_default=True, help="words per part")
+@click.option("--tags", type=int, default=CorpusConfig.tags,
+              show_default=True, help="number of distinct tags")
+@click.option("--tags-per-doc", type=int, default=CorpusConfig.tags_per_doc,
+              show_default=True)
+@click.option("--vocabulary", type=int, default=CorpusConfig.vocabulary,
+              show_default=True, help="number of distinct words")
+@click.option("--seed", type=int, default=CorpusConfig.seed,
+              show_default=True)
+@click.option("-q", "--queries", type=int, default=50, show_default=True,
+              help="queries per search variant and term frequency")
+@click.option("--compress", is_flag=True, default=False,
+              help="store the text of parts compressed")
+@click.option("--db", type=click.Path(dir_okay=False),
+              help="keep the index here instead of a temporary directory")
+@click.option("-o", "--output", type=click.File("w"), default="-",
+              help="JSON result file")
+@click.option("--baseline", type=click.File("r"),
+              help="earlier JSON result to compare with")
+def main(docs: int, parts: int, part_words: int, tags: int,
+         tags_per_doc: int, vocabulary: int, seed: int, queries: int,
+         compress: bool, db: Optional[str], output, baseline):
+    config = CorpusConfig(docs, parts, part_words, tags, tags_per_doc,
+                          vocabulary, seed)
+    corpus = Corpus(config)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = db or os.path.join(tmp, "index.db")
+        if os.path.exists(path):
+            raise click.UsageError(f"{path} already exists")
+        results = bench_ingest(corpus, path, compress)
+        results.update(bench_queries(corpus, path, queries))
+        results.update(bench_transfer(corpus, path, tmp))
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": asdict(config),
+        "storage": "compressed" if compress else "plain",
+        "results": results,
+    }
+    json.dump(report, output, indent=2)
+    output.write("\n")
+    if baseline is not None:
+        compare(json.load(baseline), report)
+
+
+if __name__ == "__main__":
+    main()
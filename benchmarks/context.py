@@ -0,0 +1,8 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                '..')))
+
+from knovleks.knovleks import Knovleks, SearchSnipOptions
+from knovleks.idocument_type import IdocumentType, DocPart
+from knovleks.transfer import read_records
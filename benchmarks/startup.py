@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Wall time of short CLI invocations, which is dominated by imports, on an
+empty index. Results are written as JSON like bench.py, pass an earlier
+result as --baseline to compare against it.
+"""
+
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Dict, List, Sequence
+
+import click
+
+from bench import compare, git_commit, latency
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+COMMANDS = {
+    "help": ["--help"],
+    "search": ["search", "foo"],
+    "tag_filter": ["tag-filter", "foo"],
+}
+_IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)")
+
+
+def run(args: Sequence[str], home: str, importtime: bool = False
+        ) -> subprocess.CompletedProcess:
+    # the index is opened in ~/.config, HOME keeps it out of the real one
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+    flags = ["-X", "importtime"] if importtime else []
+    return subprocess.run([sys.executable, *flags, "-m", "knovleks", *args],
+                          env=env, cwd=ROOT, capture_output=True, text=True,
+                          check=True)
+
+
+def time_command(args: Sequence[str], home: str, runs: int) -> List[float]:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(args, home)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def slowest_imports(args: Sequence[str], home: str,
+                    n: int) -> Dict[str, float]:
+    """
+    Cumulative import time in ms of the slowest top-level imports.
+    """
+    imports = {}
+    for line in run(args, home, importtime=True).stderr.splitlines():
+        m = _IMPORT_TIME.match(line)
+        if m and not m[2]:
+            imports[m[3]] = int(m[1]) / 1000
+    slowest = sorted(imports.items(), key=lambda el: -el[1])[:n]
+    return dict(slowest)
+
+
+@click.command(help=__doc__)
+@click.option("-r", "--runs", type=click.IntRange(1), default=20,
+              show_default=True, help="runs per command")
+@click.option("--imports", type=int, default=10, show_default=True,
+              help="number of slowest imports to report per command")
+@click.option("-o", "--output", type=click.File("w"), default="-",
+              help="JSON result file")
+@click.option("--baseline", type=click.File("r"),
+              help="earlier JSON result to compare with")
+def main(runs: int, imports: int, output, baseline):
+    results = {}
+    with tempfile.TemporaryDirectory() as home:
+        # create the index first, so that no run pays for the schema
+        run(COMMANDS["search"], home)
+        for name, args in COMMANDS.items():
+            results[name] = latency(time_command(args, home, runs))
+            results[name]["imports_ms"] = slowest_imports(args, home, imports)
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": {"runs": runs},
+        "results": results,
+    }
+    json.dump(report, output, indent=2)
+    output.write("\n")
+    if baseline is not None:
+        compare(json.load(baseline), report)
+
+
+if __name__ == "__main__":
+    main()
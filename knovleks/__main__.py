@@ -1,14 +1,37 @@
 #!/usr/bin/env python3
 
+import cProfile
+import glob
+import gzip
+import io
+import json
+import os
+import sys
 import textwrap
 import shutil
+import sqlite3
+import time
 import click
 
-from typing import Mapping, Type, Tuple, Optional
-from .knovleks import Knovleks, SearchSnipOptions
-from .document_types import NoteDocument, PdfDocument, WebsiteDocument
+from collections import deque
+from dataclasses import asdict
+from typing import (Any, Callable, Deque, Dict, FrozenSet, Mapping, Type,
+                    Tuple, Optional, Iterator, Iterable, Union)
+from . import stats
+from .knovleks import (Knovleks, SearchPage, SearchQuery, SearchResult,
+                       SearchSnipOptions, iter_pages)
+from .ingest import (IndexJob, document_errors, parse_documents,
+                     skip_unchanged, walk_files)
+from .cache import ResultCache
+from .connection import ReaderPool
+from .federated import FederatedKnovleks
 from .idocument_type import IdocumentType
-from .tui import KnovTui
+from .registry import DocumentTypeRegistry
+from .transfer import read_records
+
+# fetch, watch, serve, tui and the document types are imported where they
+# are used, most of the startup time of a command would be spent importing
+# their dependencies otherwise
 
 
 class bcolors:
@@ -35,12 +58,7 @@ def print_autobreak(*args, sep=' '):
 
 
 def get_supported_document_types() -> Mapping[str, Type[IdocumentType]]:
-    # TODO: make modular
-    return {
-        "note": NoteDocument,
-        "pdf": PdfDocument,
-        "website": WebsiteDocument
-    }
+    return DocumentTypeRegistry()
 
 
 def is_url(path: str) -> bool:
@@ -60,78 +78,495 @@ def determine_doc_type(document: str) -> str:
         return "note"
 
 
+def expand_documents(documents: Iterable[str]) -> Iterator[str]:
+    """
+    Expand directories (recursively), glob patterns and "-" (one document per
+    line on stdin) to the documents they refer to.
+    """
+    for document in documents:
+        if document == "-":
+            yield from expand_documents(
+                line.strip() for line in sys.stdin if line.strip())
+        elif is_url(document):
+            yield document
+        elif os.path.isdir(document):
+            yield from walk_files(document)
+        elif glob.has_magic(document):
+            for path in sorted(glob.iglob(document, recursive=True)):
+                if os.path.isdir(path):
+                    yield from walk_files(path)
+                else:
+                    yield path
+        else:
+            yield document
+
+
+def paged(fetch_page: Callable[[int, Optional[str]], SearchPage],
+          page_size: int, limit: Optional[int]) -> Iterator[SearchResult]:
+    """
+    Yield results page by page until `limit` results or the last page.
+    """
+    for page in iter_pages(fetch_page, page_size, limit):
+        yield from page.results
+
+
+def skip_failed(job: IndexJob, exc: Exception):
+    click.echo(f"{bcolors.WARNING}skipping {job.href}: {exc}{bcolors.ENDC}",
+               err=True)
+
+
+def run_index(knov: Knovleks, jobs: Iterable[IndexJob],
+              batch_size: int = 500, workers: Optional[int] = 1,
+              max_pending: Optional[int] = None, fetch_workers: int = 16,
+              per_host: int = 2, timeout: float = 10, retries: int = 3,
+              force: bool = False,
+              on_error: Callable[[IndexJob, Exception], None] = skip_failed
+              ) -> int:
+    """
+    Fetch, parse and index documents, returns the number of indexed ones.
+    """
+    from .fetch import WebsiteFetcher
+    with WebsiteFetcher(fetch_workers, per_host, timeout, retries) as fetcher:
+        fetched = fetcher.fetch_jobs(jobs, on_error=on_error)
+        if not force:
+            fetched = skip_unchanged(knov, fetched, batch_size)
+        docs = parse_documents(knov.supported_types, fetched,
+                               workers=workers, max_pending=max_pending,
+                               on_error=on_error)
+        return knov.index_documents(docs, batch_size=batch_size,
+                                    on_error=document_errors(on_error))
+
+
 @click.group(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--stats", "show_stats", is_flag=True,
+              help="print timings of the steps and SQL statements to stderr")
+@click.option("--profile", type=click.Path(dir_okay=False),
+              help="write cProfile output to this file")
+@click.option("--db", type=click.Path(dir_okay=False),
+              help="index to use and write to  [default: "
+              "~/.config/knovleks.knovleks/index.db]")
+@click.option("--shard", multiple=True,
+              type=click.Path(dir_okay=False, exists=True),
+              help="also search this index, which is opened read-only")
 @click.pass_context
-def cli(ctx):
+def cli(ctx, show_stats: bool, profile: Optional[str], db: Optional[str],
+        shard: Tuple[str]):
+    # before the index is opened, its connections are traced on creation
+    if show_stats:
+        stats.enable()
+        start = time.perf_counter()
+
+        def print_stats():
+            elapsed = time.perf_counter() - start
+            click.echo(f"\ntotal {elapsed * 1000:.1f} ms\n", err=True)
+            click.echo(stats.summary(), err=True)
+        ctx.call_on_close(print_stats)
+    if profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump_profile():
+            profiler.disable()
+            profiler.dump_stats(profile)
+        ctx.call_on_close(dump_profile)
     supported_types = get_supported_document_types()
-    ctx.obj = Knovleks(supported_types)
+    knov = Knovleks(supported_types) if db is None \
+        else Knovleks(supported_types, db)
+    if not shard:
+        ctx.obj = knov
+        return
+    shards = [knov]
+    try:
+        for path in shard:
+            shards.append(Knovleks(supported_types, path, read_only=True))
+    except (RuntimeError, sqlite3.Error) as e:
+        raise click.ClickException(f"{path}: {e}")
+    ctx.obj = FederatedKnovleks(shards)
 
 
-@click.command(help="")
-@click.argument("document")
+@click.command(help="index documents, directories, globs or - for stdin")
+@click.argument("document", nargs=-1, required=True)
 @click.option("-t", "--tag", multiple=True)
 @click.option("--title", default="")
 @click.option("-d", "--type", "--document-type", default="auto")
+@click.option("-b", "--batch-size", type=int, default=500, show_default=True,
+              help="number of documents per transaction")
+@click.option("-j", "--jobs", type=int, default=1, show_default=True,
+              help="number of parser processes, 0 for one per CPU")
+@click.option("--max-pending", type=int,
+              help="maximum number of documents being parsed at once "
+                   "[default: 4 per job]")
+@click.option("--fetch-workers", type=int, default=16, show_default=True,
+              help="number of concurrent website downloads")
+@click.option("--per-host", type=int, default=2, show_default=True,
+              help="maximum concurrent downloads per host")
+@click.option("--timeout", type=float, default=10, show_default=True,
+              help="website download timeout in seconds")
+@click.option("--retries", type=int, default=3, show_default=True,
+              help="number of retries per website download")
+@click.option("-f", "--force", is_flag=True, default=False,
+              help="reindex documents even if they did not change")
+@click.pass_obj
+def index(knov: Knovleks, document: Tuple[str], tag: Tuple[str],
+          title: str, type: str, batch_size: int, jobs: int,
+          max_pending: Optional[int], fetch_workers: int, per_host: int,
+          timeout: float, retries: int, force: bool):
+    def index_jobs():
+        for href in expand_documents(document):
+            doc_type = determine_doc_type(href) if type == "auto" else type
+            yield IndexJob(doc_type, href, title, set(tag))
+
+    start = time.perf_counter()
+    n = run_index(knov, index_jobs(), batch_size, jobs or None, max_pending,
+                  fetch_workers, per_host, timeout, retries, force)
+    elapsed = time.perf_counter() - start
+    click.echo(f"indexed {n} documents in {elapsed:.2f}s "
+               f"({n / elapsed if elapsed else 0:.1f} docs/s)", err=True)
+
+
+@click.command(help="keep the index in sync with directories")
+@click.argument("directory", nargs=-1, required=True,
+                type=click.Path(exists=True, file_okay=False))
+@click.option("-t", "--tag", multiple=True)
+@click.option("--debounce", type=float, default=0.2, show_default=True,
+              help="seconds without changes before a batch is indexed")
+@click.option("--polling", is_flag=True, default=False,
+              help="poll for changes instead of using inotify")
+@click.option("--poll-interval", type=float, default=1.0, show_default=True,
+              help="seconds between scans when polling")
+@click.pass_obj
+def watch(knov: Knovleks, directory: Tuple[str], tag: Tuple[str],
+          debounce: float, polling: bool, poll_interval: float):
+    def report(indexed: int, deleted: int, elapsed: float):
+        click.echo(f"indexed {indexed}, deleted {deleted} documents "
+                   f"in {elapsed:.2f}s", err=True)
+
+    from .watch import DirectoryWatcher
+    watcher = DirectoryWatcher(knov, directory, determine_doc_type, set(tag),
+                               debounce=debounce, polling=polling,
+                               poll_interval=poll_interval,
+                               on_error=skip_failed, on_batch=report)
+    backend = "polling" if watcher.polling else "inotify"
+    click.echo(f"watching {', '.join(watcher.directories)} ({backend})",
+               err=True)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+@click.command(help="serve search and indexing over a local HTTP/JSON API")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("-p", "--port", type=int, default=8765, show_default=True)
+@click.option("-s", "--socket", "socket_path", type=click.Path(),
+              help="listen on a unix socket instead of host and port")
+@click.option("--readers", type=click.IntRange(1), default=8,
+              show_default=True, help="number of read connections")
+@click.option("--cache-size", type=int, default=256, show_default=True,
+              help="number of cached query results, 0 to disable")
 @click.pass_obj
-def index(knov: Knovleks, document: str, tag: Tuple[str],
-          title: str, type: str):
-    if type == "auto":
-        type = determine_doc_type(document)
-    knov.index_document(type, document, title, set(tag))
+def serve(knov: Knovleks, host: str, port: int, socket_path: Optional[str],
+          readers: int, cache_size: int):
+    from .serve import HTTPSearchServer, SearchService, UnixSearchServer
+    shards = knov.shards if isinstance(knov, FederatedKnovleks) else [knov]
+    for shard in shards:
+        if shard.readers is not None:
+            shard.readers.close()
+            shard.readers = ReaderPool(shard.db_path, readers)
+        if cache_size > 0:
+            shard.cache = ResultCache(cache_size)
+
+    def index(jobs: Iterable[IndexJob], force: bool,
+              on_error: Callable[[IndexJob, Exception], None]) -> int:
+        return run_index(knov, jobs, force=force, on_error=on_error)
+
+    app = SearchService(knov, index, determine_doc_type)
+    server: Union[HTTPSearchServer, UnixSearchServer]
+    if socket_path:
+        server = UnixSearchServer(app, socket_path)
+        address = socket_path
+    else:
+        server = HTTPSearchServer(app, host, port)
+        address = f"http://{host}:{server.server_address[1]}"
+    click.echo(f"serving on {address}", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 @click.command(help="full-text search")
 @click.argument("query")
 @click.option("-t", "--tag", multiple=True)
+@click.option("-at", "--any-tag", multiple=True,
+              help="require at least one of these tags")
+@click.option("-xt", "--exclude-tag", multiple=True,
+              help="leave out documents with this tag")
 @click.option("-st", "--show-tags", is_flag=True, default=False)
 @click.option("-l", "--limit", type=int)
 @click.option("-dt", "--doc-type")
 @click.option("-ft", "--full-text", is_flag=True, default=False,
               help="display full text")
+@click.option("-p", "--page-size", type=click.IntRange(1), default=50,
+              show_default=True,
+              help="number of results fetched and printed at once")
+@click.option("--dedup", is_flag=True, default=False,
+              help="show text shared by several documents only once")
 @click.pass_obj
-def search(knov: Knovleks, query: str, tag: Tuple[str], show_tags: bool,
-           limit: Optional[int], doc_type: Optional[str], full_text: bool):
+def search(knov: Knovleks, query: str, tag: Tuple[str],
+           any_tag: Tuple[str], exclude_tag: Tuple[str], show_tags: bool,
+           limit: Optional[int], doc_type: Optional[str], full_text: bool,
+           page_size: int, dedup: bool):
     so = None if full_text else SearchSnipOptions(bcolors.OKBLUE, bcolors.ENDC)
-    sq = knov.search(query, set(tag), limit=limit, doc_type=doc_type, snip=so)
+    sq = paged(lambda size, cursor: knov.search_page(
+        query, set(tag), size, doc_type=doc_type, snip=so, cursor=cursor,
+        dedup=dedup, any_tags=set(any_tag), exclude_tags=set(exclude_tag)),
+        page_size, limit)
     for result in sq:
-        href = result[0]
-        page = int(result[1])
-        pstr = f" : page {page}" if page > 0 else ""
-        print(f"{bcolors.OKGREEN}{href}{bcolors.ENDC}{pstr}")
+        pstr = ""
+        if result.elem_idx > 0:
+            pstr = f" : {knov.elem_label(result.doc_type, result.elem_idx)}"
+        print(f"{bcolors.OKGREEN}{result.href}{bcolors.ENDC}{pstr}")
         if show_tags:
-            returned_tags = ', '.join(knov.get_tags_by_href(href))
+            returned_tags = ', '.join(result.tags)
             print(f"tags: {bcolors.OKCYAN}{returned_tags}{bcolors.ENDC}")
-        print_autobreak(result[3])
+        print_autobreak(result.snippet)
         print()
 
 
 @click.command(help="tag filter")
 @click.argument("tag", nargs=-1)
+@click.option("-at", "--any-tag", multiple=True,
+              help="require at least one of these tags")
+@click.option("-xt", "--exclude-tag", multiple=True,
+              help="leave out documents with this tag")
 @click.option("-st", "--show-tags", is_flag=True, default=False)
 @click.option("-l", "--limit", type=int)
 @click.option("-dt", "--doc-type")
+@click.option("-p", "--page-size", type=click.IntRange(1), default=50,
+              show_default=True,
+              help="number of results fetched and printed at once")
 @click.pass_obj
-def tag_filter(knov: Knovleks, tag: Tuple[str], show_tags: bool,
-               limit: Optional[int], doc_type: Optional[str]):
-    sq = knov.filter_by_tags(set(tag), limit=limit, doc_type=doc_type)
+def tag_filter(knov: Knovleks, tag: Tuple[str], any_tag: Tuple[str],
+               exclude_tag: Tuple[str], show_tags: bool,
+               limit: Optional[int], doc_type: Optional[str],
+               page_size: int):
+    sq = paged(lambda size, cursor: knov.tag_filter_page(
+        set(tag), size, doc_type=doc_type, cursor=cursor,
+        any_tags=set(any_tag), exclude_tags=set(exclude_tag)),
+        page_size, limit)
     for result in sq:
-        href = result[0]
-        print(f"{bcolors.OKGREEN}{href}{bcolors.ENDC}")
+        print(f"{bcolors.OKGREEN}{result.href}{bcolors.ENDC}")
         if show_tags:
-            returned_tags = ', '.join(knov.get_tags_by_href(href))
+            returned_tags = ', '.join(result.tags)
             print(f"tags: {bcolors.OKCYAN}{returned_tags}{bcolors.ENDC}")
         print()
 
 
+def _tag_set(obj: Dict[str, Any], name: str) -> FrozenSet[str]:
+    tags = obj.get(name, [])
+    if isinstance(tags, str): tags = [tags]
+    if not isinstance(tags, list) or \
+            not all(isinstance(t, str) for t in tags):
+        raise ValueError(f"{name} must be a string or a list of strings")
+    return frozenset(tags)
+
+
+def parse_batch_query(line: str, limit: Optional[int]
+                      ) -> Tuple[SearchQuery, Any]:
+    """
+    A line of search-batch: either the query itself or a JSON object with
+    the parameters of /search, e.g. {"q": "sun", "tag": ["a"], "limit": 5},
+    and an optional "id" that is returned with the results.
+    """
+    if not line.startswith("{"):
+        return SearchQuery(line, limit=limit), None
+    obj = json.loads(line)
+    if not isinstance(obj, dict) or not isinstance(obj.get("q"), str) or \
+            not obj["q"].strip():
+        raise ValueError("missing q")
+    query_limit = obj.get("limit", limit)
+    valid_limit = isinstance(query_limit, int) and query_limit >= 0
+    if query_limit is not None and not valid_limit:
+        raise ValueError("limit must be an integer >= 0")
+    query = SearchQuery(obj["q"], _tag_set(obj, "tag"), query_limit,
+                        obj.get("doc_type"), bool(obj.get("dedup")),
+                        _tag_set(obj, "any_tag"),
+                        _tag_set(obj, "exclude_tag"))
+    return query, obj.get("id")
+
+
+@click.command(help="run queries from stdin, one per line (text or JSON), "
+               "and write their results as JSON lines")
+@click.option("-l", "--limit", type=click.IntRange(0), default=20,
+              show_default=True, help="results per query, unless the query "
+              "sets a limit")
+@click.option("-w", "--workers", type=click.IntRange(1), default=1,
+              show_default=True, help="queries run in parallel")
+@click.option("-ft", "--full-text", is_flag=True, default=False,
+              help="return the full text instead of snippets")
+@click.option("--left", default="<b>", show_default=True,
+              help="inserted before matches in snippets")
+@click.option("--right", default="</b>", show_default=True,
+              help="inserted after matches in snippets")
+@click.pass_obj
+def search_batch(knov: Knovleks, limit: int, workers: int, full_text: bool,
+                 left: str, right: str):
+    snip = None if full_text else SearchSnipOptions(left, right)
+    # line number and id of the queries in flight, or a line's error
+    lines: Deque[Tuple[int, Any, Optional[str]]] = deque()
+
+    def queries() -> Iterator[SearchQuery]:
+        for n, line in enumerate(sys.stdin, 1):
+            line = line.strip()
+            if not line: continue
+            try:
+                query, query_id = parse_batch_query(line, limit)
+            except ValueError as e:
+                lines.append((n, None, str(e)))
+                continue
+            lines.append((n, query_id, None))
+            yield query
+
+    def write(obj: Dict[str, Any]):
+        sys.stdout.write(json.dumps(obj) + "\n")
+        sys.stdout.flush()
+
+    def write_errors():
+        while lines and lines[0][2] is not None:
+            n, _, error = lines.popleft()
+            write({"line": n, "error": error})
+
+    count = 0
+    start = time.perf_counter()
+    for res in knov.search_many(queries(), snip, workers):
+        write_errors()
+        n, query_id, _ = lines.popleft()
+        obj: Dict[str, Any] = {"line": n, "q": res.query.query}
+        if query_id is not None:
+            obj["id"] = query_id
+        obj["ms"] = round(res.seconds * 1000, 3)
+        obj["results"] = [asdict(r) for r in res.results]
+        write(obj)
+        count += 1
+    write_errors()
+    elapsed = time.perf_counter() - start
+    click.echo(f"{count} queries in {elapsed:.2f}s", err=True)
+
+
+@click.command(help="compact the index and speed up queries")
+@click.option("--incremental", is_flag=True, default=False,
+              help="only merge the FTS index, in small transactions that "
+              "do not block other writers for long")
+@click.option("--vacuum", is_flag=True, default=False,
+              help="rebuild the database file without unused pages")
+@click.option("--automerge", type=click.IntRange(0, 16),
+              help="merge this many FTS segments of a level (0: never)")
+@click.option("--crisismerge", type=click.IntRange(2),
+              help="merge while writing once there are this many segments")
+@click.pass_obj
+def optimize(knov: Knovleks, incremental: bool, vacuum: bool,
+             automerge: Optional[int], crisismerge: Optional[int]):
+    knov.set_fts_settings(automerge, crisismerge)
+    before = knov.storage_stats()
+    start = time.perf_counter()
+    if incremental:
+        knov.merge()
+    else:
+        knov.optimize(vacuum)
+    elapsed = time.perf_counter() - start
+    after = knov.storage_stats()
+    settings = ", ".join(f"{k} {v}" for k, v in knov.fts_settings().items())
+    click.echo(f"optimized in {elapsed:.2f}s ({settings})")
+    for name, key in (("size", "size"), ("unused", "free")):
+        click.echo(f"{name:<10} {before[key] / 2**20:>10.1f} MiB -> "
+                   f"{after[key] / 2**20:.1f} MiB")
+    click.echo(f"{'FTS pages':<10} {before['fts_pages']:>10} -> "
+               f"{after['fts_pages']}")
+
+
+@click.command(help="store the text of documents compressed")
+@click.option("--off", is_flag=True, default=False,
+              help="store it uncompressed again")
+@click.option("--vacuum/--no-vacuum", default=True, show_default=True,
+              help="give the freed space back to the file system")
+@click.pass_obj
+def compress(knov: Knovleks, off: bool, vacuum: bool):
+    before = knov.storage_stats()
+    start = time.perf_counter()
+    knov.set_part_compression(not off)
+    if vacuum:
+        knov.optimize(vacuum=True)
+    elapsed = time.perf_counter() - start
+    after = knov.storage_stats()
+    click.echo(f"{'uncompressed' if off else 'compressed'} in "
+               f"{elapsed:.2f}s, size {before['size'] / 2**20:.1f} MiB -> "
+               f"{after['size'] / 2**20:.1f} MiB")
+
+
+def open_dump(path: str, mode: str, level: int = 4) -> io.TextIOWrapper:
+    """
+    A gzip compressed dump file as text, - for stdin or stdout.
+    """
+    if path == "-":
+        std = sys.stdin if mode == "r" else sys.stdout
+        fileobj = gzip.GzipFile(fileobj=std.buffer, mode=mode + "b",
+                                compresslevel=level)
+    else:
+        fileobj = gzip.GzipFile(path, mode + "b", compresslevel=level)
+    return io.TextIOWrapper(fileobj, encoding="utf-8")
+
+
+@click.command(help="write the index to a compressed file, - for stdout")
+@click.argument("file", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--level", type=click.IntRange(1, 9), default=4,
+              show_default=True, help="gzip compression level")
+@click.pass_obj
+def export(knov: Knovleks, file: str, level: int):
+    start = time.perf_counter()
+    with open_dump(file, "w", level) as out:
+        n = knov.export_index(out)
+    elapsed = time.perf_counter() - start
+    size = "" if file == "-" else f", {os.path.getsize(file) / 2**20:.1f} MiB"
+    click.echo(f"exported {n} records in {elapsed:.2f}s{size}", err=True)
+
+
+@click.command("import",
+               help="load an exported index into an empty index, - for stdin")
+@click.argument("file", type=click.Path(dir_okay=False, allow_dash=True,
+                                        exists=True))
+@click.pass_obj
+def import_(knov: Knovleks, file: str):
+    start = time.perf_counter()
+    try:
+        with open_dump(file, "r") as lines:
+            counts = knov.import_index(read_records(lines))
+    except (ValueError, OSError, sqlite3.Error) as e:
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+    click.echo(f"imported {counts['doc']} documents, {counts['part']} parts "
+               f"and {counts['tag']} tags in {elapsed:.2f}s", err=True)
+
+
 @click.command(help="terminal user interface (experimental)")
 @click.pass_obj
 def tui(knov: Knovleks):
+    from .tui import KnovTui
     KnovTui.run(knovleks=knov, title=f"{__name__}")
 
 
 cli.add_command(index)
+cli.add_command(watch)
+cli.add_command(serve)
 cli.add_command(search)
 cli.add_command(tag_filter)
+cli.add_command(search_batch)
+cli.add_command(optimize)
+cli.add_command(compress)
+cli.add_command(export)
+cli.add_command(import_)
 cli.add_command(tui)
 
 if __name__ == '__main__':
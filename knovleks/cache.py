@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import threading
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class ResultCache:
+    """
+    LRU cache of query results holding at most `size` entries. Every entry
+    remembers the write generation of the index it was computed in and is
+    only returned for the same generation, so bumping the generation
+    invalidates all entries at once. Safe to share between threads, values
+    are computed outside of the lock.
+    """
+    def __init__(self, size: int = 128):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, Any]]" = \
+            OrderedDict()
+
+    def get(self, key: Hashable, generation: Hashable,
+            compute: Callable[[], Any]) -> Any:
+        """
+        Return the cached value of key, calling `compute` on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = compute()
+        if self.size > 0:
+            with self._lock:
+                self._entries[key] = (generation, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries), "size": self.size}
+
+    def __len__(self) -> int:
+        return len(self._entries)
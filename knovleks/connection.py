@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import queue
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from typing import Iterator, List
+from urllib.parse import quote
+
+from . import stats
+from .schema import register_functions
+
+
+# milliseconds to wait for a lock held by another process
+BUSY_TIMEOUT = 10000
+# negative: KiB of page cache per connection
+CACHE_SIZE = -32768
+MMAP_SIZE = 256 * 1024 * 1024
+# primary result codes of a read-only open that needs immutable=1
+_CANTOPEN, _READONLY = 14, 8
+
+
+def configure(con: sqlite3.Connection, writer: bool = False):
+    """
+    Apply the pragmas of all index connections. WAL mode is persistent and
+    can only be enabled by the writer, it allows readers to proceed while a
+    write transaction is running.
+    """
+    con.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT};")
+    con.execute(f"PRAGMA cache_size = {CACHE_SIZE};")
+    con.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+    if writer:
+        con.execute("PRAGMA journal_mode = WAL;")
+        # in WAL mode a crash can only lose the last commits, not corrupt
+        con.execute("PRAGMA synchronous = NORMAL;")
+
+
+def read_only_uri(path: str, immutable: bool = False) -> str:
+    uri = f"file:{quote(path)}?mode=ro"
+    return uri + "&immutable=1" if immutable else uri
+
+
+def connect_read_only(path: str) -> sqlite3.Connection:
+    """
+    Open an index read-only. A WAL index without its -shm file in a
+    directory that cannot be written, e.g. on a read-only mount, cannot be
+    read that way; it is opened immutable then, so SQLite neither locks it
+    nor notices changes by other processes.
+    """
+    con = sqlite3.connect(read_only_uri(path), uri=True,
+                          check_same_thread=False)
+    try:
+        # the file is only opened by the first statement
+        con.execute("SELECT count(*) FROM sqlite_master;")
+    except sqlite3.OperationalError as e:
+        if getattr(e, "sqlite_errorcode", 0) & 0xff not in \
+                (_CANTOPEN, _READONLY):
+            raise
+        con.close()
+        con = sqlite3.connect(read_only_uri(path, immutable=True), uri=True,
+                              check_same_thread=False)
+    return con
+
+
+class ReaderPool:
+    """
+    Read-only connections to an index for queries from several threads, at
+    most `size` are opened. A connection is used by one thread at a time.
+    """
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened: List[sqlite3.Connection] = []
+
+    def _open(self) -> sqlite3.Connection:
+        con = connect_read_only(self.path)
+        configure(con)
+        register_functions(con)
+        stats.trace(con)
+        return con
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a connection, waiting for one if all `size` are in use.
+        """
+        con = None
+        with self._lock:
+            if self._idle.empty() and len(self._opened) < self.size:
+                con = self._open()
+                self._opened.append(con)
+        if con is None:
+            con = self._idle.get()
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    def close(self):
+        with self._lock:
+            for con in self._opened:
+                con.close()
+            self._opened.clear()
@@ -1,3 +1,15 @@
-from .note_document import NoteDocument
-from .pdf_document import PdfDocument
-from .website_document import WebsiteDocument
+import importlib
+
+# imported on first access, the document types have heavy dependencies
+_MODULES = {
+    "NoteDocument": ".note_document",
+    "PdfDocument": ".pdf_document",
+    "WebsiteDocument": ".website_document",
+}
+
+
+def __getattr__(name: str):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(module, __name__), name)
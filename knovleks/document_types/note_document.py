@@ -1,11 +1,97 @@
 #!/usr/bin/env python3
 
+import os
+import re
+import shlex
+import subprocess
+
+from typing import Iterable, Iterator, List, Optional
 from ..idocument_type import IdocumentType, DocPart
 
 
+# parts are split before they grow larger than this, in characters
+MAX_PART_CHARS = 4000
+_HEADING = re.compile(r"#{1,6}(\s|$)")
+_FENCES = ("```", "~~~")
+# editors that take file:line instead of +line
+_COLON_LINE = {"code", "codium", "subl", "hx", "helix", "zed"}
+
+
+def split_note(lines: Iterable[str],
+               max_chars: int = MAX_PART_CHARS) -> Iterator[DocPart]:
+    """
+    Split the lines of a note into parts before every markdown heading
+    (outside of code blocks). Sections longer than `max_chars` are split
+    at the last blank line, or else between lines. The elem_idx of a part
+    is the number of its first line, starting at 1.
+    """
+    part: List[str] = []
+    start = 1
+    size = 0
+    # number of lines of part up to and including its last blank line
+    paragraph = 0
+    fence: Optional[str] = None
+    for lineno, line in enumerate(lines, 1):
+        stripped = line.lstrip()
+        if fence is not None:
+            if stripped.startswith(fence): fence = None
+        elif stripped.startswith(_FENCES):
+            fence = stripped[:3]
+        elif part and _HEADING.match(line):
+            yield DocPart("".join(part), start)
+            part, size, paragraph = [], 0, 0
+        if not part:
+            start = lineno
+        while size + len(line) > max_chars and part:
+            cut = paragraph or len(part)
+            yield DocPart("".join(part[:cut]), start)
+            part = part[cut:]
+            start += cut
+            size = sum(map(len, part))
+            paragraph = 0
+        # e.g. minified files or logs without line breaks
+        while len(line) > max_chars:
+            yield DocPart(line[:max_chars], lineno)
+            line = line[max_chars:]
+            start = lineno
+        part.append(line)
+        size += len(line)
+        if fence is None and not stripped:
+            paragraph = len(part)
+    if part:
+        yield DocPart("".join(part), start)
+
+
+def editor_command(editor: str, href: str, line: int) -> List[str]:
+    command = shlex.split(editor)
+    names = {os.path.basename(arg) for arg in command}
+    if names & _COLON_LINE:
+        goto = ["-g"] if names & {"code", "codium"} else []
+        return command + goto + [f"{href}:{line}"]
+    # vi, vim, nvim, emacs, nano, micro, kak, gedit, ...
+    return command + [f"+{line}", href]
+
+
 class NoteDocument(IdocumentType):
     def parse(self):
         self.doc_type = "note"
         with open(self.href, 'r') as f:
-            content = f.read()
-        self.parts.append(DocPart(doccontent=content))
+            self.parts = list(split_note(f))
+
+    @staticmethod
+    def elem_label(elem_idx: int) -> str:
+        return f"line {elem_idx}"
+
+    @staticmethod
+    def open_doc(href, elem_idx):
+        # runs detached, a terminal editor needs a terminal, e.g.
+        # KNOVLEKS_EDITOR="alacritty -e nvim"
+        editor = os.environ.get("KNOVLEKS_EDITOR") or \
+            os.environ.get("VISUAL")
+        if editor:
+            command = editor_command(editor, href, max(elem_idx, 1))
+        else:
+            command = ["/usr/bin/xdg-open", href]
+        dn = subprocess.DEVNULL
+        subprocess.Popen(command, stdin=dn, stdout=dn, stderr=dn,
+                         close_fds=True)
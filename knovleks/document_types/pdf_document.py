@@ -2,16 +2,21 @@
 
 import subprocess
 import fitz as pdfreader
+from typing import Iterator
 from ..idocument_type import IdocumentType, DocPart
 
 
 class PdfDocument(IdocumentType):
     def parse(self):
         self.doc_type = "pdf"
+        # fail early on broken files, the pages are only read when indexing
+        pdfreader.open(self.href).close()
+        self.parts = self._pages()
+
+    def _pages(self) -> Iterator[DocPart]:
         with pdfreader.open(self.href) as doc:
             for i, page in enumerate(doc, 1):
-                text = page.get_text()
-                self.parts.append(DocPart(doccontent=text, elem_idx=i))
+                yield DocPart(doccontent=page.get_text(), elem_idx=i)
 
     @staticmethod
     def open_doc(href, elem_idx):
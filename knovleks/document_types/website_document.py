@@ -1,22 +1,40 @@
 #!/usr/bin/env python3
 
-from ..idocument_type import IdocumentType, DocPart
+from ..idocument_type import IdocumentType, DocPart, SourceInfo, content_hash
+from dataclasses import dataclass, field
 from newspaper import Article
+from typing import Any, Mapping, Optional
 
 import webbrowser
 
 
+@dataclass
 class WebsiteDocument(IdocumentType):
+    # html fetched beforehand (see fetch.py), downloaded in parse() if unset
+    html: Optional[str] = field(default=None, repr=False)
+    adds_tags = True
+
     def parse(self):
         self.doc_type = "website"
         article = Article(self.href)
-        article.download()
+        article.download(input_html=self.html)
+        html = self.html if self.html is not None else article.html
+        self.html = None
+        if html:
+            self.source = SourceInfo(content_hash=content_hash(html))
         article.parse()
         self.title = article.title
         self.tags |= frozenset(article.keywords)
         self.metadata = {"author": article.authors}
         self.parts.append(DocPart(doccontent=article.text))
 
+    @staticmethod
+    def source_info(href: str, options: Mapping[str, Any] = {},
+                    known: Optional[SourceInfo] = None) -> SourceInfo:
+        if options.get("html") is None:
+            return SourceInfo()
+        return SourceInfo(content_hash=content_hash(options["html"]))
+
     @staticmethod
     def open_doc(href, elem_idx):
         webbrowser.open(href)
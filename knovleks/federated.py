@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import heapq
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import (Any, Dict, Generator, Iterable, Iterator, List,
+                    Optional, Sequence, Set, Tuple, Union)
+
+from .knovleks import (Knovleks, QueryResults, SearchPage, SearchQuery,
+                       SearchResult, SearchSnipOptions, check_page_size,
+                       decode_cursor, encode_cursor, ordered_map, run_query)
+from .tag_index import TagFilter
+
+
+# Part and reference ids sort before and after all others in shard cursors.
+_FIRST_ID = -1
+_LAST_ID = sys.maxsize
+
+# (rank, shard, part id, reference id): order of merged search results
+SearchKey = Tuple[float, int, int, int]
+
+
+class FederatedKnovleks:
+    """
+    Several indexes (shards) searched as one. Queries run on all shards in
+    parallel and their results are merged by rank, all writes and other
+    methods go to the `writer` shard. The bm25 ranks of different shards
+    are not exactly comparable, as they depend on the term frequencies of
+    each shard, which is fine for shards of similar documents.
+    """
+    def __init__(self, shards: Sequence[Knovleks], writer: int = 0):
+        if not shards:
+            raise ValueError("no shards")
+        self.shards = list(shards)
+        self.writer = self.shards[writer]
+        self._writer_idx = writer
+        self._executor = ThreadPoolExecutor(len(self.shards))
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for attributes this class does not have
+        return getattr(self.writer, name)
+
+    def reader(self, cache_size: int = 0) -> "FederatedKnovleks":
+        return FederatedKnovleks(
+            [shard.reader(cache_size) for shard in self.shards],
+            self._writer_idx)
+
+    def interrupt(self):
+        for shard in self.shards:
+            shard.interrupt()
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+    def cache_stats(self) -> Optional[Dict[str, int]]:
+        """
+        The result cache stats of all shards added up, None if none has one.
+        """
+        shard_stats = [s for s in (shard.cache_stats()
+                                   for shard in self.shards) if s is not None]
+        if not shard_stats: return None
+        return {k: sum(s[k] for s in shard_stats) for k in shard_stats[0]}
+
+    def _check_shard(self, shard_idx: Any, cursor: Optional[str]):
+        if not isinstance(shard_idx, int) or \
+                not 0 <= shard_idx < len(self.shards):
+            raise ValueError(f"invalid cursor: {cursor!r}")
+
+    def _on_shards(self, fn, shards: Optional[Sequence[int]] = None
+                   ) -> List[Any]:
+        """
+        fn(shard index, shard) of all (or the given) shards, in parallel.
+        """
+        if shards is None:
+            shards = range(len(self.shards))
+        futures = [self._executor.submit(fn, i, self.shards[i])
+                   for i in shards]
+        return [f.result() for f in futures]
+
+    def search(self, search_query: str, tags: Set[str] = set(),
+               limit: Optional[int] = None,
+               doc_type: Optional[str] = None,
+               snip: Optional[SearchSnipOptions] = None,
+               cursor: Optional[str] = None,
+               dedup: bool = False, any_tags: Set[str] = set(),
+               exclude_tags: Set[str] = set()) -> Generator:
+        for r in self.search_results(search_query, tags, limit, doc_type,
+                                     snip, cursor, dedup, any_tags,
+                                     exclude_tags):
+            yield r.href, r.elem_idx, r.title, r.snippet, r.doc_type
+
+    def search_results(self, search_query: str, tags: Set[str] = set(),
+                       limit: Optional[int] = None,
+                       doc_type: Optional[str] = None,
+                       snip: Optional[SearchSnipOptions] = None,
+                       cursor: Optional[str] = None,
+                       dedup: bool = False, any_tags: Set[str] = set(),
+                       exclude_tags: Set[str] = set()
+                       ) -> List[SearchResult]:
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        return [result for _, result in self._search(
+            search_query, tag_filter, limit, doc_type, snip, cursor, dedup)]
+
+    def search_page(self, search_query: str, tags: Set[str] = set(),
+                    page_size: int = 40,
+                    doc_type: Optional[str] = None,
+                    snip: Optional[SearchSnipOptions] = None,
+                    cursor: Optional[str] = None,
+                    dedup: bool = False, any_tags: Set[str] = set(),
+                    exclude_tags: Set[str] = set()) -> SearchPage:
+        check_page_size(page_size)
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        merged = self._search(search_query, tag_filter, page_size + 1,
+                              doc_type, snip, cursor, dedup)
+        next_cursor = None
+        if len(merged) > page_size:
+            merged = merged[:page_size]
+            next_cursor = encode_cursor(*merged[-1][0])
+        return SearchPage([result for _, result in merged], next_cursor)
+
+    def search_many(self, queries: Iterable[Union[str, SearchQuery]],
+                    snip: Optional[SearchSnipOptions] = None,
+                    workers: int = 1,
+                    max_pending: Optional[int] = None
+                    ) -> Iterator[QueryResults]:
+        def run(query: Union[str, SearchQuery]) -> QueryResults:
+            return run_query(self, query, snip)
+
+        if workers <= 1:
+            yield from map(run, queries)
+        else:
+            yield from ordered_map(run, queries, workers, max_pending)
+
+    def _search(self, search_query: str, tag_filter: TagFilter,
+                limit: Optional[int], doc_type: Optional[str],
+                snip: Optional[SearchSnipOptions], cursor: Optional[str],
+                dedup: bool) -> List[Tuple[SearchKey, SearchResult]]:
+        """
+        The best `limit` results of each shard, merged by rank. `cursor` is
+        the SearchKey of the last result of the previous page.
+        """
+        after = None if cursor is None else decode_cursor(cursor, 4)
+        if after is not None:
+            self._check_shard(after[1], cursor)
+
+        def shard_search(i: int, shard: Knovleks
+                         ) -> List[Tuple[SearchKey, SearchResult]]:
+            shard_cursor = None
+            if after is not None:
+                rank, shard_idx, part_id, ref_id = after
+                # results of earlier shards with the same rank were on the
+                # previous pages, those of later shards were not
+                if i < shard_idx:
+                    part_id, ref_id = _LAST_ID, _LAST_ID
+                elif i > shard_idx:
+                    part_id, ref_id = _FIRST_ID, _FIRST_ID
+                shard_cursor = encode_cursor(rank, part_id, ref_id)
+            rows = shard._search(search_query, tag_filter, limit, doc_type,
+                                 snip, shard_cursor, dedup)
+            results = shard._search_results(rows)
+            return [((row[6], i, row[7], row[8]), result)
+                    for row, result in zip(rows, results)]
+
+        merged = heapq.merge(*self._on_shards(shard_search),
+                             key=lambda el: el[0])
+        return list(islice(merged, limit))
+
+    def filter_by_tags(self, tags: Set[str], limit: Optional[int] = None,
+                       doc_type: Optional[str] = None,
+                       cursor: Optional[str] = None,
+                       any_tags: Set[str] = set(),
+                       exclude_tags: Set[str] = set()) -> Generator:
+        for r in self.tag_filter_results(tags, limit, doc_type, cursor,
+                                         any_tags, exclude_tags):
+            yield r.href, r.title, r.doc_type
+
+    def tag_filter_results(self, tags: Set[str], limit: Optional[int] = None,
+                           doc_type: Optional[str] = None,
+                           cursor: Optional[str] = None,
+                           any_tags: Set[str] = set(),
+                           exclude_tags: Set[str] = set()
+                           ) -> List[SearchResult]:
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        return [result for _, result in self._filter_by_tags(
+            tag_filter, limit, doc_type, cursor)]
+
+    def tag_filter_page(self, tags: Set[str], page_size: int = 40,
+                        doc_type: Optional[str] = None,
+                        cursor: Optional[str] = None,
+                        any_tags: Set[str] = set(),
+                        exclude_tags: Set[str] = set()) -> SearchPage:
+        check_page_size(page_size)
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        rows = self._filter_by_tags(tag_filter, page_size + 1, doc_type,
+                                    cursor)
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(*rows[-1][0])
+        return SearchPage([result for _, result in rows], next_cursor)
+
+    def _filter_by_tags(self, tag_filter: TagFilter, limit: Optional[int],
+                        doc_type: Optional[str], cursor: Optional[str]
+                        ) -> List[Tuple[Tuple[int, int], SearchResult]]:
+        """
+        The documents of shard after shard, with (shard, doc id) keys. The
+        shards are queried in parallel, for `limit` documents each.
+        """
+        shard_idx, after = (0, None) if cursor is None \
+            else decode_cursor(cursor, 2)
+        self._check_shard(shard_idx, cursor)
+
+        def shard_filter(i: int, shard: Knovleks
+                         ) -> List[Tuple[Tuple[int, int], SearchResult]]:
+            shard_cursor = None
+            if i == shard_idx and after is not None:
+                shard_cursor = encode_cursor(after)
+            rows = shard._filter_by_tags(tag_filter, limit, doc_type,
+                                         shard_cursor)
+            results = shard._tag_filter_results(rows)
+            return [((i, row[3]), result)
+                    for row, result in zip(rows, results)]
+
+        shards = range(shard_idx, len(self.shards))
+        rows = [row for shard_rows in self._on_shards(shard_filter, shards)
+                for row in shard_rows]
+        return rows[:limit]
+
+    def get_tags_by_href(self, href: str) -> Generator:
+        for shard in self.shards:
+            if shard.href_exists(href):
+                yield from shard.get_tags_by_href(href)
+                return
+
+    def href_exists(self, href: str) -> bool:
+        return any(self._on_shards(lambda _, shard: shard.href_exists(href)))
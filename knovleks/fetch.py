@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import threading
+
+from collections import defaultdict
+from concurrent.futures import (ThreadPoolExecutor, Future, FIRST_COMPLETED,
+                                wait)
+from typing import (Callable, DefaultDict, Iterable, Iterator, Optional, Set,
+                    Tuple)
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .ingest import IndexJob
+
+
+USER_AGENT = "Mozilla/5.0 (compatible; knovleks)"
+
+
+class WebsiteFetcher:
+    """
+    Download websites concurrently over a pooled HTTP session with at most
+    `per_host` requests in flight per host. Failed requests (connection
+    errors, 429 and 5xx responses) are retried `retries` times with
+    exponential backoff.
+    """
+    def __init__(self, workers: int = 16, per_host: int = 2,
+                 timeout: float = 10, retries: int = 3):
+        self.workers = workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=workers,
+                              pool_maxsize=per_host, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._host_lock = threading.Lock()
+        self._host_slots: DefaultDict[str, threading.Semaphore] = \
+            defaultdict(lambda: threading.BoundedSemaphore(per_host))
+
+    def _slot(self, url: str) -> threading.Semaphore:
+        with self._host_lock:
+            return self._host_slots[urlsplit(url).netloc.lower()]
+
+    def fetch(self, url: str) -> str:
+        with self._slot(url):
+            resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        # same decoding as newspaper: let lxml sniff the charset if the
+        # server did not declare one
+        if resp.encoding != "ISO-8859-1":
+            return resp.text
+        return resp.content  # type: ignore[return-value]
+
+    def fetch_jobs(self, jobs: Iterable[IndexJob],
+                   on_error: Optional[
+                       Callable[[IndexJob, Exception], None]] = None,
+                   max_pending: Optional[int] = None) -> Iterator[IndexJob]:
+        """
+        Download the html of website jobs and yield them with it attached as
+        `html` option. Other jobs are passed through immediately. If a
+        download fails, `on_error` is called and the job is dropped, without
+        `on_error` the exception is raised.
+        """
+        max_pending = max_pending or 4 * self.workers
+        pending: Set[Future] = set()
+
+        def collect(done: Set[Future]) -> Iterator[IndexJob]:
+            for f in done:
+                job, exc = f.result()
+                if exc is None:
+                    yield job
+                elif on_error is None:
+                    raise exc
+                else:
+                    on_error(job, exc)
+
+        with ThreadPoolExecutor(self.workers) as ex:
+            try:
+                for job in jobs:
+                    if job.doc_type != "website":
+                        yield job
+                        continue
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        yield from collect(done)
+                    pending.add(ex.submit(self._fetch_job, job))
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from collect(done)
+            finally:
+                for f in pending:
+                    f.cancel()
+
+    def _fetch_job(self, job: IndexJob
+                   ) -> Tuple[IndexJob, Optional[Exception]]:
+        try:
+            job.options["html"] = self.fetch(job.href)
+        except requests.RequestException as e:
+            return job, e
+        return job, None
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
 
+import hashlib
+import os
+import stat
 import subprocess
 
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from collections.abc import Sequence
-from typing import Mapping, Set
+from typing import Any, Iterable, Mapping, Optional, Set, Union
+
+
+def content_hash(content: Union[str, bytes]) -> str:
+    if isinstance(content, str):
+        content = content.encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
 
 
 @dataclass
@@ -13,6 +29,21 @@ class DocPart:
     doccontent: str
     elem_idx: int = 0
 
+    @property
+    def content_hash(self) -> str:
+        return content_hash(self.doccontent)
+
+
+@dataclass
+class SourceInfo:
+    """
+    State of the source a document was parsed from, used to skip unchanged
+    documents on reindexing. All fields are None if the source is unknown.
+    """
+    mtime: Optional[float] = None
+    size: Optional[int] = None
+    content_hash: Optional[str] = None
+
 
 @dataclass  # type: ignore[misc]
 class IdocumentType(ABC):
@@ -21,15 +52,52 @@ class IdocumentType(ABC):
     doc_type: str = ""
     tags: Set[str] = field(default_factory=lambda: set())
     metadata: Mapping[str, str] = field(default_factory=lambda: {})
-    parts: Sequence[DocPart] = field(default_factory=lambda: [])
+    # may be a generator, so that large documents are never fully in memory;
+    # it is consumed exactly once when the document is written to the index
+    parts: Iterable[DocPart] = field(default_factory=lambda: [])
+    source: Optional[SourceInfo] = None
+    # parse() adds tags of its own, e.g. keywords, so that the stored tags
+    # of a document may be more than the ones it was indexed with
+    adds_tags = False
 
     def __post_init__(self):
+        if self.source is None:
+            self.source = self.source_info(self.href)
         self.parse()
 
+    @staticmethod
+    def source_info(href: str, options: Mapping[str, Any] = {},
+                    known: Optional[SourceInfo] = None) -> SourceInfo:
+        """
+        Return the source state of `href` without parsing it. If the `known`
+        state has the same mtime and size, the content is not hashed again.
+        `options` are the keyword arguments the document will be created with.
+        """
+        try:
+            st = os.stat(href)
+        except OSError:
+            return SourceInfo()
+        if not stat.S_ISREG(st.st_mode):
+            return SourceInfo()
+        info = SourceInfo(st.st_mtime, st.st_size)
+        if known is not None and known.mtime == info.mtime \
+                and known.size == info.size:
+            info.content_hash = known.content_hash
+        else:
+            info.content_hash = file_hash(href)
+        return info
+
     @abstractmethod
     def parse(self):
         raise NotImplementedError
 
+    @staticmethod
+    def elem_label(elem_idx: int) -> str:
+        """
+        Where a part with `elem_idx` is in the document, shown with results.
+        """
+        return f"page {elem_idx}"
+
     @staticmethod
     def open_doc(href, elem_idx):
         subprocess.Popen(["/usr/bin/xdg-open", f"{href}"], kstdin=None,
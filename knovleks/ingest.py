@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+
+from concurrent.futures import (ProcessPoolExecutor, Future, FIRST_COMPLETED,
+                                wait)
+from dataclasses import dataclass, field
+from typing import (Any, Callable, Dict, Iterable, Iterator, Mapping, Optional,
+                    Set, Type)
+
+from . import stats
+from .idocument_type import IdocumentType
+from .knovleks import Knovleks, MAX_QUERY_PARAMS, chunked
+
+
+def walk_files(directory: str) -> Iterator[str]:
+    """
+    Recursively yield the files of a directory, skipping hidden ones.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for f in sorted(files):
+            if not f.startswith("."):
+                yield os.path.join(root, f)
+
+
+@dataclass
+class IndexJob:
+    doc_type: str
+    href: str
+    title: str = ""
+    tags: Set[str] = field(default_factory=lambda: set())
+    # extra keyword arguments for the document type, e.g. prefetched html
+    options: Dict[str, Any] = field(default_factory=lambda: {})
+
+
+def _parse_document(doc_cls: Type[IdocumentType], href: str, title: str,
+                    tags: Set[str], options: Dict[str, Any]) -> IdocumentType:
+    # IdocumentType parses on construction, so this runs in the worker
+    return doc_cls(href, title, tags=set(tags), **options)
+
+
+def _parse_document_eager(doc_cls: Type[IdocumentType], href: str, title: str,
+                          tags: Set[str],
+                          options: Dict[str, Any]) -> IdocumentType:
+    # lazily generated parts cannot be sent back from a worker process
+    doc = _parse_document(doc_cls, href, title, tags, options)
+    doc.parts = list(doc.parts)
+    return doc
+
+
+def parse_documents(supported_types: Mapping[str, Type[IdocumentType]],
+                    jobs: Iterable[IndexJob],
+                    workers: Optional[int] = 1,
+                    max_pending: Optional[int] = None,
+                    on_error: Optional[
+                        Callable[[IndexJob, Exception], None]] = None
+                    ) -> Iterator[IdocumentType]:
+    """
+    Parse documents in a pool of `workers` processes (None: one per CPU) and
+    yield them in completion order, so that a single writer can insert them.
+    At most `max_pending` jobs (default: 4 per worker) are in flight, the job
+    iterable is only consumed as results are taken out. If parsing fails,
+    `on_error` is called and the job is dropped, without `on_error` the
+    exception is raised.
+    Documents parsed in a worker have all their parts in memory, only the
+    sequential mode streams lazily generated parts into the index.
+    """
+    def failed(job: IndexJob, exc: Exception):
+        if on_error is None:
+            raise exc
+        on_error(job, exc)
+
+    if workers == 1:
+        for job in jobs:
+            try:
+                with stats.span("parse"):
+                    doc = _parse_document(supported_types[job.doc_type],
+                                          job.href, job.title, job.tags,
+                                          job.options)
+            except Exception as e:
+                failed(job, e)
+                continue
+            yield doc
+        return
+
+    def collect(done: Set[Future]) -> Iterator[IdocumentType]:
+        for f in done:
+            job = pending.pop(f)
+            try:
+                doc = f.result()
+            except Exception as e:
+                failed(job, e)
+                continue
+            yield doc
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 4 * workers
+    ex = ProcessPoolExecutor(workers)
+    pending: Dict[Future, IndexJob] = {}
+    try:
+        for job in jobs:
+            if len(pending) >= max_pending:
+                with stats.span("parse.wait"):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+            try:
+                doc_cls = supported_types[job.doc_type]
+            except Exception as e:
+                # e.g. an unknown type, reported like in sequential mode
+                failed(job, e)
+                continue
+            f = ex.submit(_parse_document_eager, doc_cls, job.href,
+                          job.title, job.tags, job.options)
+            pending[f] = job
+        while pending:
+            with stats.span("parse.wait"):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect(done)
+    finally:
+        ex.shutdown(cancel_futures=True)
+
+
+def document_errors(
+        on_error: Optional[Callable[[IndexJob, Exception], None]]
+) -> Optional[Callable[[IdocumentType, Exception], None]]:
+    """
+    Report documents that fail in index_documents to an on_error of jobs.
+    """
+    if on_error is None: return None
+    return lambda doc, exc: on_error(
+        IndexJob(doc.doc_type, doc.href, doc.title, set(doc.tags)), exc)
+
+
+def skip_unchanged(knov: Knovleks, jobs: Iterable[IndexJob],
+                   batch_size: int = MAX_QUERY_PARAMS) -> Iterator[IndexJob]:
+    """
+    Drop jobs for already indexed documents whose source, title and tags did
+    not change, before they are parsed. Only if mtime or size differ, the
+    content hash is compared. Tags a document type adds itself (adds_tags)
+    do not count as a change. The source state of the remaining jobs is
+    passed on, so that it is not determined twice.
+    """
+    for batch in chunked(jobs, batch_size):
+        stored = knov.get_sources(job.href for job in batch)
+        touched = []
+        for job in batch:
+            if job.href not in stored:
+                yield job
+                continue
+            known, title, tags = stored[job.href]
+            try:
+                doc_cls = knov.supported_types[job.doc_type]
+            except KeyError:
+                # reported by parse_documents, like for new documents
+                yield job
+                continue
+            info = doc_cls.source_info(job.href, job.options, known)
+            same_content = info.content_hash is not None and \
+                info.content_hash == known.content_hash
+            same_tags = job.tags <= tags if doc_cls.adds_tags \
+                else job.tags == tags
+            same_meta = same_tags and job.title in ("", title)
+            if same_content and same_meta:
+                if (info.mtime, info.size) != (known.mtime, known.size):
+                    touched.append((job.href, info))
+                continue
+            job.options["source"] = info
+            yield job
+        if touched:
+            with knov.writing():
+                knov.update_sources(touched)
@@ -1,63 +1,49 @@
 #!/usr/bin/env python
+import base64
+import json
 import sqlite3
-from dataclasses import dataclass
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import astuple, dataclass, field
 from pathlib import Path
-from typing import Set, Optional, List, Generator, Any
-
-from .idocument_type import IdocumentType
-
-
-DB_SCHEME = """
-CREATE TABLE IF NOT EXISTS documents (
-    id INTEGER PRIMARY KEY,
-    type TEXT,
-    href TEXT,
-    title TEXT
-);
-
-
-CREATE TABLE IF NOT EXISTS doc_parts (
-    id INTEGER PRIMARY KEY,
-    doc_id INTEGER,
-    elem_idx INTEGER,
-    doccontent TEXT,
-    FOREIGN KEY(doc_id) REFERENCES documents(id)
-);
-CREATE VIRTUAL TABLE IF NOT EXISTS doc_parts_fts USING fts5(
-    doccontent,
-    content=doc_parts,
-    content_rowid=id,
-    tokenize = 'porter unicode61'
-);
--- Triggers to keep the FTS index up to date.
-CREATE TRIGGER IF NOT EXISTS doc_parts_ai AFTER INSERT ON doc_parts BEGIN
-  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, new.doccontent);
-END;
-CREATE TRIGGER IF NOT EXISTS doc_parts_ad AFTER DELETE ON doc_parts BEGIN
-  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
-         VALUES('delete', old.id, old.doccontent);
-END;
-CREATE TRIGGER IF NOT EXISTS doc_parts_au AFTER UPDATE ON doc_parts BEGIN
-  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
-         VALUES('delete', old.id, old.doccontent);
-  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, new.doccontent);
-END;
-
-
-CREATE TABLE IF NOT EXISTS tags (
-    id INTEGER PRIMARY KEY,
-    tag TEXT
-);
-
-
-CREATE TABLE IF NOT EXISTS doc_tag (
-    id INTEGER PRIMARY KEY,
-    doc_id INTEGER,
-    tag_id INTEGER,
-    FOREIGN KEY(doc_id) REFERENCES documents(id),
-    FOREIGN KEY(tag_id) REFERENCES tags(id)
-);
-"""
+from itertools import islice
+from typing import (Set, Optional, List, Generator, Any, Iterable, Iterator,
+                    Dict, Sequence, Tuple, Callable, Deque, FrozenSet, Union,
+                    IO)
+
+from . import stats
+from .cache import ResultCache
+from .connection import ReaderPool, configure, connect_read_only
+from .idocument_type import IdocumentType, DocPart, SourceInfo
+from .tag_index import (ALL_DOCS, NO_DOCS, DocSet, TagFilter, TagIndex,
+                        doc_tag_version)
+from .schema import (SCHEMA_VERSION, compress_part, migrate,
+                     parts_compressed, register_functions, schema_version,
+                     set_part_compression)
+from .transfer import export_records, import_records, write_records
+
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds (999).
+MAX_QUERY_PARAMS = 500
+# Number of document parts held in memory at once while writing a document.
+PART_BATCH_SIZE = 64
+# Pages of FTS segments merged per transaction of an incremental merge.
+MERGE_PAGES = 500
+# Ingests of at least this many documents are followed by a merge.
+AUTO_MERGE_DOCS = 1000
+# FTS5 defaults of settings that are not stored in doc_parts_fts_config.
+FTS_SETTINGS = {"automerge": 4, "crisismerge": 16}
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk: return
+        yield chunk
 
 
 @dataclass
@@ -68,126 +54,742 @@ class SearchSnipOptions:
     token_nr: int = 50
 
 
+@dataclass
+class SearchResult:
+    href: str
+    elem_idx: int
+    title: str
+    snippet: str
+    doc_type: str
+    tags: List[str] = field(default_factory=lambda: [])
+
+
+@dataclass
+class SearchPage:
+    results: List[SearchResult]
+    # pass as cursor to get the next page, None on the last page
+    cursor: Optional[str] = None
+
+
+@dataclass
+class SearchQuery:
+    """
+    A query of search_many, with the arguments of search_results.
+    """
+    query: str
+    tags: FrozenSet[str] = frozenset()
+    limit: Optional[int] = None
+    doc_type: Optional[str] = None
+    dedup: bool = False
+    any_tags: FrozenSet[str] = frozenset()
+    exclude_tags: FrozenSet[str] = frozenset()
+
+
+@dataclass
+class QueryResults:
+    query: SearchQuery
+    results: List[SearchResult]
+    seconds: float
+
+
+def encode_cursor(*key: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> Tuple:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != length:
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    return tuple(key)
+
+
+def check_page_size(page_size: int):
+    if page_size < 1:
+        raise ValueError("page_size must be >= 1")
+
+
+def iter_pages(fetch_page: Callable[[int, Optional[str]], SearchPage],
+               page_size: int, limit: Optional[int] = None,
+               cursor: Optional[str] = None) -> Iterator[SearchPage]:
+    """
+    Fetch pages with fetch_page(size, cursor), following their cursors until
+    `limit` results or the last page.
+    """
+    check_page_size(page_size)
+    n = 0
+    while limit is None or n < limit:
+        size = page_size if limit is None else min(page_size, limit - n)
+        page = fetch_page(size, cursor)
+        yield page
+        n += len(page.results)
+        if page.cursor is None: return
+        cursor = page.cursor
+
+
+def ordered_map(fn: Callable[[Any], Any], items: Iterable, workers: int,
+                max_pending: Optional[int] = None) -> Iterator:
+    """
+    map() on `workers` threads, yielding in the order of `items`, which are
+    only consumed as results are taken out: at most `max_pending` (default:
+    4 per worker) are in flight.
+    """
+    max_pending = max_pending or 4 * workers
+    ex = ThreadPoolExecutor(workers)
+    pending: Deque[Future] = deque()
+    try:
+        for item in items:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(ex.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        ex.shutdown(cancel_futures=True)
+
+
+def run_query(knov: Any, query: Union[str, SearchQuery],
+              snip: Optional[SearchSnipOptions]) -> QueryResults:
+    """
+    search_results of a SearchQuery (or just a query string), timed.
+    """
+    if isinstance(query, str):
+        query = SearchQuery(query)
+    start = time.perf_counter()
+    results = knov.search_results(
+        query.query, query.tags, query.limit, query.doc_type, snip,
+        dedup=query.dedup, any_tags=query.any_tags,
+        exclude_tags=query.exclude_tags)
+    return QueryResults(query, results, time.perf_counter() - start)
+
+
 class Knovleks:
+    """
+    Index of documents, safe to share between threads. All writes go
+    through the single writer connection `db_con` one at a time, queries
+    use a pool of up to `readers` read-only connections (0: the writer
+    connection), which are not blocked by a running write in WAL mode.
+    A `read_only` index is opened without a writer, e.g. on a read-only
+    mount, and has to be of the current schema version.
+    """
     def __init__(self,
                  supported_types,
-                 db: str = f"~/.config/{__name__}/index.db"):
+                 db: str = f"~/.config/{__name__}/index.db",
+                 cache_size: int = 0,
+                 readers: int = 4,
+                 read_only: bool = False):
+        self.readers: Optional[ReaderPool] = None
+        self.read_only = read_only
         if db == ":memory:":
-            self.db_con = sqlite3.connect(db)
+            self.db_path = db
+            self.db_con = sqlite3.connect(db, check_same_thread=False)
+        elif read_only:
+            self.db_path = str(Path(db).expanduser().resolve())
+            self.db_con = connect_read_only(self.db_path)
+            configure(self.db_con)
+            if readers > 0:
+                self.readers = ReaderPool(self.db_path, readers)
         else:
             p = Path(db).expanduser().resolve()
             p.parent.mkdir(parents=True, exist_ok=True)
-            self.db_con = sqlite3.connect(p)
+            self.db_path = str(p)
+            self.db_con = sqlite3.connect(p, check_same_thread=False)
+            configure(self.db_con, writer=True)
+            if readers > 0:
+                self.readers = ReaderPool(self.db_path, readers)
         # self.db_con.row_factory = sqlite3.Row
+        stats.trace(self.db_con)
         self.supported_types = supported_types
-        self.db_con.executescript(DB_SCHEME)
-        self.db_con.commit()
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        register_functions(self.db_con)
+        if read_only:
+            version = schema_version(self.db_con)
+            if version != SCHEMA_VERSION:
+                raise RuntimeError(f"read-only index {self.db_path} has "
+                                   f"schema version {version}, but this "
+                                   f"knovleks needs {SCHEMA_VERSION}")
+        else:
+            migrate(self.db_con)
+        # parts are written compressed, see set_part_compression()
+        self.compress_parts = parts_compressed(self.db_con)
+        # bumped by every write, invalidates cached results
+        self.generation = 0
+        self.cache: Optional[ResultCache] = None
+        if cache_size > 0:
+            self.cache = ResultCache(cache_size)
+        self.tag_index = TagIndex()
+
+    def reader(self, cache_size: int = 0) -> "Knovleks":
+        """
+        Open another connection to the same index, e.g. to run queries in
+        another thread that can be aborted with interrupt().
+        """
+        if self.db_path == ":memory:":
+            raise ValueError("an in-memory index cannot be shared")
+        return Knovleks(self.supported_types, self.db_path, cache_size,
+                        readers=0, read_only=self.read_only)
+
+    @contextmanager
+    def writing(self) -> Iterator[sqlite3.Connection]:
+        """
+        Run a write transaction on the writer connection, waiting for the
+        writes of other threads to finish first. Committed at the end,
+        rolled back on errors.
+        """
+        with self._write_lock:
+            try:
+                yield self.db_con
+            except BaseException:
+                self.db_con.rollback()
+                self.tag_index.rollback()
+                raise
+            tag_version = None
+            if self.tag_index.pending:
+                tag_version = doc_tag_version(self.db_con)
+            try:
+                with stats.span("commit"):
+                    self.db_con.commit()
+            except BaseException:
+                self.tag_index.rollback()
+                raise
+            if tag_version is not None:
+                self.tag_index.commit(tag_version)
+
+    @contextmanager
+    def reading(self) -> Iterator[sqlite3.Connection]:
+        """
+        A connection for queries, nested calls of a thread get the same one.
+        Queries on a pooled connection only see committed writes.
+        """
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            yield con
+            return
+        try:
+            if self.readers is None:
+                with self._write_lock:
+                    yield self.db_con
+            else:
+                with self.readers.connection() as con:
+                    self._local.con = con
+                    try:
+                        yield con
+                    finally:
+                        self._local.con = None
+        finally:
+            # the last statement ends with the read, not with the next one
+            stats.flush()
+
+    def interrupt(self):
+        """
+        Abort the queries running on the writer connection, which is the
+        one of a reader().
+        """
+        self.db_con.interrupt()
+
+    def close(self):
+        if self.readers is not None:
+            self.readers.close()
+        self.db_con.close()
+
+    def cache_stats(self) -> Optional[Dict[str, int]]:
+        """
+        Hits, misses, entries and size of the result cache, None without.
+        """
+        return None if self.cache is None else self.cache.stats()
+
+    def _cached(self, key: Tuple, compute) -> List:
+        with self.reading() as con:
+            if self.cache is None: return compute()
+            # data_version changes when another connection commits, but
+            # differs between connections
+            data_version = con.execute("PRAGMA data_version;").fetchone()
+            return self.cache.get(
+                key, (self.generation, id(con), data_version[0]), compute)
 
     def _insert_doc(self, doc: IdocumentType) -> int:
         cur = self.db_con.cursor()
-        cur.execute("INSERT INTO documents(type, href, title) VALUES(?,?,?);",
-                    (doc.doc_type, doc.href, doc.title))
+        src = doc.source or SourceInfo()
+        cur.execute(("INSERT INTO documents(type, href, title, mtime, size, "
+                     "content_hash) VALUES(?,?,?,?,?,?);"),
+                    (doc.doc_type, doc.href, doc.title, src.mtime, src.size,
+                     src.content_hash))
         id = cur.lastrowid
-        insert_q = ("INSERT INTO doc_parts(doc_id, elem_idx, doccontent) "
-                    "VALUES(?,?,?);")
-        for part in doc.parts:
-            cur.execute(insert_q, (id, part.elem_idx, part.doccontent))
+        for parts in chunked(doc.parts, PART_BATCH_SIZE):
+            self._insert_parts(id, [(p, p.content_hash) for p in parts])
         cur.close()
         return id
 
+    def _insert_parts(self, doc_id: int,
+                      parts: Sequence[Tuple[DocPart, str]]):
+        """
+        Add parts to a document. Contents are shared between documents, only
+        contents that are not stored yet are inserted and indexed.
+        """
+        if not parts: return
+        cur = self.db_con.cursor()
+
+        def part_ids(hashes: List[str]) -> Dict[str, int]:
+            qm = ",".join("?" * len(hashes))
+            cur.execute(("SELECT part_hash, id FROM doc_parts "
+                         f"WHERE part_hash IN ({qm});"), hashes)
+            return dict(cur.fetchall())
+
+        ids = part_ids(list({part_hash for _, part_hash in parts}))
+        new = {part_hash: part.doccontent for part, part_hash in parts
+               if part_hash not in ids}
+        if new:
+            compress = self.compress_parts
+            cur.executemany(
+                "INSERT INTO doc_parts(doccontent, part_hash) VALUES(?,?);",
+                ((compress_part(content) if compress else content, part_hash)
+                 for part_hash, content in new.items()))
+            ids.update(part_ids(list(new)))
+        cur.executemany(
+            ("INSERT INTO doc_part_refs(doc_id, elem_idx, part_id) "
+             "VALUES(?,?,?);"),
+            ((doc_id, part.elem_idx, ids[part_hash])
+             for part, part_hash in parts))
+        cur.close()
+
     def _update_doc(self, doc: IdocumentType, doc_id: int):
+        """
+        Update a document, only touching the parts whose content or position
+        changed. Parts are consumed in batches of PART_BATCH_SIZE, parts with
+        new content are inserted and stale ones deleted at the end, which
+        costs the FTS index the same as updating them in place.
+        """
         cur = self.db_con.cursor()
-        cur.execute("UPDATE documents SET type=?, href=?, title=? WHERE id=?;",
-                    (doc.doc_type, doc.href, doc.title, doc_id))
-        cur.execute("SELECT id FROM doc_parts WHERE doc_id = ?;", (doc_id,))
-        existing_part_ids = [el[0] for el in cur.fetchall()]
-        parts = list(doc.parts)
-        for part_id, part in zip(existing_part_ids, parts):
-            cur.execute(
-                "UPDATE doc_parts SET elem_idx=?, doccontent=? WHERE id=?;",
-                (part.elem_idx, part.doccontent, part_id))
-        for part in parts[len(existing_part_ids):]:
-            cur.execute(("INSERT INTO doc_parts(doc_id, elem_idx, doccontent) "
-                         "VALUES(?,?,?);"),
-                        (doc_id, part.elem_idx, part.doccontent))
-        for part_id in existing_part_ids[len(parts):]:
-            cur.execute("DELETE FROM doc_parts WHERE id=?;",
-                        (part_id,))
+        src = doc.source or SourceInfo()
+        cur.execute(("UPDATE documents SET type=?, href=?, title=?, mtime=?, "
+                     "size=?, content_hash=? WHERE id=?;"),
+                    (doc.doc_type, doc.href, doc.title, src.mtime, src.size,
+                     src.content_hash, doc_id))
+        cur.execute(("SELECT r.id, r.elem_idx, p.part_hash "
+                     "FROM doc_part_refs r "
+                     "JOIN doc_parts p ON p.id = r.part_id "
+                     "WHERE r.doc_id = ? ORDER BY r.id;"), (doc_id,))
+        # existing parts by content hash, reused for parts with equal content
+        by_hash: Dict[str, List[Tuple[int, int]]] = {}
+        for ref_id, elem_idx, part_hash in cur.fetchall():
+            by_hash.setdefault(part_hash, []).append((ref_id, elem_idx))
+        for parts in chunked(doc.parts, PART_BATCH_SIZE):
+            changed = []
+            moved = []
+            for part in parts:
+                part_hash = part.content_hash
+                same = by_hash.get(part_hash)
+                if not same:
+                    changed.append((part, part_hash))
+                    continue
+                match = next((e for e in same if e[1] == part.elem_idx),
+                             same[0])
+                same.remove(match)
+                if match[1] != part.elem_idx:
+                    moved.append((part.elem_idx, match[0]))
+            # updating elem_idx only does not touch the FTS index
+            cur.executemany("UPDATE doc_part_refs SET elem_idx=? WHERE id=?;",
+                            moved)
+            self._insert_parts(doc_id, changed)
+        # contents no other document refers to are deleted by a trigger
+        cur.executemany("DELETE FROM doc_part_refs WHERE id=?;",
+                        ((ref_id,) for refs in by_hash.values()
+                         for ref_id, _ in refs))
         cur.close()
 
+    def get_sources(self, hrefs: Iterable[str]
+                    ) -> Dict[str, Tuple[SourceInfo, str, Set[str]]]:
+        """
+        Return the stored source state, title and tags of indexed documents.
+        """
+        res: Dict[str, Tuple[SourceInfo, str, Set[str]]] = {}
+        with self.reading() as con:
+            cur = con.cursor()
+            for chunk in chunked(hrefs, MAX_QUERY_PARAMS):
+                qm = ','.join("?" * len(chunk))
+                cur.execute(("SELECT href, mtime, size, content_hash, title "
+                             f"FROM documents WHERE href IN ({qm});"), chunk)
+                for href, mtime, size, chash, title in cur.fetchall():
+                    res[href] = (SourceInfo(mtime, size, chash), title, set())
+                cur.execute(("SELECT d.href, t.tag FROM documents d "
+                             "JOIN doc_tag dt ON dt.doc_id = d.id "
+                             "JOIN tags t ON t.id = dt.tag_id "
+                             f"WHERE d.href IN ({qm});"), chunk)
+                for href, tag in cur.fetchall():
+                    res[href][2].add(tag)
+            cur.close()
+        return res
+
+    def update_sources(self, sources: Iterable[Tuple[str, SourceInfo]]):
+        """
+        Store the source state of documents whose content did not change,
+        but does not write/commit the DB.
+        """
+        self.generation += 1
+        self.db_con.executemany(
+            ("UPDATE documents SET mtime=?, size=?, content_hash=? "
+             "WHERE href=?;"),
+            ((s.mtime, s.size, s.content_hash, href) for href, s in sources))
+
     def _upsert_doc(self, doc: IdocumentType):
-        cur = self.db_con.cursor()
-        cur.execute("SELECT id FROM documents WHERE href=?;", (doc.href,))
-        el = cur.fetchone()
-        if el is None:
-            id = self._insert_doc(doc)
-        else:
-            id = el[0]
-            self._update_doc(doc, id)
-        tag_ids = self.add_tags(doc.tags)
-        self._update_doc_tag_link(id, tag_ids)
-        self.db_con.commit()
+        with self.writing():
+            self._upsert_docs([doc])
 
-    def _insert_tag(self, tag: str) -> int:
+    def _upsert_docs(self, docs: Sequence[IdocumentType],
+                     on_error: Optional[
+                         Callable[[IdocumentType, Exception], None]] = None
+                     ) -> int:
         """
-        Insert a tag to the tags database, but does not write/commit the DB.
+        Upsert a batch of documents, but does not write/commit the DB. With
+        `on_error`, each document is written in a savepoint: if it fails,
+        e.g. because its parts generator raises, only that document is
+        rolled back and reported. Returns the number of failed documents.
         """
+        self.generation += 1
+        # the last occurrence of an href within a batch wins
+        docs = list({doc.href: doc for doc in docs}.values())
         cur = self.db_con.cursor()
-        cur.execute("INSERT INTO tags(tag) VALUES (?)", (tag,))
-        id = cur.lastrowid
+        existing: Dict[str, int] = {}
+        for hrefs in chunked([d.href for d in docs], MAX_QUERY_PARAMS):
+            qm = ','.join("?" * len(hrefs))
+            cur.execute(
+                f"SELECT href, id FROM documents WHERE href IN ({qm});", hrefs)
+            existing.update(cur.fetchall())
+        if on_error is not None and not self.db_con.in_transaction:
+            # RELEASE of an outermost savepoint would commit
+            cur.execute("BEGIN;")
+        written: List[Tuple[int, IdocumentType]] = []
+        for doc in docs:
+            if on_error is not None:
+                cur.execute("SAVEPOINT upsert_doc;")
+            try:
+                if doc.href in existing:
+                    id = existing[doc.href]
+                    with stats.span("update"):
+                        self._update_doc(doc, id)
+                else:
+                    with stats.span("insert"):
+                        id = self._insert_doc(doc)
+            except Exception as e:
+                if on_error is None: raise
+                cur.execute("ROLLBACK TO upsert_doc;")
+                cur.execute("RELEASE upsert_doc;")
+                # not the document's fault, e.g. a full disk
+                if isinstance(e, sqlite3.OperationalError): raise
+                on_error(doc, e)
+                continue
+            if on_error is not None:
+                cur.execute("RELEASE upsert_doc;")
+            written.append((id, doc))
         cur.close()
-        return id
+        with stats.span("tags"):
+            tag_map = self._resolve_tags(
+                set().union(*(doc.tags for _, doc in written)))
+            self._update_doc_tag_links(
+                [(id, {tag_map[t] for t in doc.tags}) for id, doc in written])
+        return len(docs) - len(written)
+
+    def index_documents(self, docs: Iterable[IdocumentType],
+                        batch_size: int = MAX_QUERY_PARAMS,
+                        on_error: Optional[
+                            Callable[[IdocumentType, Exception], None]] = None
+                        ) -> int:
+        """
+        Upsert all documents of an iterable and commit every `batch_size`
+        documents. If writing a document fails, e.g. while its parts are
+        generated, it is skipped and reported to `on_error`, without
+        `on_error` the exception is raised and the batch rolled back.
+        Returns the number of processed documents.
+        """
+        n = 0
+        for batch in chunked(docs, batch_size):
+            with self.writing():
+                failed = self._upsert_docs(batch, on_error)
+            n += len(batch) - failed
+        if n >= AUTO_MERGE_DOCS:
+            # many batches leave many small FTS segments behind, merge them
+            # with an amount of work in proportion to the ingest
+            self.merge(steps=n // AUTO_MERGE_DOCS)
+        return n
+
+    def merge(self, pages: int = MERGE_PAGES,
+              steps: Optional[int] = None) -> int:
+        """
+        Incrementally merge the segments of the FTS index, about `pages`
+        pages per transaction, until it is a single segment or after
+        `steps` transactions. Other writers only wait for one step at a
+        time. Returns the number of steps.
+        """
+        n = 0
+        with stats.span("merge"):
+            while steps is None or n < steps:
+                with self.writing() as con:
+                    before = con.total_changes
+                    # negative: merge segments regardless of usermerge
+                    con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts, "
+                                 "rank) VALUES('merge', ?);"), (-pages,))
+                    # less than two changes: there was no work left
+                    done = con.total_changes - before < 2
+                n += 1
+                if done: break
+        return n
+
+    def optimize(self, vacuum: bool = False):
+        """
+        Merge the FTS index into a single segment and update the statistics
+        of the query planner. With `vacuum`, the database file is rebuilt
+        without unused pages, which needs up to twice its size on disk.
+        """
+        with stats.span("optimize"):
+            with self.writing() as con:
+                con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts) "
+                             "VALUES('optimize');"))
+                con.execute("ANALYZE;")
+            with self.writing() as con:
+                con.execute("PRAGMA optimize;")
+                if vacuum:
+                    con.commit()  # cannot vacuum within a transaction
+                    con.execute("VACUUM;")
+                if self.db_path != ":memory:":
+                    con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+    def set_part_compression(self, compress: bool):
+        """
+        Store the text of parts zlib compressed or uncompressed. Converts
+        all stored parts and rebuilds the FTS index, which takes about as
+        long as indexing everything again. The space of a smaller database
+        is only given back to the file system by optimize(vacuum=True).
+        """
+        with stats.span("set_part_compression"):
+            with self.writing() as con:
+                con.commit()
+                con.execute("BEGIN IMMEDIATE;")
+                set_part_compression(con, compress)
+                self.compress_parts = compress
+                self.generation += 1
+
+    def export_index(self, out: IO[str]) -> int:
+        """
+        Write a dump of the index as JSON lines (see transfer.py), in a
+        single read transaction and with constant memory. Returns the number
+        of records.
+        """
+        with stats.span("export"):
+            with self.reading() as con:
+                con.execute("BEGIN;")
+                try:
+                    return write_records(export_records(con), out)
+                finally:
+                    con.rollback()
+
+    def import_index(self, records: Iterable[Dict[str, Any]]
+                     ) -> Dict[str, int]:
+        """
+        Load the records of a dump into this index, which has to be empty.
+        The FTS index is built once at the end. Returns the number of
+        imported tags, parts and documents.
+        """
+        with stats.span("import"):
+            with self.writing() as con:
+                con.commit()
+                con.execute("BEGIN IMMEDIATE;")
+                counts = import_records(con, records)
+                self.compress_parts = parts_compressed(con)
+                self.generation += 1
+        return counts
+
+    def fts_settings(self) -> Dict[str, int]:
+        """
+        The automerge and crisismerge settings of the FTS index.
+        """
+        with self.reading() as con:
+            stored = dict(con.execute(
+                "SELECT k, v FROM doc_parts_fts_config;").fetchall())
+        return {k: stored.get(k, default)
+                for k, default in FTS_SETTINGS.items()}
+
+    def set_fts_settings(self, automerge: Optional[int] = None,
+                         crisismerge: Optional[int] = None):
+        """
+        FTS5 merges `automerge` segments of a level automatically once there
+        are as many, and merges within the writing transaction once there
+        are `crisismerge`. They are stored in the index.
+        """
+        with self.writing() as con:
+            for name, value in (("automerge", automerge),
+                                ("crisismerge", crisismerge)):
+                if value is None: continue
+                con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts, rank) "
+                             "VALUES(?, ?);"), (name, value))
+
+    def storage_stats(self) -> Dict[str, int]:
+        """
+        Size and unused bytes of the database and the number of pages of the
+        FTS index.
+        """
+        with self.reading() as con:
+            page_size, = con.execute("PRAGMA page_size;").fetchone()
+            pages, = con.execute("PRAGMA page_count;").fetchone()
+            free, = con.execute("PRAGMA freelist_count;").fetchone()
+            fts_pages, = con.execute(
+                "SELECT count(*) FROM doc_parts_fts_data;").fetchone()
+        return {"size": pages * page_size, "free": free * page_size,
+                "fts_pages": fts_pages}
+
+    def _doc_ids_below(self, directory: str) -> List[int]:
+        # range instead of LIKE, so that an index on href can be used
+        prefix = directory.rstrip("/") + "/"
+        cur = self.db_con.execute(("SELECT id FROM documents "
+                                   "WHERE href >= ? AND href < ?;"),
+                                  (prefix, prefix[:-1] + "0"))
+        return [el[0] for el in cur.fetchall()]
+
+    def get_hrefs(self, directory: str) -> List[str]:
+        """
+        Return the hrefs of all documents below a directory.
+        """
+        prefix = directory.rstrip("/") + "/"
+        with self.reading() as con:
+            cur = con.execute(("SELECT href FROM documents "
+                               "WHERE href >= ? AND href < ?;"),
+                              (prefix, prefix[:-1] + "0"))
+            return [el[0] for el in cur.fetchall()]
+
+    def delete_documents(self, hrefs: Iterable[str],
+                         recursive: bool = False) -> int:
+        """
+        Delete documents by href. If `recursive`, documents below an href
+        (i.e. files in a directory) are deleted as well. Returns the number
+        of deleted documents.
+        """
+        with self.writing() as con:
+            self.generation += 1
+            cur = con.cursor()
+            doc_ids: Set[int] = set()
+            for href in hrefs:
+                cur.execute("SELECT id FROM documents WHERE href = ?;",
+                            (href,))
+                doc_ids.update(el[0] for el in cur.fetchall())
+                if recursive:
+                    doc_ids.update(self._doc_ids_below(href))
+            for chunk in chunked(doc_ids, MAX_QUERY_PARAMS):
+                qm = ','.join("?" * len(chunk))
+                cur.execute(
+                    f"DELETE FROM doc_part_refs WHERE doc_id IN ({qm});",
+                    chunk)
+                cur.execute(f"DELETE FROM doc_tag WHERE doc_id IN ({qm});",
+                            chunk)
+                self.tag_index.deleted(chunk, cur.rowcount)
+                cur.execute(f"DELETE FROM documents WHERE id IN ({qm});",
+                            chunk)
+            cur.close()
+        return len(doc_ids)
 
     def _update_doc_tag_link(self, doc_id: int, tag_ids: Set[int]):
+        self._update_doc_tag_links([(doc_id, tag_ids)])
+
+    def _update_doc_tag_links(self, links: Sequence[Tuple[int, Set[int]]]):
+        """
+        Batched version of _update_doc_tag_link, does not write/commit the DB.
+        """
+        self.generation += 1
         cur = self.db_con.cursor()
-        cur.execute("SELECT tag_id FROM doc_tag WHERE doc_id=?;", (doc_id,))
-        existing_tag_ids = frozenset([el[0] for el in cur.fetchall()])
-        tag_ids_to_remove = existing_tag_ids - tag_ids
-        new_tag_ids = tag_ids - existing_tag_ids
-        for tag_id in tag_ids_to_remove:
-            cur.execute("DELETE FROM doc_tag WHERE doc_id=? AND tag_id=?;",
-                        (doc_id, tag_id))
-        for tag_id in new_tag_ids:
-            cur.execute("INSERT INTO doc_tag(doc_id, tag_id) VALUES (?,?);",
-                        (doc_id, tag_id))
-        self.db_con.commit()
+        existing: Dict[int, Set[int]] = {doc_id: set() for doc_id, _ in links}
+        for doc_ids in chunked(list(existing), MAX_QUERY_PARAMS):
+            qm = ','.join("?" * len(doc_ids))
+            cur.execute(("SELECT doc_id, tag_id FROM doc_tag "
+                         f"WHERE doc_id IN ({qm});"), doc_ids)
+            for doc_id, tag_id in cur.fetchall():
+                existing[doc_id].add(tag_id)
+        to_remove = []
+        to_add = []
+        for doc_id, tag_ids in links:
+            to_remove.extend((doc_id, t) for t in existing[doc_id] - tag_ids)
+            to_add.extend((doc_id, t) for t in tag_ids - existing[doc_id])
+        cur.executemany("DELETE FROM doc_tag WHERE doc_id=? AND tag_id=?;",
+                        to_remove)
+        self.tag_index.unlinked(to_remove, cur.rowcount)
+        cur.executemany("INSERT INTO doc_tag(doc_id, tag_id) VALUES (?,?);",
+                        to_add)
+        self.tag_index.linked(to_add, cur.rowcount)
         cur.close()
 
-    def add_tags(self, tags: Set[str]) -> Set[int]:
-        if len(tags) <= 0: return set([])
+    def _resolve_tags(self, tags: Set[str]) -> Dict[str, int]:
+        """
+        Map tags to their ids, inserting missing ones, but does not
+        write/commit the DB.
+        """
         cur = self.db_con.cursor()
-        qm = ','.join("?" * len(tags))
-        q = f"SELECT id, tag FROM tags WHERE tag in ({qm});"
-        cur.execute(q, tuple(tags))
-        res = cur.fetchall()
-        exi_ids, existing_tags = zip(*res) if len(res) > 0 else (set(), set())
-        mis_tags = tags - frozenset(existing_tags)
-        ids_set = set(exi_ids)
-        for t in mis_tags:
-            id = self._insert_tag(t)
-            ids_set.add(id)
-        self.db_con.commit()
+        tag_map: Dict[str, int] = {}
+
+        def select_ids(tags: Iterable[str]):
+            for chunk in chunked(tags, MAX_QUERY_PARAMS):
+                qm = ','.join("?" * len(chunk))
+                q = f"SELECT tag, id FROM tags WHERE tag IN ({qm});"
+                tag_map.update(cur.execute(q, chunk).fetchall())
+
+        select_ids(tags)
+        missing = [t for t in tags if t not in tag_map]
+        if missing:
+            self.generation += 1
+            cur.executemany("INSERT INTO tags(tag) VALUES (?)",
+                            ((t,) for t in missing))
+            select_ids(missing)
         cur.close()
-        return ids_set
+        self.tag_index.resolved(tag_map)
+        return tag_map
+
+    def add_tags(self, tags: Set[str]) -> Set[int]:
+        with self.writing():
+            return self._add_tags(tags)
+
+    def _add_tags(self, tags: Set[str]) -> Set[int]:
+        return set(self._resolve_tags(tags).values())
 
     def get_tags_by_href(self, href: str) -> Generator:
-        cur = self.db_con.cursor()
         q = ("SELECT tag FROM tags t, doc_tag dt, documents d "
              "WHERE t.id = dt.tag_id AND dt.doc_id = d.id AND d.href = ?;")
-        cur.execute(q, (href,))
-        yield from map(lambda x: x[0], cur.fetchall())
+        with self.reading() as con:
+            rows = con.execute(q, (href,)).fetchall()
+        yield from map(lambda x: x[0], rows)
+
+    def _tags_by_doc_ids(self, doc_ids: Iterable[int]
+                         ) -> Dict[int, List[str]]:
+        doc_tags: Dict[int, List[str]] = {}
+        with self.reading() as con:
+            for chunk in chunked(doc_ids, MAX_QUERY_PARAMS):
+                qm = ','.join("?" * len(chunk))
+                cur = con.execute(
+                    ("SELECT dt.doc_id, t.tag FROM doc_tag dt "
+                     "JOIN tags t ON t.id = dt.tag_id "
+                     f"WHERE dt.doc_id IN ({qm}) ORDER BY t.tag;"), chunk)
+                for doc_id, tag in cur.fetchall():
+                    doc_tags.setdefault(doc_id, []).append(tag)
+        return doc_tags
 
     def index_document(self, doc_type: str, href: str, title: str,
                        tags: Set[str]):
-        doc = self.supported_types[doc_type](href, title, tags=tags)
+        doc = self.create_document(doc_type, href, title, tags)
         self._upsert_doc(doc)
 
-    def _join_tag_query(self, tags: Set[str]):
-        if not tags: return ""
-        qm = ','.join("?" * len(tags))
-        q = (f"JOIN tags t ON t.tag in ({qm}) "
-             "JOIN doc_tag dt ON t.id = dt.tag_id AND dt.doc_id = d.id ")
-        return q
+    def create_document(self, doc_type: str, href: str, title: str,
+                        tags: Set[str]) -> IdocumentType:
+        return self.supported_types[doc_type](href, title, tags=set(tags))
+
+    def _tag_condition(self, docs: DocSet, column: str,
+                       parameters: List[Any]) -> Optional[str]:
+        """
+        SQL condition restricting `column` to the documents of a tag filter,
+        as evaluated by the tag index. None if there are no such documents.
+        """
+        if docs == ALL_DOCS: return ""
+        if docs == NO_DOCS: return None
+        parameters.append(f"[{','.join(map(str, docs.ids()))}]")
+        op = "NOT IN" if docs.negated else "IN"
+        return f" AND {column} {op} (SELECT value FROM json_each(?))"
 
     def _content_column_snippet(self,
                                 parameters: List[str],
@@ -204,58 +806,316 @@ class Knovleks:
     def search(self, search_query: str, tags: Set[str] = set(),
                limit: Optional[int] = None,
                doc_type: Optional[str] = None,
-               snip: Optional[SearchSnipOptions] = None) -> Generator:
-        parameters: List[str] = []
-        filter_doc_type = group_by_inner = ""
-        content_col = self._content_column_snippet(parameters, snip)
-        parameters.extend(tags)
+               snip: Optional[SearchSnipOptions] = None,
+               cursor: Optional[str] = None,
+               dedup: bool = False, any_tags: Set[str] = set(),
+               exclude_tags: Set[str] = set()) -> Generator:
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        for row in self._search(search_query, tag_filter, limit, doc_type,
+                                snip, cursor, dedup):
+            yield row[:5]
+
+    def search_results(self, search_query: str, tags: Set[str] = set(),
+                       limit: Optional[int] = None,
+                       doc_type: Optional[str] = None,
+                       snip: Optional[SearchSnipOptions] = None,
+                       cursor: Optional[str] = None,
+                       dedup: bool = False, any_tags: Set[str] = set(),
+                       exclude_tags: Set[str] = set()
+                       ) -> List[SearchResult]:
+        """
+        Like search, but returns SearchResult objects including the tags of
+        each document, which are fetched with one query for all results.
+        """
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        rows = list(self._search(search_query, tag_filter, limit, doc_type,
+                                 snip, cursor, dedup))
+        return self._search_results(rows)
+
+    def search_page(self, search_query: str, tags: Set[str] = set(),
+                    page_size: int = 40,
+                    doc_type: Optional[str] = None,
+                    snip: Optional[SearchSnipOptions] = None,
+                    cursor: Optional[str] = None,
+                    dedup: bool = False, any_tags: Set[str] = set(),
+                    exclude_tags: Set[str] = set()) -> SearchPage:
+        """
+        One page of search_results, starting after the part the cursor of
+        the previous page points to.
+        """
+        check_page_size(page_size)
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        rows = list(self._search(search_query, tag_filter, page_size + 1,
+                                 doc_type, snip, cursor, dedup))
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(*rows[-1][6:9])
+        return SearchPage(self._search_results(rows), next_cursor)
+
+    def search_many(self, queries: Iterable[Union[str, SearchQuery]],
+                    snip: Optional[SearchSnipOptions] = None,
+                    workers: int = 1,
+                    max_pending: Optional[int] = None
+                    ) -> Iterator[QueryResults]:
+        """
+        Run many queries and yield their results in query order, while the
+        query iterable is only consumed as results are taken out. With one
+        worker all queries run on the same read connection, which keeps
+        their prepared statements. Otherwise up to `workers` threads query
+        in parallel on pooled connections, with at most `max_pending`
+        (default: 4 per worker) queries in flight.
+        """
+        def run(query: Union[str, SearchQuery]) -> QueryResults:
+            return run_query(self, query, snip)
+
+        if workers <= 1 or self.readers is None:
+            # without a pool, the writer connection must not stay locked
+            # while the caller processes results
+            hold = nullcontext() if self.readers is None else self.reading()
+            with hold:
+                yield from map(run, queries)
+            return
+        yield from ordered_map(run, queries, workers, max_pending)
+
+    def _search_results(self, rows: List[Tuple]) -> List[SearchResult]:
+        with stats.span("search.tags"):
+            doc_tags = self._tags_by_doc_ids({row[5] for row in rows})
+        return [SearchResult(href, int(elem_idx), title, snippet, type,
+                             doc_tags.get(doc_id, []))
+                for href, elem_idx, title, snippet, type, doc_id, *_ in rows]
+
+    def _search(self, search_query: str, tag_filter: TagFilter,
+                limit: Optional[int], doc_type: Optional[str],
+                snip: Optional[SearchSnipOptions],
+                cursor: Optional[str] = None,
+                dedup: bool = False) -> List[Tuple]:
+        """
+        Rows of href, elem_idx, title, snippet, type, doc id, rank, part id
+        and part reference id, ordered by rank and the ids. A part whose
+        content is shared by several documents is returned once per document,
+        or only for the first of them with `dedup`.
+        """
+        after = None if cursor is None else decode_cursor(cursor, 3)
+        key = ("search", search_query, tag_filter, limit, doc_type,
+               None if snip is None else astuple(snip), after, dedup)
+        with stats.span("search"):
+            return self._cached(key, lambda: self._search_rows(
+                search_query, tag_filter, limit, doc_type, snip, after,
+                dedup))
+
+    def _search_rows(self, search_query: str, tag_filter: TagFilter,
+                     limit: Optional[int], doc_type: Optional[str],
+                     snip: Optional[SearchSnipOptions],
+                     after: Optional[Tuple], dedup: bool) -> List[Tuple]:
+        with stats.span("search.rank"):
+            try:
+                # use fts syntax
+                ranked = self._rank_parts(search_query, tag_filter, limit,
+                                          doc_type, after, dedup)
+            except sqlite3.OperationalError as e:
+                # cancelled by db_con.interrupt(), not a syntax error
+                if str(e) == "interrupted": raise
+                search_query = self._quote_string(search_query)
+                ranked = self._rank_parts(search_query, tag_filter, limit,
+                                          doc_type, after, dedup)
+        with stats.span("search.fetch"):
+            return list(self._fetch_parts(search_query, ranked, snip))
+
+    def _rank_parts(self, search_query: str, tag_filter: TagFilter,
+                    limit: Optional[int], doc_type: Optional[str],
+                    after: Optional[Tuple] = None, dedup: bool = False
+                    ) -> List[Tuple[int, float, int]]:
+        """
+        First search phase: the reference ids, ranks and part ids of the best
+        matching parts, with document type and tag filters applied before the
+        limit. `after` is the (rank, part id, reference id) of the last part
+        of the previous page.
+        """
+        parameters: List[Any] = [search_query]
+        filters = ""
+        if after is not None and dedup:
+            parameters.extend(after[:2])
+            filters += " AND (dpf.rank, dpf.rowid) > (?, ?)"
+        elif after is not None:
+            parameters.extend(after)
+            filters += " AND (dpf.rank, dpf.rowid, r.id) > (?, ?, ?)"
         if doc_type is not None:
             parameters.append(doc_type)
-            filter_doc_type = "WHERE d.type = ?"
-        if len(tags) > 0:
-            group_by_inner = f"GROUP BY d.id HAVING COUNT(d.id) = {len(tags)}"
-        query = (f"SELECT DISTINCT href, elem_idx, title, {content_col}, "
-                 "type FROM "
-                 f"(SELECT * FROM documents d {self._join_tag_query(tags)}"
-                 f" {filter_doc_type} {group_by_inner}) d, "
-                 "doc_parts dp, doc_parts_fts dpf "
-                 "WHERE dpf.rowid = dp.id AND dp.doc_id = d.id AND "
-                 "dpf.doccontent MATCH ? ORDER BY rank")
-        parameters.append(search_query)
-        search_query_idx = len(parameters) - 1
-        if limit is not None:
-            parameters.append(f"{limit}")
-            query += " LIMIT ?"
-        try:
-            # use fts syntax
-            yield from self.db_con.execute(query, parameters)
-        except sqlite3.OperationalError:
-            parameters[search_query_idx] = self._quote_string(search_query)
-            print(parameters[search_query_idx])
-            yield from self.db_con.execute(query, parameters)
+            filters += " AND d.type = ?"
+        with self.reading() as con:
+            tag_condition = self._tag_condition(
+                self.tag_index.select(con, tag_filter), "r.doc_id",
+                parameters)
+            if tag_condition is None: return []
+            ref_id = "MIN(r.id)" if dedup else "r.id"
+            group = " GROUP BY dpf.rowid" if dedup else ""
+            query = (f"SELECT {ref_id} AS ref_id, dpf.rank, dpf.rowid "
+                     "FROM doc_parts_fts dpf "
+                     "JOIN doc_part_refs r ON r.part_id = dpf.rowid "
+                     "JOIN documents d ON d.id = r.doc_id "
+                     f"WHERE doc_parts_fts MATCH ?{filters}{tag_condition}"
+                     f"{group} ORDER BY dpf.rank, dpf.rowid, ref_id")
+            if limit is not None:
+                parameters.append(limit)
+                query += " LIMIT ?"
+            return con.execute(query, parameters).fetchall()
+
+    def _fetch_parts(self, search_query: str,
+                     ranked: List[Tuple[int, float, int]],
+                     snip: Optional[SearchSnipOptions]) -> Iterator[Tuple]:
+        """
+        Second search phase: documents and snippets of the ranked parts only,
+        in rank order.
+        """
+        for ranked_chunk in chunked(ranked, MAX_QUERY_PARAMS):
+            chunk = [ref_id for ref_id, _, _ in ranked_chunk]
+            parameters: List[Any] = []
+            content_col = self._content_column_snippet(parameters, snip)
+            parameters.append(search_query)
+            parameters.extend(chunk)
+            query = (f"SELECT r.id, href, r.elem_idx, title, {content_col},"
+                     " type, d.id FROM doc_parts_fts dpf "
+                     "JOIN doc_part_refs r ON r.part_id = dpf.rowid "
+                     "JOIN documents d ON d.id = r.doc_id "
+                     "WHERE doc_parts_fts MATCH ? AND r.id IN "
+                     f"({','.join('?' * len(chunk))})")
+            with self.reading() as con:
+                rows = {row[0]: row[1:]
+                        for row in con.execute(query, parameters)}
+            yield from (rows[ref_id] + (rank, part_id, ref_id)
+                        for ref_id, rank, part_id in ranked_chunk
+                        if ref_id in rows)
 
     def open_document(self, doc_type, href, elem_idx):
         self.supported_types[doc_type].open_doc(href, elem_idx)
 
+    def elem_label(self, doc_type: str, elem_idx: int) -> str:
+        # e.g. a shard with a document type this installation lacks
+        doc_cls = self.supported_types.get(doc_type, IdocumentType)
+        return doc_cls.elem_label(elem_idx)
+
     def filter_by_tags(self, tags: Set[str], limit: Optional[int] = None,
-                       doc_type: Optional[str] = None) -> Generator:
-        parameters: List[Any] = []
-        parameters.extend(tags)
-        filter_doc_type = ""
-        if doc_type is not None:
-            parameters.append(doc_type)
-            filter_doc_type = "WHERE d.type = ?"
-        parameters.append(len(tags))
-        query = ("SELECT href, title, type "
-                 f"FROM  documents d {self._join_tag_query(tags)}"
-                 f"{filter_doc_type} "
-                 "GROUP BY d.id HAVING COUNT(d.id) = ?")
-        if limit is not None:
-            parameters.append(f"{limit}")
-            query += " LIMIT ?"
-        yield from self.db_con.execute(query, parameters)
+                       doc_type: Optional[str] = None,
+                       cursor: Optional[str] = None,
+                       any_tags: Set[str] = set(),
+                       exclude_tags: Set[str] = set()) -> Generator:
+        """
+        Documents with all of `tags`, at least one of `any_tags` (unless
+        empty) and none of `exclude_tags`. Without any tags, none.
+        """
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        for row in self._filter_by_tags(tag_filter, limit, doc_type, cursor):
+            yield row[:3]
+
+    def tag_filter_results(self, tags: Set[str], limit: Optional[int] = None,
+                           doc_type: Optional[str] = None,
+                           cursor: Optional[str] = None,
+                           any_tags: Set[str] = set(),
+                           exclude_tags: Set[str] = set()
+                           ) -> List[SearchResult]:
+        """
+        Like filter_by_tags, but returns SearchResult objects including the
+        tags of each document, which are fetched with one query for all
+        results.
+        """
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        rows = self._filter_by_tags(tag_filter, limit, doc_type, cursor)
+        return self._tag_filter_results(rows)
+
+    def tag_filter_page(self, tags: Set[str], page_size: int = 40,
+                        doc_type: Optional[str] = None,
+                        cursor: Optional[str] = None,
+                        any_tags: Set[str] = set(),
+                        exclude_tags: Set[str] = set()) -> SearchPage:
+        """
+        One page of tag_filter_results, starting after the document the
+        cursor of the previous page points to.
+        """
+        check_page_size(page_size)
+        tag_filter = TagFilter(frozenset(tags), frozenset(any_tags),
+                               frozenset(exclude_tags))
+        rows = self._filter_by_tags(tag_filter, page_size + 1, doc_type,
+                                    cursor)
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(rows[-1][3])
+        return SearchPage(self._tag_filter_results(rows), next_cursor)
+
+    def _tag_filter_results(self, rows: List[Tuple]) -> List[SearchResult]:
+        with stats.span("tag_filter.tags"):
+            doc_tags = self._tags_by_doc_ids({row[3] for row in rows})
+        return [SearchResult(href, 0, title, "", type,
+                             doc_tags.get(doc_id, []))
+                for href, title, type, doc_id in rows]
+
+    def _filter_by_tags(self, tag_filter: TagFilter, limit: Optional[int],
+                        doc_type: Optional[str],
+                        cursor: Optional[str] = None) -> List[Tuple]:
+        """
+        Rows of href, title, type and doc id, ordered by doc id.
+        """
+        if not tag_filter: return []
+        after = None if cursor is None else decode_cursor(cursor, 1)[0]
+        key = ("filter_by_tags", tag_filter, limit, doc_type, after)
+        with stats.span("tag_filter"):
+            return self._cached(key, lambda: self._filter_rows(
+                tag_filter, limit, doc_type, after))
+
+    def _filter_rows(self, tag_filter: TagFilter, limit: Optional[int],
+                     doc_type: Optional[str],
+                     after: Optional[int]) -> List[Tuple]:
+        with self.reading() as con:
+            docs = self.tag_index.select(con, tag_filter)
+            if not docs.negated:
+                return self._documents_by_ids(
+                    con, docs.ids(-1 if after is None else after), limit,
+                    doc_type)
+            parameters: List[Any] = []
+            filters = self._tag_condition(docs, "id", parameters)
+            if doc_type is not None:
+                parameters.append(doc_type)
+                filters += " AND type = ?"
+            if after is not None:
+                parameters.append(after)
+                filters += " AND id > ?"
+            query = ("SELECT href, title, type, id FROM documents "
+                     f"WHERE 1{filters} ORDER BY id")
+            if limit is not None:
+                parameters.append(limit)
+                query += " LIMIT ?"
+            return con.execute(query, parameters).fetchall()
+
+    def _documents_by_ids(self, con: sqlite3.Connection,
+                          doc_ids: Iterator[int], limit: Optional[int],
+                          doc_type: Optional[str]) -> List[Tuple]:
+        """
+        Rows of href, title, type and doc id of the first `limit` documents
+        of ascending ids, only as many ids are looked up as needed.
+        """
+        type_filter = "" if doc_type is None else " AND type = ?"
+        size = MAX_QUERY_PARAMS if limit is None \
+            else min(limit, MAX_QUERY_PARAMS)
+        rows: List[Tuple] = []
+        for chunk in chunked(doc_ids, size):
+            parameters: List[Any] = list(chunk)
+            if doc_type is not None:
+                parameters.append(doc_type)
+            rows.extend(con.execute(
+                ("SELECT href, title, type, id FROM documents "
+                 f"WHERE id IN ({','.join('?' * len(chunk))}){type_filter} "
+                 "ORDER BY id;"), parameters))
+            if limit is not None and len(rows) >= limit: break
+        return rows[:limit]
 
     def href_exists(self, href: str) -> bool:
-        cur = self.db_con.cursor()
-        cur.execute("SELECT href FROM documents WHERE href=?;", (href, ))
-        return cur.fetchone() is not None
+        with self.reading() as con:
+            cur = con.execute("SELECT href FROM documents WHERE href=?;",
+                              (href, ))
+            return cur.fetchone() is not None
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import importlib
+
+from typing import Any, Dict, Iterator, Mapping, Type, Union
+
+from .idocument_type import IdocumentType
+
+
+# entry point group of document types provided by other packages
+ENTRY_POINT_GROUP = "knovleks.document_types"
+BUILTIN_TYPES = {
+    "note": "knovleks.document_types.note_document:NoteDocument",
+    "pdf": "knovleks.document_types.pdf_document:PdfDocument",
+    "website": "knovleks.document_types.website_document:WebsiteDocument",
+}
+
+
+def _load(spec: Any) -> Type[IdocumentType]:
+    if not isinstance(spec, str):
+        return spec.load()  # an importlib.metadata.EntryPoint
+    module, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+class DocumentTypeRegistry(Mapping[str, Type[IdocumentType]]):
+    """
+    Document types by name, given as "module:Class". A type's module (and
+    its dependencies, e.g. PyMuPDF for pdf) is only imported when the type
+    is looked up for the first time. Other packages can add types with an
+    entry point in the group ENTRY_POINT_GROUP, e.g. in setup.cfg:
+
+        [options.entry_points]
+        knovleks.document_types =
+            epub = knovleks_epub:EpubDocument
+
+    Built-in types take precedence over entry points of the same name.
+    """
+    def __init__(self, types: Mapping[str, str] = BUILTIN_TYPES,
+                 plugins: bool = True):
+        # "module:Class" or importlib.metadata.EntryPoint
+        self._specs: Dict[str, Any] = dict(types)
+        self._loaded: Dict[str, Type[IdocumentType]] = {}
+        # entry points are only looked for when a name is not known
+        self._discover = plugins
+
+    def register(self, name: str,
+                 doc_type: Union[str, Type[IdocumentType]]):
+        self._loaded.pop(name, None)
+        if isinstance(doc_type, str):
+            self._specs[name] = doc_type
+        else:
+            self._specs[name] = f"{doc_type.__module__}:{doc_type.__name__}"
+            self._loaded[name] = doc_type
+
+    def _discover_plugins(self):
+        if not self._discover: return
+        self._discover = False
+        # slow to import, only needed for unknown names
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        # entry_points() returns a dict before Python 3.10
+        group = eps.select(group=ENTRY_POINT_GROUP) \
+            if hasattr(eps, "select") else eps.get(ENTRY_POINT_GROUP, [])
+        for ep in group:
+            self._specs.setdefault(ep.name, ep)
+
+    def __getitem__(self, name: str) -> Type[IdocumentType]:
+        doc_type = self._loaded.get(name)
+        if doc_type is not None: return doc_type
+        if name not in self: raise KeyError(name)
+        doc_type = self._loaded[name] = _load(self._specs[name])
+        return doc_type
+
+    def __contains__(self, name: object) -> bool:
+        if name not in self._specs:
+            self._discover_plugins()
+        return name in self._specs
+
+    def __iter__(self) -> Iterator[str]:
+        self._discover_plugins()
+        return iter(self._specs)
+
+    def __len__(self) -> int:
+        self._discover_plugins()
+        return len(self._specs)
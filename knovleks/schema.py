@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import zlib
+
+from typing import Callable, Iterator, List, Optional, Union
+
+
+# Schema of the first release, migrations bring it to SCHEMA_VERSION.
+DB_SCHEME = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    type TEXT,
+    href TEXT,
+    title TEXT
+);
+
+
+CREATE TABLE IF NOT EXISTS doc_parts (
+    id INTEGER PRIMARY KEY,
+    doc_id INTEGER,
+    elem_idx INTEGER,
+    doccontent TEXT,
+    FOREIGN KEY(doc_id) REFERENCES documents(id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS doc_parts_fts USING fts5(
+    doccontent,
+    content=doc_parts,
+    content_rowid=id,
+    tokenize = 'porter unicode61'
+);
+-- Triggers to keep the FTS index up to date.
+CREATE TRIGGER IF NOT EXISTS doc_parts_ai AFTER INSERT ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, new.doccontent);
+END;
+CREATE TRIGGER IF NOT EXISTS doc_parts_ad AFTER DELETE ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
+         VALUES('delete', old.id, old.doccontent);
+END;
+CREATE TRIGGER IF NOT EXISTS doc_parts_au AFTER UPDATE ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
+         VALUES('delete', old.id, old.doccontent);
+  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, new.doccontent);
+END;
+
+
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    tag TEXT
+);
+
+
+CREATE TABLE IF NOT EXISTS doc_tag (
+    id INTEGER PRIMARY KEY,
+    doc_id INTEGER,
+    tag_id INTEGER,
+    FOREIGN KEY(doc_id) REFERENCES documents(id),
+    FOREIGN KEY(tag_id) REFERENCES tags(id)
+);
+"""
+
+
+def sql_statements(script: str) -> Iterator[str]:
+    """
+    Split an SQL script into statements (triggers contain semicolons).
+    """
+    stmt = ""
+    for line in script.splitlines(True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            yield stmt.strip()
+            stmt = ""
+
+
+def _add_columns(con: sqlite3.Connection, table: str, columns: List[str]):
+    # databases of unreleased versions may already have the columns
+    cur = con.execute(f"PRAGMA table_info({table});")
+    existing = {el[1] for el in cur.fetchall()}
+    for column in columns:
+        if column.split()[0] not in existing:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {column};")
+
+
+def _v1_base_schema(con: sqlite3.Connection):
+    for stmt in sql_statements(DB_SCHEME):
+        con.execute(stmt)
+
+
+def _v2_source_state(con: sqlite3.Connection):
+    _add_columns(con, "documents",
+                 ["mtime REAL", "size INTEGER", "content_hash TEXT"])
+    _add_columns(con, "doc_parts", ["part_hash TEXT"])
+    # only content updates have to touch the FTS index
+    con.execute("DROP TRIGGER IF EXISTS doc_parts_au;")
+    con.execute("""
+CREATE TRIGGER doc_parts_au AFTER UPDATE OF doccontent ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
+         VALUES('delete', old.id, old.doccontent);
+  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, new.doccontent);
+END;""")
+
+
+def _v3_indexes(con: sqlite3.Connection):
+    # merge duplicates that would violate the unique indexes
+    con.execute("""
+DELETE FROM doc_parts WHERE doc_id IN (
+    SELECT id FROM documents WHERE id NOT IN (
+        SELECT MIN(id) FROM documents GROUP BY href));""")
+    con.execute("""
+DELETE FROM doc_tag WHERE doc_id IN (
+    SELECT id FROM documents WHERE id NOT IN (
+        SELECT MIN(id) FROM documents GROUP BY href));""")
+    con.execute("""
+DELETE FROM documents WHERE id NOT IN (
+    SELECT MIN(id) FROM documents GROUP BY href);""")
+    con.execute("""
+UPDATE doc_tag SET tag_id = (
+    SELECT MIN(t2.id) FROM tags t1 JOIN tags t2 ON t1.tag = t2.tag
+    WHERE t1.id = doc_tag.tag_id)
+WHERE tag_id NOT IN (SELECT MIN(id) FROM tags GROUP BY tag);""")
+    con.execute("""
+DELETE FROM tags WHERE id NOT IN (SELECT MIN(id) FROM tags GROUP BY tag);""")
+    con.execute("""
+DELETE FROM doc_tag WHERE id NOT IN (
+    SELECT MIN(id) FROM doc_tag GROUP BY doc_id, tag_id);""")
+    for stmt in (
+            "CREATE UNIQUE INDEX documents_href ON documents(href);",
+            "CREATE INDEX doc_parts_doc_id ON doc_parts(doc_id);",
+            "CREATE UNIQUE INDEX tags_tag ON tags(tag);",
+            "CREATE UNIQUE INDEX doc_tag_doc_id ON doc_tag(doc_id, tag_id);",
+            "CREATE INDEX doc_tag_tag_id ON doc_tag(tag_id);",
+            "ANALYZE;"):
+        con.execute(stmt)
+
+
+def _v4_shared_parts(con: sqlite3.Connection):
+    # doc_parts keeps one row per distinct content, with the id of its
+    # first occurrence, so that its FTS postings stay valid; doc_part_refs
+    # holds where parts occur in documents
+    compressed = parts_compressed(con)
+    con.execute("""
+CREATE TABLE doc_part_refs (
+    id INTEGER PRIMARY KEY,
+    doc_id INTEGER,
+    elem_idx INTEGER,
+    part_id INTEGER,
+    FOREIGN KEY(doc_id) REFERENCES documents(id),
+    FOREIGN KEY(part_id) REFERENCES doc_parts(id)
+);""")
+    # parts of the first release have no hash and are not shared
+    con.execute("""
+INSERT INTO doc_part_refs(id, doc_id, elem_idx, part_id)
+    SELECT dp.id, dp.doc_id, dp.elem_idx, COALESCE(first.id, dp.id)
+    FROM doc_parts dp LEFT JOIN (
+        SELECT part_hash, MIN(id) AS id FROM doc_parts
+        WHERE part_hash IS NOT NULL GROUP BY part_hash) first
+    ON first.part_hash = dp.part_hash;""")
+    content = "knov_decompress(dp.doccontent)" if compressed \
+        else "dp.doccontent"
+    con.execute(f"""
+INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
+    SELECT 'delete', dp.id, {content} FROM doc_parts dp
+    JOIN doc_part_refs r ON r.id = dp.id WHERE r.part_id != dp.id;""")
+    for stmt in (
+            "DROP VIEW IF EXISTS doc_parts_text;",
+            ("CREATE TABLE doc_parts_shared (id INTEGER PRIMARY KEY, "
+             "doccontent TEXT, part_hash TEXT);"),
+            ("INSERT INTO doc_parts_shared SELECT id, doccontent, part_hash "
+             "FROM doc_parts "
+             "WHERE id IN (SELECT part_id FROM doc_part_refs);"),
+            # also drops the FTS triggers and doc_parts_doc_id
+            "DROP TABLE doc_parts;",
+            "ALTER TABLE doc_parts_shared RENAME TO doc_parts;",
+            "CREATE UNIQUE INDEX doc_parts_part_hash ON doc_parts(part_hash);",
+            "CREATE INDEX doc_part_refs_doc_id ON doc_part_refs(doc_id);",
+            "CREATE INDEX doc_part_refs_part_id ON doc_part_refs(part_id);",
+            """
+CREATE TRIGGER doc_part_refs_ad AFTER DELETE ON doc_part_refs
+WHEN NOT EXISTS (SELECT 1 FROM doc_part_refs WHERE part_id = old.part_id)
+BEGIN
+  DELETE FROM doc_parts WHERE id = old.part_id;
+END;"""):
+        con.execute(stmt)
+    if compressed:
+        con.execute(_TEXT_VIEW)
+    create_fts_triggers(con, compressed)
+
+
+def _v5_doc_tag_version(con: sqlite3.Connection):
+    # tells in-memory tag indexes that another connection changed doc_tag
+    con.execute("CREATE TABLE doc_tag_version (version INTEGER NOT NULL);")
+    con.execute("INSERT INTO doc_tag_version(version) VALUES (0);")
+    for name, event in (("ai", "INSERT"), ("ad", "DELETE"),
+                        ("au", "UPDATE")):
+        con.execute(f"""
+CREATE TRIGGER doc_tag_{name} AFTER {event} ON doc_tag BEGIN
+  UPDATE doc_tag_version SET version = version + 1;
+END;""")
+
+
+# Never change a released migration, append a new one instead.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _v1_base_schema,
+    _v2_source_state,
+    _v3_indexes,
+    _v4_shared_parts,
+    _v5_doc_tag_version,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(con: sqlite3.Connection) -> int:
+    return con.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def migrate(con: sqlite3.Connection) -> int:
+    """
+    Upgrade the database to SCHEMA_VERSION, each migration in its own
+    transaction. Returns the version the database had before.
+    """
+    version = schema_version(con)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"index has schema version {version}, but this "
+                           f"knovleks only supports up to {SCHEMA_VERSION}")
+    for new_version in range(version + 1, SCHEMA_VERSION + 1):
+        con.commit()
+        con.execute("BEGIN IMMEDIATE;")
+        try:
+            # another process may have migrated in the meantime
+            if schema_version(con) < new_version:
+                MIGRATIONS[new_version - 1](con)
+                con.execute(f"PRAGMA user_version = {new_version};")
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+    return version
+
+
+# Compressed part storage: doc_parts.doccontent holds zlib compressed BLOBs
+# and the FTS index reads its content through a view that decompresses
+# them, i.e. only for the parts snippets are computed for. Connections need
+# the SQL functions of register_functions().
+COMPRESS_LEVEL = 6
+_FTS_TABLE = """
+CREATE VIRTUAL TABLE doc_parts_fts USING fts5(
+    doccontent,
+    content={content},
+    content_rowid=id,
+    tokenize = 'porter unicode61'
+);"""
+_FTS_TRIGGERS = """
+CREATE TRIGGER doc_parts_ai AFTER INSERT ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, {new});
+END;
+CREATE TRIGGER doc_parts_ad AFTER DELETE ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
+         VALUES('delete', old.id, {old});
+END;
+CREATE TRIGGER doc_parts_au AFTER UPDATE OF doccontent ON doc_parts BEGIN
+  INSERT INTO doc_parts_fts(doc_parts_fts, rowid, doccontent)
+         VALUES('delete', old.id, {old});
+  INSERT INTO doc_parts_fts(rowid, doccontent) VALUES (new.id, {new});
+END;"""
+_TEXT_VIEW = """
+CREATE VIEW doc_parts_text AS
+    SELECT id, knov_decompress(doccontent) AS doccontent FROM doc_parts;"""
+
+
+def compress_part(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8", "surrogatepass"),
+                         COMPRESS_LEVEL)
+
+
+def decompress_part(content: Union[str, bytes, None]) -> Optional[str]:
+    # parts written uncompressed (e.g. before compression was enabled) are
+    # stored as text
+    if not isinstance(content, bytes): return content
+    return zlib.decompress(content).decode("utf-8", "surrogatepass")
+
+
+def register_functions(con: sqlite3.Connection):
+    con.create_function("knov_compress", 1, compress_part,
+                        deterministic=True)
+    con.create_function("knov_decompress", 1, decompress_part,
+                        deterministic=True)
+
+
+def parts_compressed(con: sqlite3.Connection) -> bool:
+    cur = con.execute(("SELECT 1 FROM sqlite_master "
+                       "WHERE type = 'view' AND name = 'doc_parts_text';"))
+    return cur.fetchone() is not None
+
+
+def drop_fts_triggers(con: sqlite3.Connection):
+    """
+    Stop updating the FTS index on writes of doc_parts, e.g. for a bulk
+    load that rebuilds it afterwards.
+    """
+    for name in ("ai", "ad", "au"):
+        con.execute(f"DROP TRIGGER doc_parts_{name};")
+
+
+def create_fts_triggers(con: sqlite3.Connection, compressed: bool):
+    value = "knov_decompress({}.doccontent)" if compressed \
+        else "{}.doccontent"
+    for stmt in sql_statements(_FTS_TRIGGERS.format(
+            new=value.format("new"), old=value.format("old"))):
+        con.execute(stmt)
+
+
+def set_part_compression(con: sqlite3.Connection, compress: bool):
+    """
+    Convert the stored parts and recreate the FTS index for the storage
+    mode, which retokenizes all parts. Does not commit.
+    """
+    if parts_compressed(con) == compress: return
+    settings = con.execute(
+        ("SELECT k, v FROM doc_parts_fts_config "
+         "WHERE k IN ('automerge', 'crisismerge', 'usermerge');")).fetchall()
+    drop_fts_triggers(con)
+    for stmt in ("DROP TABLE doc_parts_fts;",
+                 "DROP VIEW IF EXISTS doc_parts_text;"):
+        con.execute(stmt)
+    if compress:
+        con.execute(("UPDATE doc_parts SET doccontent = "
+                     "knov_compress(doccontent) "
+                     "WHERE typeof(doccontent) = 'text';"))
+        con.execute(_TEXT_VIEW)
+    else:
+        con.execute(("UPDATE doc_parts SET doccontent = "
+                     "knov_decompress(doccontent) "
+                     "WHERE typeof(doccontent) = 'blob';"))
+    con.execute(_FTS_TABLE.format(
+        content="doc_parts_text" if compress else "doc_parts"))
+    create_fts_triggers(con, compress)
+    con.executemany(("INSERT INTO doc_parts_fts(doc_parts_fts, rank) "
+                     "VALUES(?, ?);"), settings)
+    con.execute("INSERT INTO doc_parts_fts(doc_parts_fts) VALUES('rebuild');")
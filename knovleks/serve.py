@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Union)
+from urllib.parse import parse_qs, urlsplit
+
+from .ingest import IndexJob
+from .knovleks import Knovleks, SearchPage, SearchSnipOptions, iter_pages
+
+
+# results per page when a response streams all results
+STREAM_PAGE_SIZE = 100
+# upper bounds of the latency histogram in milliseconds
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Metrics:
+    """
+    Request counters and latency histograms per endpoint.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict[str, Any]] = {}
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finish(self, endpoint: str, status: int, seconds: float,
+               results: int = 0):
+        with self._lock:
+            self.in_flight -= 1
+            stats = self._endpoints.setdefault(endpoint, {
+                "requests": 0, "errors": 0, "results": 0,
+                "latency_total_ms": 0.0, "latency_max_ms": 0.0,
+                "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+            ms = seconds * 1000
+            stats["requests"] += 1
+            stats["errors"] += status >= 400
+            stats["results"] += results
+            stats["latency_total_ms"] += ms
+            stats["latency_max_ms"] = max(stats["latency_max_ms"], ms)
+            bucket = next((i for i, le in enumerate(LATENCY_BUCKETS)
+                           if ms <= le), len(LATENCY_BUCKETS))
+            stats["latency_buckets"][bucket] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            endpoints = {}
+            for endpoint, stats in self._endpoints.items():
+                avg = stats["latency_total_ms"] / stats["requests"]
+                endpoints[endpoint] = dict(
+                    stats,
+                    latency_avg_ms=avg,
+                    requests_per_second=stats["requests"] / uptime,
+                    latency_buckets=dict(zip(
+                        [str(le) for le in LATENCY_BUCKETS] + ["inf"],
+                        stats["latency_buckets"])))
+            return {"uptime_seconds": uptime, "in_flight": self.in_flight,
+                    "endpoints": endpoints}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: Union["HTTPSearchServer", "UnixSearchServer"]
+
+    def address_string(self) -> str:
+        # unix socket clients have no address
+        if not self.client_address: return "unix"
+        return super().address_string()
+
+    def log_message(self, format, *args):
+        pass  # counted in /metrics instead
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method: str):
+        app: SearchService = self.server.app
+        url = urlsplit(self.path)
+        route = app.routes.get((method, url.path))
+        self.endpoint = url.path
+        self.start = time.perf_counter()
+        self.counted = False
+        app.metrics.start()
+        status, results = 500, 0
+        self.streaming = False
+        try:
+            if route is None:
+                raise BadRequest(f"no endpoint {method} {url.path}", 404)
+            params = parse_qs(url.query)
+            status, results = route(self, params)
+        except BadRequest as e:
+            message, status = (e.args + (400,))[:2]
+            self.send_json({"error": message}, status)
+        except Exception as e:
+            status = 500
+            if self.streaming:
+                # too late for an error response, the client sees a
+                # truncated body
+                self.close_connection = True
+            else:
+                self.send_json({"error": f"{type(e).__name__}: {e}"},
+                               status)
+        finally:
+            # e.g. a truncated stream, which is counted as an error
+            self._count(status, results)
+
+    def _count(self, status: int, results: int):
+        """
+        Count the request in /metrics, before the last write of its response,
+        so that a client sees it as soon as it has the response.
+        """
+        if self.counted: return
+        self.counted = True
+        self.server.app.metrics.finish(
+            self.endpoint, status, time.perf_counter() - self.start, results)
+
+    def send_json(self, obj: Any, status: int = 200, results: int = 0):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self._count(status, results)
+        self.wfile.write(body)
+
+    def stream_pages(self, pages: Iterator[SearchPage]) -> int:
+        """
+        Send the results of pages as one JSON object with chunked transfer
+        encoding, a page is sent as soon as it is fetched. The cursor of the
+        last page allows to continue. Returns the number of results.
+        """
+        # the first page is fetched before the status is sent, so that
+        # invalid requests still get an error response
+        try:
+            first = next(pages, SearchPage([]))
+        except ValueError as e:
+            raise BadRequest(str(e))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.streaming = True
+        self._send_chunk('{"results": [')
+        n = 0
+        cursor = None
+        for page in chain([first], pages):
+            if page.results:
+                sep = ", " if n else ""
+                self._send_chunk(sep + ", ".join(json.dumps(asdict(r))
+                                                 for r in page.results))
+            n += len(page.results)
+            cursor = page.cursor
+        self._send_chunk(f'], "cursor": {json.dumps(cursor)}}}')
+        self._count(200, n)
+        self.wfile.write(b"0\r\n\r\n")
+        return n
+
+    def _send_chunk(self, data: str):
+        raw = data.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+
+    def read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"null")
+        except ValueError as e:
+            raise BadRequest(f"invalid JSON body: {e}")
+
+
+def _param(params: Dict[str, List[str]], name: str,
+           default: Optional[str] = None) -> Optional[str]:
+    return params.get(name, [default])[-1]
+
+
+def _int_param(params: Dict[str, List[str]], name: str,
+               minimum: int = 0) -> Optional[int]:
+    value = _param(params, name)
+    if value is None: return None
+    try:
+        number = int(value)
+    except ValueError:
+        number = minimum - 1
+    if number < minimum:
+        raise BadRequest(f"{name} must be an integer >= {minimum}")
+    return number
+
+
+class SearchService:
+    """
+    JSON API of an index:
+
+    - GET /search?q=&tag=&any_tag=&exclude_tag=&doc_type=&limit=&page_size=
+      &cursor=&full_text=&dedup=
+    - GET /tag_filter?tag=&any_tag=&exclude_tag=&doc_type=&limit=&page_size=
+      &cursor=
+    - GET /tags?href=
+    - POST /index {"documents": [{"href", "type", "title", "tags"}],
+      "force": false}
+    - GET /metrics
+
+    Without page_size all results (up to limit) are streamed, otherwise one
+    page and the cursor of the next one. Documents are indexed with
+    index(jobs, force, on_error), the document type "auto" or a missing one
+    is determined with doc_type(href).
+    """
+    def __init__(self, knov: Knovleks,
+                 index: Callable[[Iterable[IndexJob], bool,
+                                  Callable[[IndexJob, Exception], None]],
+                                 int],
+                 doc_type: Callable[[str], str]):
+        self.knov = knov
+        self.index = index
+        self.doc_type = doc_type
+        self.metrics = Metrics()
+        self.routes = {
+            ("GET", "/search"): self.search,
+            ("GET", "/tag_filter"): self.tag_filter,
+            ("GET", "/tags"): self.tags,
+            ("POST", "/index"): self.index_documents,
+            ("GET", "/metrics"): self.get_metrics,
+        }
+
+    def _pages(self, params: Dict[str, List[str]],
+               fetch_page: Callable[[int, Optional[str]], SearchPage]
+               ) -> Iterator[SearchPage]:
+        page_size = _int_param(params, "page_size", minimum=1)
+        cursor = _param(params, "cursor")
+        if page_size is not None:
+            return (fetch_page(page_size, cursor) for _ in range(1))
+        return iter_pages(fetch_page, STREAM_PAGE_SIZE,
+                          _int_param(params, "limit"), cursor)
+
+    def search(self, req: RequestHandler, params: Dict[str, List[str]]):
+        query = _param(params, "q")
+        if not query: raise BadRequest("missing parameter q")
+        tags = set(params.get("tag", []))
+        doc_type = _param(params, "doc_type")
+        snip = None
+        if _param(params, "full_text", "0") in ("0", "false", ""):
+            snip = SearchSnipOptions(_param(params, "left", "<b>"),
+                                     _param(params, "right", "</b>"))
+        dedup = _param(params, "dedup", "0") not in ("0", "false", "")
+        any_tags = set(params.get("any_tag", []))
+        exclude_tags = set(params.get("exclude_tag", []))
+        return 200, req.stream_pages(self._pages(
+            params, lambda size, cursor: self.knov.search_page(
+                query, tags, size, doc_type, snip, cursor, dedup, any_tags,
+                exclude_tags)))
+
+    def tag_filter(self, req: RequestHandler, params: Dict[str, List[str]]):
+        tags = set(params.get("tag", []))
+        any_tags = set(params.get("any_tag", []))
+        exclude_tags = set(params.get("exclude_tag", []))
+        if not (tags or any_tags or exclude_tags):
+            raise BadRequest("missing parameter tag")
+        doc_type = _param(params, "doc_type")
+        return 200, req.stream_pages(self._pages(
+            params, lambda size, cursor: self.knov.tag_filter_page(
+                tags, size, doc_type, cursor, any_tags, exclude_tags)))
+
+    def tags(self, req: RequestHandler, params: Dict[str, List[str]]):
+        href = _param(params, "href")
+        if not href: raise BadRequest("missing parameter href")
+        tags = sorted(self.knov.get_tags_by_href(href))
+        req.send_json({"href": href, "tags": tags}, results=len(tags))
+        return 200, len(tags)
+
+    def index_documents(self, req: RequestHandler,
+                        params: Dict[str, List[str]]):
+        body = req.read_json()
+        if not isinstance(body, dict) or \
+                not isinstance(body.get("documents"), list):
+            raise BadRequest('expected {"documents": [...]}')
+        jobs = []
+        for doc in body["documents"]:
+            if isinstance(doc, str):
+                doc = {"href": doc}
+            if not isinstance(doc, dict) or not doc.get("href"):
+                raise BadRequest(f"invalid document {doc!r}")
+            doc_type = doc.get("type", "auto")
+            if doc_type == "auto":
+                doc_type = self.doc_type(doc["href"])
+            if doc_type not in self.knov.supported_types:
+                raise BadRequest(f"unsupported document type {doc_type!r}")
+            jobs.append(IndexJob(doc_type, doc["href"], doc.get("title", ""),
+                                 set(doc.get("tags", []))))
+        failed = []
+
+        def on_error(job: IndexJob, exc: Exception):
+            failed.append({"href": job.href, "error": str(exc)})
+
+        n = self.index(jobs, bool(body.get("force")), on_error)
+        req.send_json({"indexed": n, "failed": failed}, results=n)
+        return 200, n
+
+    def get_metrics(self, req: RequestHandler, params: Dict[str, List[str]]):
+        metrics = self.metrics.snapshot()
+        cache = self.knov.cache_stats()
+        if cache is not None:
+            metrics["cache"] = cache
+        req.send_json(metrics)
+        return 200, 0
+
+
+class HTTPSearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, app: SearchService, host: str, port: int):
+        self.app = app
+        super().__init__((host, port), RequestHandler)
+
+
+class UnixSearchServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, app: SearchService, path: str):
+        self.app = app
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)  # left over from a previous run
+        except FileNotFoundError:
+            pass
+        super().__init__(path, RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import re
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+
+_LITERAL = re.compile(
+    # qualified names like 'main'.'table' are kept as they are
+    r"(?P<name>'[^']*'\.'[^']*')|'(?:[^']|'')*'"
+    r"|\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b", re.IGNORECASE)
+_PARAM_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_SPACE = re.compile(r"\s+")
+_NULL_SPAN = nullcontext()
+
+
+def normalize_statement(sql: str) -> str:
+    """
+    Group statements that only differ in their values.
+    """
+    sql = _LITERAL.sub(lambda m: m["name"] or "?", sql)
+    sql = _PARAM_LIST.sub("(...)", sql)
+    return _SPACE.sub(" ", sql).strip()[:100]
+
+
+class Stats:
+    """
+    Count and duration of named spans and of SQL statements.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [count, total seconds, max seconds]
+        self.spans: Dict[str, List[float]] = {}
+        self.statements: Dict[str, List[float]] = {}
+
+    def _add(self, table: Dict[str, List[float]], name: str,
+             seconds: float):
+        with self._lock:
+            entry = table.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def add_span(self, name: str, seconds: float):
+        self._add(self.spans, name, seconds)
+
+    def add_statement(self, sql: str, seconds: float):
+        self._add(self.statements, sql, seconds)
+
+    def summary(self, top: int = 15) -> str:
+        lines = []
+        for title, table, limit in (("span", self.spans, None),
+                                    ("statement", self.statements, top)):
+            if not table: continue
+            lines.append(f"{title:<60} {'count':>8} {'total ms':>10} "
+                         f"{'mean ms':>9} {'max ms':>9}")
+            rows = sorted(table.items(), key=lambda el: -el[1][1])
+            for name, (count, total, max_) in rows[:limit]:
+                lines.append(f"{name[:60]:<60} {int(count):>8} "
+                             f"{total * 1000:>10.1f} "
+                             f"{total * 1000 / count:>9.3f} "
+                             f"{max_ * 1000:>9.3f}")
+            lines.append("")
+        return "\n".join(lines)
+
+
+class StatementTimer:
+    """
+    Trace callback timing the statements of one connection. SQLite only
+    reports when a statement starts, so a statement counts until the next
+    one starts, the enclosing span ends or the read (see flush) is over.
+    Triggers and the statements FTS5 runs internally count as part of the
+    statement that caused them.
+    """
+    def __init__(self, stats: Stats):
+        self.stats = stats
+        self.current: Optional[str] = None
+        self.started = 0.0
+        self.thread: Optional[int] = None
+
+    def __call__(self, sql: str):
+        now = time.perf_counter()
+        # trigger programs repeat the statement, nested ones start with --
+        if sql == self.current or sql.startswith("-- "): return
+        self.flush(now)
+        self.current = sql
+        self.started = now
+        self.thread = threading.get_ident()
+
+    def flush(self, now: Optional[float] = None):
+        if self.current is None: return
+        now = now or time.perf_counter()
+        self.stats.add_statement(normalize_statement(self.current),
+                                 now - self.started)
+        self.current = None
+
+
+_stats: Optional[Stats] = None
+_timers: List[StatementTimer] = []
+
+
+def enable() -> Stats:
+    global _stats
+    _stats = Stats()
+    return _stats
+
+
+def disable():
+    global _stats
+    _stats = None
+    _timers.clear()
+
+
+def enabled() -> bool:
+    return _stats is not None
+
+
+def _flush_timers(now: Optional[float] = None):
+    # only the statements of this thread's connections belong to the span
+    thread = threading.get_ident()
+    for timer in _timers:
+        if timer.thread == thread:
+            timer.flush(now)
+
+
+@contextmanager
+def _span(stats: Stats, name: str) -> Iterator[None]:
+    _flush_timers()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _flush_timers(end)
+        stats.add_span(name, end - start)
+
+
+def span(name: str) -> ContextManager:
+    """
+    Time a block as span `name`, a no-op unless enabled.
+    """
+    if _stats is None: return _NULL_SPAN
+    return _span(_stats, name)
+
+
+def trace(con: sqlite3.Connection):
+    """
+    Time the statements of a connection, if enabled.
+    """
+    if _stats is None: return
+    timer = StatementTimer(_stats)
+    _timers.append(timer)
+    con.set_trace_callback(timer)
+
+
+def flush():
+    """
+    End the statement this thread's connections are running, if enabled.
+    """
+    if _stats is not None: _flush_timers()
+
+
+def summary() -> str:
+    """
+    Table of the spans and the most expensive statements so far.
+    """
+    if _stats is None: return ""
+    _flush_timers()
+    return _stats.summary()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import re
+import sqlite3
+import threading
+
+from dataclasses import dataclass
+from functools import reduce
+from itertools import groupby
+from operator import itemgetter
+from typing import (Collection, Dict, FrozenSet, Iterable, Iterator, List,
+                    Optional, Sequence, Tuple, Union)
+
+
+_ONE = re.compile("1")
+# rough size of an id in a frozenset in bits, sparser tags are stored as sets
+SET_ID_BITS = 512
+
+# document ids as a bitmap or, if sparse, as a set
+Docs = Union[int, FrozenSet[int]]
+
+
+def to_bitmap(doc_ids: Sequence[int]) -> int:
+    """
+    Bitmap of document ids, bit n is set for id n.
+    """
+    if not doc_ids: return 0
+    bits = bytearray(max(doc_ids) // 8 + 1)
+    for doc_id in doc_ids:
+        bits[doc_id >> 3] |= 1 << (doc_id & 7)
+    return int.from_bytes(bits, "little")
+
+
+def from_bitmap(bitmap: int, after: int = -1) -> Iterator[int]:
+    """
+    Document ids of a bitmap greater than `after`, in ascending order.
+    """
+    start = after + 1
+    # bin() and finditer run in C, testing the bits one by one does not
+    bits = bin(bitmap >> start)[:1:-1]
+    return (start + m.start() for m in _ONE.finditer(bits))
+
+
+def compact(doc_ids: Collection[int]) -> Docs:
+    """
+    Document ids as a frozenset if they are sparse, else as a bitmap, so
+    that a rare tag does not take (highest document id / 8) bytes.
+    """
+    if not doc_ids: return 0
+    if len(doc_ids) * SET_ID_BITS < max(doc_ids): return frozenset(doc_ids)
+    return to_bitmap(list(doc_ids))
+
+
+def _bitmap(docs: Docs) -> int:
+    return docs if isinstance(docs, int) else to_bitmap(list(docs))
+
+
+def _intersect(a: Docs, b: Docs) -> Docs:
+    if isinstance(a, frozenset) and isinstance(b, frozenset):
+        return a & b or 0
+    return _bitmap(a) & _bitmap(b) if a and b else 0
+
+
+def _union(a: Docs, b: Docs) -> Docs:
+    if not (a and b): return a or b
+    if isinstance(a, frozenset) and isinstance(b, frozenset): return a | b
+    return _bitmap(a) | _bitmap(b)
+
+
+def _difference(a: Docs, b: Docs) -> Docs:
+    if not (a and b): return a
+    if isinstance(a, frozenset) and isinstance(b, frozenset):
+        return a - b or 0
+    return _bitmap(a) & ~_bitmap(b)
+
+
+@dataclass(frozen=True)
+class DocSet:
+    """
+    Set of document ids, or all documents but these if `negated`, so that
+    NOT does not need to know all document ids. No documents are always 0.
+    """
+    docs: Docs = 0
+    negated: bool = False
+
+    def __and__(self, other: "DocSet") -> "DocSet":
+        if self.negated and other.negated:
+            return DocSet(_union(self.docs, other.docs), True)
+        if self.negated:
+            return DocSet(_difference(other.docs, self.docs))
+        if other.negated:
+            return DocSet(_difference(self.docs, other.docs))
+        return DocSet(_intersect(self.docs, other.docs))
+
+    def __or__(self, other: "DocSet") -> "DocSet":
+        return ~(~self & ~other)
+
+    def __invert__(self) -> "DocSet":
+        return DocSet(self.docs, not self.negated)
+
+    def ids(self, after: int = -1) -> Iterator[int]:
+        """
+        The document ids (the excluded ones if negated), in ascending order.
+        """
+        if isinstance(self.docs, int): return from_bitmap(self.docs, after)
+        return iter(sorted(i for i in self.docs if i > after))
+
+
+ALL_DOCS = DocSet(0, True)
+NO_DOCS = DocSet(0)
+
+
+@dataclass(frozen=True)
+class TagFilter:
+    """
+    Documents with all of `tags`, at least one of `any_tags` (unless empty)
+    and none of `exclude_tags`.
+    """
+    tags: FrozenSet[str] = frozenset()
+    any_tags: FrozenSet[str] = frozenset()
+    exclude_tags: FrozenSet[str] = frozenset()
+
+    def __bool__(self) -> bool:
+        return bool(self.tags or self.any_tags or self.exclude_tags)
+
+
+def doc_tag_version(con: sqlite3.Connection) -> int:
+    """
+    Number of changes of doc_tag so far, counted by triggers.
+    """
+    return con.execute("SELECT version FROM doc_tag_version;").fetchone()[0]
+
+
+class TagIndex:
+    """
+    The documents of every tag, which evaluate tag filters in memory: as a
+    bitmap (Python int) of about (highest document id / 8) bytes, or as a
+    frozenset of ids if the tag has fewer than 1 in SET_ID_BITS of them.
+    Loaded from doc_tag on first use and again after other connections
+    changed it, which doc_tag_version tells. The writer reports its changes
+    while writing and they are applied once committed, so that queries of
+    other threads do not see them earlier. Safe to share between threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # doc_tag_version the tag documents correspond to, None: not loaded
+        self.version: Optional[int] = None
+        self._tag_ids: Dict[str, int] = {}
+        self._docs_of_tag: Dict[int, Docs] = {}
+        # changes of the running write transaction, in order
+        self._ops: List[Tuple[str, int, int]] = []
+        self._pending_tags: Dict[str, int] = {}
+        self._changes = 0
+
+    def select(self, con: sqlite3.Connection,
+               tag_filter: TagFilter) -> DocSet:
+        """
+        The documents matching a tag filter.
+        """
+        if not tag_filter: return ALL_DOCS
+        version = doc_tag_version(con)
+        with self._lock:
+            if version != self.version:
+                self._load(con, version)
+            docs = ALL_DOCS
+            for tag in tag_filter.tags:
+                docs &= self._docs(tag)
+            if tag_filter.any_tags:
+                docs &= reduce(DocSet.__or__,
+                               map(self._docs, tag_filter.any_tags))
+            for tag in tag_filter.exclude_tags:
+                docs &= ~self._docs(tag)
+        return docs
+
+    def _docs(self, tag: str) -> DocSet:
+        tag_id = self._tag_ids.get(tag)
+        if tag_id is None: return NO_DOCS
+        return DocSet(self._docs_of_tag.get(tag_id, 0))
+
+    def _load(self, con: sqlite3.Connection, version: int):
+        # the version is read first, newer contents only cause another load
+        self._tag_ids = dict(con.execute("SELECT tag, id FROM tags;"))
+        doc_ids: Dict[int, List[int]] = {}
+        for tag_id, doc_id in con.execute(
+                "SELECT tag_id, doc_id FROM doc_tag;"):
+            doc_ids.setdefault(tag_id, []).append(doc_id)
+        self._docs_of_tag = {tag_id: compact(ids)
+                             for tag_id, ids in doc_ids.items()}
+        self.version = version
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._ops or self._pending_tags)
+
+    def resolved(self, tag_ids: Dict[str, int]):
+        self._pending_tags.update(tag_ids)
+
+    def linked(self, links: Iterable[Tuple[int, int]], rows: int):
+        """
+        `rows` (doc_id, tag_id) links were added.
+        """
+        self._ops.extend(("link", doc_id, tag_id) for doc_id, tag_id in links)
+        self._changes += rows
+
+    def unlinked(self, links: Iterable[Tuple[int, int]], rows: int):
+        self._ops.extend(("unlink", doc_id, tag_id)
+                         for doc_id, tag_id in links)
+        self._changes += rows
+
+    def deleted(self, doc_ids: Iterable[int], rows: int):
+        """
+        All links of documents were deleted, `rows` of them.
+        """
+        self._ops.extend(("delete", doc_id, 0) for doc_id in doc_ids)
+        self._changes += rows
+
+    def commit(self, version: int):
+        """
+        Apply the changes of the committed transaction, `version` is the
+        doc_tag_version it ended with.
+        """
+        with self._lock:
+            if self.version is not None and \
+                    self.version == version - self._changes:
+                self._apply()
+                self.version = version
+            else:
+                # another connection changed doc_tag as well
+                self.version = None
+        self.rollback()
+
+    def rollback(self):
+        self._ops = []
+        self._pending_tags = {}
+        self._changes = 0
+
+    def _apply(self):
+        self._tag_ids.update(self._pending_tags)
+        tag_docs = self._docs_of_tag
+        # runs of the same operation at once, e.g. the links of a batch
+        for op, run in groupby(self._ops, key=itemgetter(0)):
+            doc_ids: Dict[int, List[int]] = {}
+            for _, doc_id, tag_id in run:
+                doc_ids.setdefault(tag_id, []).append(doc_id)
+            if op == "delete":
+                deleted = frozenset(doc_ids[0])
+                mask = ~to_bitmap(doc_ids[0])
+                for tag_id, docs in tag_docs.items():
+                    if isinstance(docs, int):
+                        tag_docs[tag_id] = docs & mask
+                    else:
+                        tag_docs[tag_id] = docs - deleted or 0
+            elif op == "link":
+                for tag_id, ids in doc_ids.items():
+                    docs = _union(tag_docs.get(tag_id, 0), frozenset(ids))
+                    if isinstance(docs, frozenset):
+                        docs = compact(docs)  # possibly dense now
+                    tag_docs[tag_id] = docs
+            else:
+                for tag_id, ids in doc_ids.items():
+                    tag_docs[tag_id] = _difference(tag_docs.get(tag_id, 0),
+                                                   frozenset(ids))
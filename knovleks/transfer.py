@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+
+from itertools import groupby, islice
+from typing import (Any, Callable, Dict, IO, Iterable, Iterator, List,
+                    Optional, Tuple)
+
+from .schema import (SCHEMA_VERSION, compress_part, create_fts_triggers,
+                     decompress_part, drop_fts_triggers, parts_compressed,
+                     set_part_compression)
+
+
+# Portable index dump: one JSON object per line, usually gzip compressed.
+# A header is followed by the tags, the distinct part contents and the
+# documents with their tags and parts, each in id order. The text is always
+# stored uncompressed, ids are kept so that references need no lookups.
+FORMAT = "knovleks-export"
+FORMAT_VERSION = 1
+# Rows per executemany() of an import.
+IMPORT_BATCH_SIZE = 1000
+
+_OPTIONAL_TEXT = (str, type(None))
+# types of the fields of each kind of record, the first field names it
+_FIELDS: Dict[str, Dict[str, Any]] = {
+    "tag": {"tag": _OPTIONAL_TEXT, "id": int},
+    "part": {"part": int, "hash": _OPTIONAL_TEXT, "text": _OPTIONAL_TEXT},
+    "doc": {"doc": int, "type": _OPTIONAL_TEXT, "href": _OPTIONAL_TEXT,
+            "title": _OPTIONAL_TEXT, "mtime": (int, float, type(None)),
+            "size": (int, type(None)), "content_hash": _OPTIONAL_TEXT,
+            "tags": list, "parts": list},
+}
+
+
+def _rows_by_id(rows: Iterable[Tuple]) -> Callable[[int], List[Tuple]]:
+    """
+    Merge join for rows ordered by an id in their first column: the
+    returned function takes ascending ids and returns the rest of the rows
+    with that id, skipping rows of ids that were not asked for.
+    """
+    it = iter(rows)
+    row = [next(it, None)]
+
+    def take(id: int) -> List[Tuple]:
+        group = []
+        while row[0] is not None and row[0][0] <= id:
+            if row[0][0] == id:
+                group.append(row[0][1:])
+            row[0] = next(it, None)
+        return group
+    return take
+
+
+def export_records(con: sqlite3.Connection) -> Iterator[Dict[str, Any]]:
+    """
+    The records of a dump of the index, read with cursors so that only a
+    document at a time is held in memory. Should run in a read transaction
+    to get a consistent dump.
+    """
+    settings = dict(con.execute(
+        ("SELECT k, v FROM doc_parts_fts_config "
+         "WHERE k IN ('automerge', 'crisismerge', 'usermerge');")))
+    yield {"format": FORMAT, "version": FORMAT_VERSION,
+           "schema": SCHEMA_VERSION, "compressed": parts_compressed(con),
+           "fts": settings}
+    for id, tag in con.execute("SELECT id, tag FROM tags ORDER BY id;"):
+        yield {"tag": tag, "id": id}
+    for id, content, part_hash in con.execute(
+            "SELECT id, doccontent, part_hash FROM doc_parts ORDER BY id;"):
+        yield {"part": id, "hash": part_hash,
+               "text": decompress_part(content)}
+    refs = _rows_by_id(con.execute(
+        ("SELECT doc_id, elem_idx, part_id FROM doc_part_refs "
+         "ORDER BY doc_id, id;")))
+    tags = _rows_by_id(con.execute(
+        "SELECT doc_id, tag_id FROM doc_tag ORDER BY doc_id, tag_id;"))
+    for id, doc_type, href, title, mtime, size, content_hash in con.execute(
+            ("SELECT id, type, href, title, mtime, size, content_hash "
+             "FROM documents ORDER BY id;")):
+        yield {"doc": id, "type": doc_type, "href": href, "title": title,
+               "mtime": mtime, "size": size, "content_hash": content_hash,
+               "tags": [tag_id for tag_id, in tags(id)],
+               "parts": [list(ref) for ref in refs(id)]}
+
+
+def write_records(records: Iterable[Dict[str, Any]], out: IO[str]) -> int:
+    """
+    Write records as JSON lines, returns their number.
+    """
+    n = 0
+    # ASCII only, which escapes lone surrogates of compressed parts as well
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+    for record in records:
+        out.write(encode(record))
+        out.write("\n")
+        n += 1
+    return n
+
+
+def _ints(values: Any, length: Optional[int] = None) -> bool:
+    if not isinstance(values, list): return False
+    if length is not None and len(values) != length: return False
+    return all(type(i) is int for i in values)
+
+
+def check_record(record: Any):
+    """
+    Raise ValueError unless `record` is a tag, part or document record with
+    all fields of the right types.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    kind = _kind(record)
+    for name, types in _FIELDS[kind].items():
+        if name not in record:
+            raise ValueError(f"missing field {name!r}")
+        if not isinstance(record[name], types) or \
+                isinstance(record[name], bool):
+            raise ValueError(f"invalid field {name!r}: {record[name]!r:.80}")
+    if kind == "doc":
+        if not _ints(record["tags"]):
+            raise ValueError("tags must be tag ids")
+        if not all(_ints(ref, 2) for ref in record["parts"]):
+            raise ValueError("parts must be [elem_idx, part id] pairs")
+
+
+def read_records(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """
+    Parse the JSON lines of a dump and check its header and records. Errors
+    are raised as ValueError with the line number.
+    """
+    it = iter(lines)
+    try:
+        header = json.loads(next(it, "null"))
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise ValueError("not a knovleks export")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"export has format version {header['version']}, "
+                         f"but this knovleks only supports up to "
+                         f"{FORMAT_VERSION}")
+    yield header
+    for lineno, line in enumerate(it, 2):
+        if not line.strip(): continue
+        try:
+            record = json.loads(line)
+            check_record(record)
+        except ValueError as e:
+            raise ValueError(f"line {lineno}: {e}") from None
+        yield record
+
+
+def _kind(record: Dict[str, Any]) -> str:
+    for kind in ("tag", "part", "doc"):
+        if kind in record: return kind
+    raise ValueError(f"unknown record {record!r:.80}")
+
+
+def _batches(records: Iterable[Dict[str, Any]]
+             ) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    # consecutive records of a kind in batches of IMPORT_BATCH_SIZE
+    for kind, group in groupby(records, key=_kind):
+        while True:
+            batch = list(islice(group, IMPORT_BATCH_SIZE))
+            if not batch: break
+            yield kind, batch
+
+
+def import_records(con: sqlite3.Connection,
+                   records: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Load a dump into an empty index. The FTS triggers are dropped during
+    the load and the FTS index is built once at the end, which is much
+    faster than indexing part by part. Runs in the transaction of `con`
+    and does not commit. Returns the number of imported records by kind.
+    """
+    it = iter(records)
+    header = next(it)
+    empty, = con.execute(
+        ("SELECT NOT EXISTS (SELECT 1 FROM documents) "
+         "AND NOT EXISTS (SELECT 1 FROM doc_parts) "
+         "AND NOT EXISTS (SELECT 1 FROM tags);")).fetchone()
+    if not empty:
+        raise ValueError("can only import into an empty index")
+    compress = bool(header.get("compressed"))
+    set_part_compression(con, compress)
+    con.executemany(("INSERT INTO doc_parts_fts(doc_parts_fts, rank) "
+                     "VALUES(?, ?);"), header.get("fts", {}).items())
+    drop_fts_triggers(con)
+    counts = {"tag": 0, "part": 0, "doc": 0}
+    for kind, batch in _batches(it):
+        counts[kind] += len(batch)
+        if kind == "tag":
+            con.executemany("INSERT INTO tags(id, tag) VALUES(?,?);",
+                            ((r["id"], r["tag"]) for r in batch))
+        elif kind == "part":
+            con.executemany(
+                ("INSERT INTO doc_parts(id, doccontent, part_hash) "
+                 "VALUES(?,?,?);"),
+                ((r["part"],
+                  compress_part(r["text"]) if compress else r["text"],
+                  r["hash"]) for r in batch))
+        else:
+            con.executemany(
+                ("INSERT INTO documents(id, type, href, title, mtime, size, "
+                 "content_hash) VALUES(?,?,?,?,?,?,?);"),
+                ((r["doc"], r["type"], r["href"], r["title"], r["mtime"],
+                  r["size"], r["content_hash"]) for r in batch))
+            con.executemany(
+                ("INSERT INTO doc_part_refs(doc_id, elem_idx, part_id) "
+                 "VALUES(?,?,?);"),
+                ((r["doc"], elem_idx, part_id) for r in batch
+                 for elem_idx, part_id in r["parts"]))
+            con.executemany(
+                "INSERT INTO doc_tag(doc_id, tag_id) VALUES(?,?);",
+                ((r["doc"], tag_id) for r in batch for tag_id in r["tags"]))
+    con.execute("INSERT INTO doc_parts_fts(doc_parts_fts) VALUES('rebuild');")
+    create_fts_triggers(con, compress)
+    con.execute("ANALYZE;")
+    return counts
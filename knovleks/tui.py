@@ -2,8 +2,12 @@
 
 # XXX: Hacky first attempt with textual
 
+import asyncio
+import sqlite3
+
 from collections.abc import Collection
-from typing import Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
 
 from rich.align import Align
 from rich import box
@@ -19,19 +23,77 @@ from textual.widget import Reactive, Widget
 from textual.widgets import ScrollView
 from textual_inputs import TextInput
 
-from .knovleks import Knovleks, SearchSnipOptions
+from .knovleks import Knovleks, SearchPage, SearchSnipOptions
+
+
+# seconds without typing before a query is run
+DEBOUNCE = 0.15
+# results fetched at once, the next page is loaded when the selection gets
+# within LOAD_AHEAD results of the end
+PAGE_SIZE = 40
+LOAD_AHEAD = 10
+
+
+class QueryRunner:
+    """
+    Run queries off the event loop, in a thread with its own read connection.
+    Only the newest query counts: queued queries that became stale are
+    skipped and a running one is interrupted.
+    """
+    def __init__(self, knovleks: Knovleks, cache_size: int = 256):
+        self.knov = knovleks
+        self.cache_size = cache_size
+        self.latest = 0
+        self._reader: Optional[Knovleks] = None
+        self._executor = ThreadPoolExecutor(1, initializer=self._open)
+
+    def _open(self):
+        self._reader = self.knov.reader(self.cache_size)
+
+    def _execute(self, query_id: int, query: Callable[[Knovleks], Any]):
+        if query_id != self.latest or self._reader is None: return None
+        try:
+            return query(self._reader)
+        except sqlite3.OperationalError:
+            if query_id != self.latest: return None
+            raise
+
+    async def run(self, query: Callable[[Knovleks], Any],
+                  supersede: bool = True) -> Optional[Any]:
+        """
+        Run query with the read connection, returns None if a newer query
+        was started in the meantime. Unless `supersede`, the query does not
+        count as newer than the one started before, e.g. to load more
+        results of it.
+        """
+        if supersede:
+            self.latest += 1
+            if self._reader is not None:
+                self._reader.interrupt()
+        query_id = self.latest
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(self._executor, self._execute,
+                                            query_id, query)
+        return result if query_id == self.latest else None
+
+    def close(self):
+        self.latest += 1
+        if self._reader is not None:
+            self._reader.interrupt()
+        self._executor.shutdown(wait=False)
 
 
 class SearchEntry(Text):
     def __init__(self, href: str, content: Text, elem_idx: int,
-                 doc_type: str, tags: Collection[str] = frozenset()):
+                 doc_type: str, tags: Collection[str] = frozenset(),
+                 elem_label: str = ""):
         super(SearchEntry, self).__init__()
         self.href = href
         self.elem_idx = elem_idx
         self.doc_type = doc_type
         self.append(f"{href}", style="green")
         if self.elem_idx:
-            self.append(f" : page {elem_idx}")
+            self.append(f" : {elem_label or elem_idx}")
         self.append("\n")
         if tags:
             ts = f'{", ".join(tags)}\n'
@@ -45,43 +107,97 @@ class SearchBar(TextInput):
         self.result_view = result_view
         self.knov = knovleks
         self.rw = ResultWidget()
+        self.runner = QueryRunner(knovleks)
+        self.searched = ""
+        self._pending: Optional[asyncio.Future] = None
+        # query of the shown results and the cursor of their next page
+        self._query: Optional[
+            Callable[[Knovleks, Optional[str]], SearchPage]] = None
+        self._cursor: Optional[str] = None
 
     async def on_key(self, event: events.Key) -> None:
         await self.dispatch_key(event)
+        # TextInput.on_key changes the value after this handler
+        if event.key != "enter":
+            self._cancel_pending()
+            self._pending = asyncio.ensure_future(self._search_later())
 
-    async def simple_parse(self, query) -> Tuple[str, Set[str]]:
+    def _cancel_pending(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    async def _search_later(self):
+        await asyncio.sleep(DEBOUNCE)
+        await self.search(self.value)
+
+    async def simple_parse(self, query) -> Tuple[str, Set[str], Set[str]]:
         t = query.split()
         is_tag = lambda x: x.find("tag:") >= 0
-        tags = set(map(lambda x: x[4:], filter(is_tag, t))) - {'', ' '}
+        is_excluded = lambda x: x.startswith("-tag:")
+        tags = set(map(lambda x: x[4:],
+                       filter(lambda x: is_tag(x) and not is_excluded(x), t)))
+        excluded = set(map(lambda x: x[5:], filter(is_excluded, t)))
         search_q = " ".join(filter(lambda x: not is_tag(x), t))
-        return search_q, tags
+        return search_q, tags - {'', ' '}, excluded - {''}
 
     async def key_enter(self, event: events.Key) -> None:
-        if self.value.strip() == "": return
-        so = SearchSnipOptions("[bold blue]", "[/bold blue]")
-        q, s_tags = await self.simple_parse(self.value)
-        if not q and not s_tags: return
-        results = []
-        if q.strip():
-            sq = self.knov.search(q, tags=s_tags, limit=40, snip=so)
-            for result in sq:
-                href = result[0]
-                content = Text.from_markup(result[3])
-                page = int(result[1])
-                doc_type = result[4]
-                tags = set(self.knov.get_tags_by_href(href))
-                results.append(SearchEntry(href, content, page, doc_type,
-                                           tags))
-        else:
-            sq = self.knov.filter_by_tags(set(s_tags))
-            for result in sq:
-                href = result[0]
-                doc_type = result[2]
-                tags = set(self.knov.get_tags_by_href(href))
-                results.append(SearchEntry(href, Text(), 0, doc_type, tags))
-        self.rw = ResultWidget(results=results)
-        await self.rw.focus()
+        self._cancel_pending()
+        if await self.search(self.value):
+            await self.rw.focus()
+
+    async def search(self, value: str) -> bool:
+        """
+        Search for value and show the results, unless a newer search
+        superseded it. Returns whether results are shown.
+        """
+        if value.strip() == "": return False
+        if value == self.searched: return True
+        q, s_tags, x_tags = await self.simple_parse(value)
+        if not q and not s_tags and not x_tags: return False
+
+        def query(knov: Knovleks,
+                  cursor: Optional[str] = None) -> SearchPage:
+            if q.strip():
+                so = SearchSnipOptions("[bold blue]", "[/bold blue]")
+                return knov.search_page(q, tags=s_tags, page_size=PAGE_SIZE,
+                                        snip=so, cursor=cursor,
+                                        exclude_tags=x_tags)
+            return knov.tag_filter_page(set(s_tags), page_size=PAGE_SIZE,
+                                        cursor=cursor, exclude_tags=x_tags)
+
+        page = await self.runner.run(query)
+        if page is None: return False
+        self.searched = value
+        self._query, self._cursor = query, page.cursor
+        self.rw = ResultWidget(results=self._entries(page),
+                               load_more=self.load_more)
         await self.result_view.update(self.rw)
+        return True
+
+    def _entries(self, page: SearchPage) -> List[SearchEntry]:
+        return [SearchEntry(result.href, Text.from_markup(result.snippet),
+                            result.elem_idx, result.doc_type, result.tags,
+                            self.knov.elem_label(result.doc_type,
+                                                 result.elem_idx))
+                for result in page.results]
+
+    async def load_more(self):
+        """
+        Append the next page to the shown results.
+        """
+        query, cursor, rw = self._query, self._cursor, self.rw
+        if query is None or cursor is None: return
+        self._cursor = None  # one page at a time
+        page = await self.runner.run(lambda knov: query(knov, cursor),
+                                     supersede=False)
+        if rw is not self.rw: return
+        if page is None:
+            self._cursor = cursor
+            return
+        self._cursor = page.cursor
+        await rw.append(self._entries(page))
+        await self.result_view.update(rw, home=False)
 
 
 @rich.repr.auto(angular=False)
@@ -93,12 +209,15 @@ class ResultWidget(Widget, can_focus=True):
         yield Align.center(self.table, vertical="middle")
 
     def __init__(self, *args, results: Collection[SearchEntry] = tuple(),
-                 title: str = "Results", **kwargs):
+                 title: str = "Results",
+                 load_more: Optional[Callable[[], Awaitable]] = None,
+                 **kwargs):
         self.title = title
         self.table = Table(show_header=False)
         self.table.box = box.SIMPLE
         self.arrow = Text.from_markup("[bold green]>[/bold green]")
-        self.results = results
+        self.results = list(results)
+        self.load_more = load_more
         for result in results:
             self.table.add_row("", result)
         for row in self.table.rows:
@@ -106,9 +225,14 @@ class ResultWidget(Widget, can_focus=True):
         if results:
             self.table.rows[self.selected].style = 'bold'
             self.table.columns[0]._cells[self.selected] = self.arrow
-            self.results = results
         super().__init__(*args, **kwargs)
 
+    async def append(self, results: Collection[SearchEntry]):
+        for result in results:
+            self.table.add_row("", result, style='dim')
+        self.results.extend(results)
+        self.refresh()
+
     def render(self) -> RenderableType:
         return Panel(self.table, box=box.SQUARE)
 
@@ -119,6 +243,10 @@ class ResultWidget(Widget, can_focus=True):
             self.selected += pos
             self.table.rows[self.selected].style = 'bold'
             self.table.columns[0]._cells[self.selected] = self.arrow
+        near_end = len(self.results) - self.selected <= LOAD_AHEAD
+        if near_end and self.load_more is not None:
+            # do not block key handling while the page loads
+            asyncio.ensure_future(self.load_more())
 
     async def on_key(self, event: events.Key):
         await self.dispatch_key(event)
@@ -183,6 +311,10 @@ class KnovTui(App):
             await self.search_bar.focus()
         self.sb_focus = not self.sb_focus
 
+    def exit(self):
+        self.search_bar.runner.close()
+        quit()
+
     async def on_key(self, event: events.Key):
         if event.key == "enter":
             if self.sb_focus:
@@ -191,9 +323,9 @@ class KnovTui(App):
             else:
                 print(event)
                 await self.action_open_result()
-                quit()
+                self.exit()
         elif event.key == "escape":
             if self.sb_focus:
-                quit()
+                self.exit()
             else:
                 await self.action_focus_searchbar()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from typing import (Callable, Dict, Iterable, List, Optional, Set, Tuple,
+                    Union)
+
+from .ingest import (IndexJob, document_errors, parse_documents,
+                     skip_unchanged, walk_files)
+from .knovleks import Knovleks
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyBackend:
+    """
+    Report changed paths below directories through Linux inotify. New
+    subdirectories are watched as they appear. `read` returns None if the
+    kernel queue overflowed and events were lost.
+    """
+    def __init__(self, directories: Iterable[str]):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches: Dict[int, str] = {}
+        for directory in directories:
+            self._watch_tree(directory)
+
+    def _watch_tree(self, directory: str):
+        for root, dirs, _ in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root),
+                                             WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), root)
+            self.watches[wd] = root
+
+    def read(self, timeout: float) -> Optional[Set[str]]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready: return set()
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return set()
+        paths: Set[str] = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) \
+                    and not name.startswith("."):
+                try:
+                    self._watch_tree(path)
+                except OSError:
+                    pass  # already gone again
+        return None if overflow else paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend:
+    """
+    Report changed paths by periodically comparing the mtime and size of all
+    files below directories.
+    """
+    def __init__(self, directories: Iterable[str], interval: float = 1.0):
+        self.directories = list(directories)
+        self.interval = interval
+        self.snapshot = self._scan()
+        self.next_scan = time.monotonic() + interval
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for directory in self.directories:
+            for path in walk_files(directory):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def read(self, timeout: float) -> Optional[Set[str]]:
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+        old, self.snapshot = self.snapshot, self._scan()
+        return {p for p in old.keys() | self.snapshot.keys()
+                if old.get(p) != self.snapshot.get(p)}
+
+    def close(self):
+        pass
+
+
+class DirectoryWatcher:
+    """
+    Keep the index in sync with the files below `directories`. Changed paths
+    are collected until no event arrived for `debounce` seconds (but at most
+    `max_delay` seconds), then the batch is indexed with the regular ingest
+    pipeline and removed files are deleted from the index.
+    """
+    def __init__(self, knov: Knovleks, directories: Iterable[str],
+                 doc_type: Callable[[str], str],
+                 tags: Iterable[str] = (),
+                 debounce: float = 0.2, max_delay: float = 2.0,
+                 polling: bool = False, poll_interval: float = 1.0,
+                 on_error: Optional[
+                     Callable[[IndexJob, Exception], None]] = None,
+                 on_batch: Optional[Callable[[int, int, float], None]] = None):
+        self.knov = knov
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.doc_type = doc_type
+        self.tags = set(tags)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.on_error = on_error
+        self.on_batch = on_batch
+        self.backend: Union[InotifyBackend, PollingBackend]
+        if not polling:
+            try:
+                self.backend = InotifyBackend(self.directories)
+            except (OSError, AttributeError):
+                polling = True
+        if polling:
+            self.backend = PollingBackend(self.directories, poll_interval)
+        self.polling = polling
+
+    def _ignored(self, path: str) -> bool:
+        for directory in self.directories:
+            if os.path.commonpath([directory, path]) == directory:
+                rel = os.path.relpath(path, directory)
+                return any(p.startswith(".") or p.endswith("~")
+                           for p in rel.split(os.sep))
+        return True
+
+    def _index(self, paths: Iterable[str]) -> int:
+        jobs = (IndexJob(self.doc_type(p), p, "", set(self.tags))
+                for p in paths)
+        docs = parse_documents(self.knov.supported_types,
+                               skip_unchanged(self.knov, jobs),
+                               on_error=self.on_error)
+        return self.knov.index_documents(
+            docs, on_error=document_errors(self.on_error))
+
+    def sync(self) -> Tuple[int, int]:
+        """
+        Index all files below the directories and delete documents of files
+        that no longer exist. Returns the number of indexed and deleted
+        documents.
+        """
+        start = time.perf_counter()
+        indexed = self._index(p for d in self.directories
+                              for p in walk_files(d))
+        gone = [href for d in self.directories
+                for href in self.knov.get_hrefs(d)
+                if not os.path.isfile(href)]
+        deleted = self.knov.delete_documents(gone)
+        self._report(indexed, deleted, start)
+        return indexed, deleted
+
+    def apply(self, paths: Set[str]) -> Tuple[int, int]:
+        """
+        Bring the given paths up to date: files are (re)indexed, everything
+        below directories is indexed and documents of paths that no longer
+        exist are deleted.
+        """
+        start = time.perf_counter()
+        changed: Set[str] = set()
+        removed: List[str] = []
+        for path in sorted(paths):
+            if self._ignored(path):
+                continue
+            if os.path.isfile(path):
+                changed.add(path)
+            elif os.path.isdir(path):
+                changed.update(walk_files(path))
+            else:
+                removed.append(path)
+        indexed = self._index(sorted(changed))
+        deleted = self.knov.delete_documents(removed, recursive=True)
+        self._report(indexed, deleted, start)
+        return indexed, deleted
+
+    def _report(self, indexed: int, deleted: int, start: float):
+        if self.on_batch is not None and (indexed or deleted):
+            self.on_batch(indexed, deleted, time.perf_counter() - start)
+
+    def run(self, stop: Optional[threading.Event] = None):
+        """
+        Watch the directories until `stop` is set.
+        """
+        stop = stop or threading.Event()
+        self.sync()
+        dirty: Set[str] = set()
+        first = last = 0.0
+        try:
+            while not stop.is_set():
+                now = time.monotonic()
+                timeout = 0.5
+                if dirty:
+                    deadline = min(last + self.debounce,
+                                   first + self.max_delay)
+                    timeout = min(timeout, max(deadline - now, 0))
+                paths = self.backend.read(timeout)
+                now = time.monotonic()
+                if paths is None:
+                    dirty.clear()
+                    self.sync()
+                    continue
+                if paths:
+                    if not dirty:
+                        first = now
+                    dirty |= paths
+                    last = now
+                quiet = now - last >= self.debounce
+                if dirty and (quiet or now - first >= self.max_delay):
+                    batch, dirty = dirty, set()
+                    self.apply(batch)
+        finally:
+            self.backend.close()
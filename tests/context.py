@@ -3,5 +3,21 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
                 '..')))
 
-from knovleks.knovleks import Knovleks, SearchSnipOptions
+from knovleks.knovleks import Knovleks, SearchSnipOptions, SearchQuery
+from knovleks.knovleks import encode_cursor, iter_pages
+from knovleks.tag_index import TagFilter
 from knovleks.idocument_type import IdocumentType, DocPart
+from knovleks.ingest import IndexJob, parse_documents, skip_unchanged
+from knovleks.fetch import WebsiteFetcher
+from knovleks.watch import DirectoryWatcher
+from knovleks.schema import DB_SCHEME, SCHEMA_VERSION, schema_version
+from knovleks.schema import MIGRATIONS
+from knovleks.transfer import read_records
+from knovleks.federated import FederatedKnovleks
+from knovleks.cache import ResultCache
+from knovleks.tui import QueryRunner
+from knovleks.registry import DocumentTypeRegistry
+from knovleks.serve import HTTPSearchServer, SearchService
+from knovleks import stats
+from knovleks.document_types.note_document import NoteDocument, split_note
+from knovleks.document_types.website_document import WebsiteDocument
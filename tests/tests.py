@@ -1,7 +1,28 @@
+import asyncio
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
 from context import Knovleks, SearchSnipOptions, IdocumentType, DocPart
+from context import TagFilter, encode_cursor, iter_pages
+from context import SearchQuery
+from context import IndexJob, parse_documents, skip_unchanged
+from context import WebsiteFetcher, DirectoryWatcher
+from context import DB_SCHEME, SCHEMA_VERSION, schema_version, MIGRATIONS
+from context import ResultCache, QueryRunner, read_records
+from context import FederatedKnovleks
+from context import HTTPSearchServer, SearchService
+from context import stats, DocumentTypeRegistry
+from context import NoteDocument, split_note, WebsiteDocument
 
 
 THE_LOVELY_LADY = """The walls of the Wonderful House rose up straight and
@@ -25,6 +46,52 @@ class DocumentTypeMock(IdocumentType):
         pass
 
 
+class EchoDocumentMock(IdocumentType):
+    def parse(self):
+        self.doc_type = "note"
+        self.parts.append(DocPart(f"content of {self.href}"))
+
+
+class StreamDocumentMock(IdocumentType):
+    pages = 300
+
+    def parse(self):
+        self.doc_type = "pdf"
+        self.parts = (DocPart(f"page{i} of {self.href}", i)
+                      for i in range(1, type(self).pages + 1))
+
+
+class BrokenDocumentMock(IdocumentType):
+    def parse(self):
+        self.doc_type = "pdf"
+
+        def pages():
+            yield DocPart(f"page1 of {self.href}", 1)
+            raise ValueError("corrupt page")
+        self.parts = pages()
+
+
+class FileDocumentMock(IdocumentType):
+    parsed = 0
+
+    def parse(self):
+        type(self).parsed += 1
+        self.doc_type = "note"
+        with open(self.href) as f:
+            for i, line in enumerate(f):
+                self.parts.append(DocPart(line, i))
+
+
+class KeywordWebsiteMock(WebsiteDocument):
+    parsed = 0
+
+    def parse(self):
+        type(self).parsed += 1
+        super().parse()
+        # as article.nlp() would
+        self.tags |= {"fox"}
+
+
 class TestKnovleks(unittest.TestCase):
     # TODO: add tests for metadata
     def setUp(self):
@@ -174,11 +241,103 @@ class TestKnovleks(unittest.TestCase):
             DocPart("This lovely text is added here.", 3))
         self.test__upsert_doc_3_elem()
         cur = self.k.db_con.cursor()
-        cur.execute("SELECT id FROM doc_parts;")
+        cur.execute("SELECT id FROM doc_part_refs;")
 
         num_parts = sum([len(el.parts) for el in self.docs])
         self.assertEqual(len(cur.fetchall()), num_parts)
 
+    def test_index_documents(self):
+        """
+        Test that index_documents upserts batches, including duplicate hrefs
+        within a batch and documents spanning multiple batches.
+        """
+        n = self.k.index_documents(self.docs + [self.docs[0]], batch_size=2)
+        self.assertEqual(n, len(self.docs) + 1)
+        self.test__upsert_doc_3_elem()
+        cur = self.k.db_con.cursor()
+        cur.execute("SELECT COUNT(*) FROM doc_part_refs;")
+        num_parts = sum([len(el.parts) for el in self.docs])
+        self.assertEqual(cur.fetchone()[0], num_parts)
+        cur.execute("SELECT COUNT(*) FROM tags;")
+        all_tags = set().union(*(d.tags for d in self.docs))
+        self.assertEqual(cur.fetchone()[0], len(all_tags))
+
+    def test__upsert_doc_unchanged_parts_kept(self):
+        """
+        Test that updating a document only rewrites the parts that changed.
+        """
+        doc = self.docs[2]
+        doc.parts.append(DocPart("Third page.", 3))
+        self.k._upsert_doc(doc)
+        q = ("SELECT r.id, r.elem_idx, p.doccontent FROM doc_part_refs r "
+             "JOIN doc_parts p ON p.id = r.part_id ORDER BY r.id;")
+        before = self.k.db_con.execute(q).fetchall()
+        doc.parts = [DocPart("Inserted page.", 1),
+                     DocPart("This is some random text.", 2),
+                     DocPart("The weather is great for swimming.", 3),
+                     DocPart("Third page.", 4)]
+        self.k._upsert_doc(doc)
+        after = self.k.db_con.execute(q).fetchall()
+        self.assertEqual([r[0] for r in after[:3]], [r[0] for r in before])
+        self.assertEqual([r[1] for r in after], [2, 3, 4, 1])
+        self.assertEqual(after[3][2], "Inserted page.")
+        self.assertEqual(len(list(self.k.search("inserted"))), 1)
+        self.assertEqual(len(list(self.k.search("random"))), 1)
+
+    def test_delete_documents(self):
+        self.test__upsert_doc_3_elem()
+        self.assertEqual(self.k.delete_documents(["/tmp/test.txt"]), 1)
+        self.assertFalse(self.k.href_exists("/tmp/test.txt"))
+        self.assertEqual(len(list(self.k.search("shine"))), 1)
+        self.assertEqual(self.k.delete_documents(["/tmp/"], recursive=True),
+                         2)
+        cur = self.k.db_con.execute("SELECT COUNT(*) FROM doc_parts;")
+        self.assertEqual(cur.fetchone()[0], 0)
+
+    def test__upsert_doc_streamed_parts(self):
+        """
+        Test that lazily generated parts are inserted and updated in batches.
+        """
+        self.k._upsert_doc(StreamDocumentMock("/tmp/big.pdf"))
+        q = "SELECT COUNT(*) FROM doc_part_refs;"
+        self.assertEqual(self.k.db_con.execute(q).fetchone()[0], 300)
+        StreamDocumentMock.pages = 200
+        try:
+            self.k._upsert_doc(StreamDocumentMock("/tmp/big.pdf"))
+        finally:
+            StreamDocumentMock.pages = 300
+        self.assertEqual(self.k.db_con.execute(q).fetchone()[0], 200)
+        self.assertEqual(len(list(self.k.search("page150"))), 1)
+        self.assertEqual(len(list(self.k.search("page250"))), 0)
+
+    def test_index_documents_broken_parts(self):
+        """
+        Test that a document whose parts generator raises is rolled back and
+        reported, while the other documents of the batch are indexed.
+        """
+        self.k._upsert_doc(EchoDocumentMock("/tmp/doc2.txt"))
+        types = {"note": EchoDocumentMock, "pdf": BrokenDocumentMock}
+        jobs = [IndexJob("pdf" if i in (2, 3) else "note", f"/tmp/doc{i}.txt")
+                for i in range(5)]
+        errors = []
+        n = self.k.index_documents(
+            parse_documents(types, jobs),
+            on_error=lambda doc, e: errors.append((doc.href, str(e))))
+        self.assertEqual(n, 3)
+        self.assertEqual(errors, [("/tmp/doc2.txt", "corrupt page"),
+                                  ("/tmp/doc3.txt", "corrupt page")])
+        self.assertFalse(self.k.db_con.in_transaction)
+        self.assertEqual(len(list(self.k.search("content"))), 4)
+        self.assertEqual(len(list(self.k.search("page1"))), 0)
+        # the previous version of an updated document is kept
+        self.assertEqual([r[0] for r in self.k.search("doc2")],
+                         ["/tmp/doc2.txt"])
+        self.assertFalse(self.k.href_exists("/tmp/doc3.txt"))
+        self.k.db_con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts) "
+                               "VALUES('integrity-check');"))
+        with self.assertRaises(ValueError):
+            self.k.index_documents([BrokenDocumentMock("/tmp/doc5.pdf")])
+
     def test_search(self):
         self.test__upsert_doc_3_elem()
         self.assertEqual(len(list(self.k.search("shine"))), 2)
@@ -202,6 +361,39 @@ class TestKnovleks(unittest.TestCase):
             len(list(self.k.search("shine", tags={"roman", "excerpt"}))), 1)
         self.assertEqual(len(list(self.k.search("swim", tags={"non"}))), 0)
 
+    def test_search_results(self):
+        """
+        Test that search_results returns the tags of all hits with a constant
+        number of queries.
+        """
+        self.test__upsert_doc_3_elem()
+
+        def count_statements(limit):
+            statements = []
+            self.k.db_con.set_trace_callback(statements.append)
+            self.k.search_results("swim", limit=limit)
+            self.k.db_con.set_trace_callback(None)
+            # tag lookups, the ranking query filters by tag itself
+            return len([s for s in statements
+                        if "doc_tag" in s and "MATCH" not in s])
+
+        self.assertEqual(count_statements(1), count_statements(None))
+        results = self.k.search_results("swim")
+        self.assertEqual({r.href for r in results},
+                         {"/tmp/test.txt", "/tmp/test2.pdf"})
+        for r in results:
+            doc = next(d for d in self.docs if d.href == r.href)
+            self.assertEqual(set(r.tags), doc.tags)
+            self.assertEqual(r.doc_type, doc.doc_type)
+
+    def test_tag_filter_results(self):
+        self.test__upsert_doc_3_elem()
+        results = self.k.tag_filter_results({"excerpt"})
+        self.assertEqual(len(results), 2)
+        for r in results:
+            self.assertIn("excerpt", r.tags)
+            self.assertEqual(r.snippet, "")
+
     def test_href_exists(self):
         self.assertFalse(self.k.href_exists(self.docs[0].href))
         self.test__upsert_doc_3_elem()
@@ -217,6 +409,1021 @@ class TestKnovleks(unittest.TestCase):
         r = len(list(self.k.filter_by_tags({"excerpt"})))
         self.assertEqual(r, 2)
 
+    def test_filter_by_tags_any_exclude(self):
+        self.test__upsert_doc_3_elem()
+
+        def hrefs(*args, **kwargs):
+            return {r[0] for r in self.k.filter_by_tags(*args, **kwargs)}
+
+        self.assertEqual(hrefs(set(), any_tags={"roman", "document"}),
+                         {"/tmp/lady.txt", "/tmp/test2.pdf"})
+        self.assertEqual(hrefs({"excerpt"}, exclude_tags={"roman"}),
+                         {"/tmp/test.txt"})
+        self.assertEqual(hrefs(set(), exclude_tags={"roman", "random"}),
+                         {"/tmp/test2.pdf"})
+        self.assertEqual(hrefs({"excerpt"}, any_tags={"random", "no"},
+                               exclude_tags={"no"}), {"/tmp/test.txt"})
+        self.assertEqual(hrefs(set()), set())
+        self.assertEqual(hrefs(set(), doc_type="pdf",
+                               exclude_tags={"excerpt"}), {"/tmp/test2.pdf"})
+        res = self.k.search_results("swim", exclude_tags={"document"})
+        self.assertEqual([r.href for r in res], ["/tmp/test.txt"])
+        res = self.k.search_results("shine", any_tags={"roman", "random"},
+                                    exclude_tags={"roman"})
+        self.assertEqual([r.href for r in res], ["/tmp/test.txt"])
+        page = self.k.tag_filter_page(set(), page_size=1,
+                                      exclude_tags={"document"})
+        rest = self.k.tag_filter_results(set(), cursor=page.cursor,
+                                         exclude_tags={"document"})
+        self.assertEqual(len(page.results) + len(rest), 2)
+
+    def test_tag_index_updates(self):
+        """
+        Test that the tag index applies committed writes without reloading
+        and ignores rolled back ones.
+        """
+        self.test__upsert_doc_3_elem()
+        self.assertEqual(len(list(self.k.filter_by_tags({"excerpt"}))), 2)
+        self.docs[0].tags = {"document", "excerpt"}
+        self.k._upsert_doc(self.docs[0])
+        self.k.delete_documents(["/tmp/test2.pdf"])
+        # the id of the deleted document is reused
+        self.k._upsert_doc(DocumentTypeMock(
+            doc_type="note", href="/tmp/new.txt", title="new",
+            tags={"new"}, parts=[DocPart("new text")]))
+        self.assertEqual(list(self.k.filter_by_tags({"new"}))[0][0],
+                         "/tmp/new.txt")
+        version = self.k.db_con.execute(
+            "SELECT version FROM doc_tag_version;").fetchone()[0]
+        self.assertEqual(self.k.tag_index.version, version)
+        with self.assertRaises(ValueError):
+            with self.k.writing():
+                self.k._update_doc_tag_link(2, set())
+                raise ValueError
+        self.assertEqual(self.k.tag_index.version, version)
+        self.assertEqual({r[0] for r in self.k.filter_by_tags({"excerpt"})},
+                         {"/tmp/lady.txt", "/tmp/test.txt"})
+        self.assertEqual([r[0] for r in self.k.filter_by_tags({"document"})],
+                         ["/tmp/lady.txt"])
+        self.assertEqual(list(self.k.filter_by_tags({"roman"})), [])
+
+    def test_tag_index_sparse(self):
+        """
+        Test that rare tags are kept as sets of ids and mix with bitmaps.
+        """
+        self.k.index_documents(EchoDocumentMock(
+            f"/tmp/doc{i}.txt", tags={"all", "rare"} if i % 1300 == 0
+            else {"all"}) for i in range(1400))
+
+        def hrefs(*args, **kwargs):
+            return [r[0] for r in self.k.filter_by_tags(*args, **kwargs)]
+
+        rare = ["/tmp/doc0.txt", "/tmp/doc1300.txt"]
+        self.assertEqual(hrefs({"rare"}), rare)
+        index = self.k.tag_index
+        tag_docs = {tag: index._docs_of_tag[tag_id]
+                    for tag, tag_id in index._tag_ids.items()}
+        self.assertIsInstance(tag_docs["rare"], frozenset)
+        self.assertIsInstance(tag_docs["all"], int)
+        self.assertEqual(hrefs({"all", "rare"}), rare)
+        self.assertEqual(len(hrefs({"all"}, exclude_tags={"rare"})), 1398)
+        self.assertEqual(hrefs(set(), any_tags={"rare", "none"}), rare)
+        self.assertEqual(len(hrefs(set(), exclude_tags={"rare"})), 1398)
+        self.k.delete_documents(["/tmp/doc0.txt"])
+        self.assertEqual(hrefs({"rare"}), rare[1:])
+        self.assertEqual(len(hrefs({"all"})), 1399)
+
+    def test_search_many(self):
+        self.test__upsert_doc_3_elem()
+        so = SearchSnipOptions("<", ">")
+        queries = ["swim", SearchQuery("shine", frozenset({"roman"})),
+                   SearchQuery("swim", limit=1), "nothing"]
+        res = list(self.k.search_many(iter(queries), so))
+        self.assertEqual([r.query.query for r in res],
+                         ["swim", "shine", "swim", "nothing"])
+        self.assertEqual(res[0].results,
+                         self.k.search_results("swim", snip=so))
+        self.assertEqual([r.href for r in res[1].results], ["/tmp/lady.txt"])
+        self.assertEqual([len(r.results) for r in res[2:]], [1, 0])
+        self.assertTrue(all(r.seconds > 0 for r in res))
+
+    def test_search_page(self):
+        """
+        Test that following the cursors yields all results in rank order.
+        """
+        self.test__upsert_doc_3_elem()
+        expected = self.k.search_results("the")
+        self.assertGreater(len(expected), 2)
+        results = []
+        cursor = None
+        while True:
+            page = self.k.search_page("the", page_size=2, cursor=cursor)
+            results.extend(page.results)
+            if page.cursor is None: break
+            cursor = page.cursor
+        self.assertEqual(results, expected)
+        self.assertEqual(self.k.search_page("the", page_size=len(expected)
+                                            ).cursor, None)
+        with self.assertRaises(ValueError):
+            self.k.search_page("the", cursor="nope")
+        with self.assertRaises(ValueError):
+            self.k.search_page("the", page_size=0)
+        with self.assertRaises(ValueError):
+            next(iter_pages(lambda size, cursor: self.k.search_page(
+                "the", page_size=size, cursor=cursor), 0))
+
+    def test_tag_filter_page(self):
+        self.test__upsert_doc_3_elem()
+        page = self.k.tag_filter_page({"excerpt"}, page_size=1)
+        self.assertEqual(len(page.results), 1)
+        rest = self.k.tag_filter_results({"excerpt"}, cursor=page.cursor)
+        self.assertEqual(page.results + rest,
+                         self.k.tag_filter_results({"excerpt"}))
+        with self.assertRaises(ValueError):
+            self.k.tag_filter_page({"excerpt"}, page_size=0)
+        last = self.k.tag_filter_page({"excerpt"}, cursor=page.cursor)
+        self.assertEqual((len(last.results), last.cursor), (1, None))
+
+    def test_result_cache(self):
+        """
+        Test that repeated queries are answered from the cache until the
+        index is written.
+        """
+        self.k.cache = ResultCache(2)
+        self.test__upsert_doc_3_elem()
+        so = SearchSnipOptions("<", ">")
+        first = list(self.k.search("swim", snip=so))
+        self.assertEqual(list(self.k.search("swim", snip=so)), first)
+        self.assertEqual(list(self.k.filter_by_tags({"excerpt"})),
+                         list(self.k.filter_by_tags({"excerpt"})))
+        self.assertEqual((self.k.cache.hits, self.k.cache.misses), (2, 2))
+        self.k._upsert_doc(DocumentTypeMock(
+            doc_type="note", href="/tmp/swim.txt", title="swim",
+            tags={"excerpt"}, parts=[DocPart("We swim in the sea.")]))
+        self.assertEqual(len(list(self.k.search("swim", snip=so))),
+                         len(first) + 1)
+        self.assertEqual(len(list(self.k.filter_by_tags({"excerpt"}))), 3)
+        self.assertEqual(self.k.cache.misses, 4)
+        # least recently used entries are evicted
+        list(self.k.search("sun"))
+        self.assertEqual(len(self.k.cache), 2)
+        list(self.k.search("swim", snip=so))
+        self.assertEqual(self.k.cache.misses, 6)
+
+    def test_optimize(self):
+        self.assertEqual(self.k.fts_settings(),
+                         {"automerge": 4, "crisismerge": 16})
+        self.k.set_fts_settings(automerge=0)
+        self.assertEqual(self.k.fts_settings()["automerge"], 0)
+        # one FTS segment per transaction, none merged automatically
+        for doc in self.docs * 3:
+            self.k._upsert_doc(doc)
+        expected = list(self.k.search("swim"))
+        fragmented = self.k.storage_stats()["fts_pages"]
+        self.assertGreater(self.k.merge(pages=1, steps=2), 1)
+        self.assertLess(self.k.storage_stats()["fts_pages"], fragmented)
+        self.k.optimize(vacuum=True)
+        self.assertEqual(self.k.merge(), 1)
+        self.assertEqual(self.k.storage_stats()["free"], 0)
+        self.assertEqual(list(self.k.search("swim")), expected)
+
+    def test_part_compression(self):
+        self.test__upsert_doc_3_elem()
+        so = SearchSnipOptions("<b>", "</b>", "...", 5)
+        expected = list(self.k.search("swim", snip=so))
+        self.k.set_fts_settings(automerge=2)
+        self.k.set_part_compression(True)
+        q = "SELECT DISTINCT typeof(doccontent) FROM doc_parts;"
+        self.assertEqual(self.k.db_con.execute(q).fetchall(), [("blob",)])
+        self.assertEqual(list(self.k.search("swim", snip=so)), expected)
+        self.assertEqual(self.k.fts_settings()["automerge"], 2)
+        # new and updated parts are compressed as well
+        doc = self.docs[2]
+        doc.parts = [DocPart("Rain all day.", 1), doc.parts[1]]
+        self.k._upsert_doc(doc)
+        self.assertEqual(self.k.db_con.execute(q).fetchall(), [("blob",)])
+        self.assertEqual(len(list(self.k.search("rain"))), 1)
+        self.assertEqual(len(list(self.k.search("random"))), 0)
+        self.assertEqual({r[0] for r in self.k.search("swim")},
+                         {r[0] for r in expected})
+        self.k.set_part_compression(False)
+        self.assertEqual(self.k.db_con.execute(q).fetchall(), [("text",)])
+        self.assertEqual(len(list(self.k.search("rain"))), 1)
+        self.k.db_con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts) "
+                               "VALUES('integrity-check');"))
+
+    def test_shared_parts(self):
+        """
+        Test that equal parts of different documents are stored and indexed
+        once, but found in each of them.
+        """
+        self.test__upsert_doc_3_elem()
+        sun = self.docs[1].parts[0].doccontent
+        self.k._upsert_doc(DocumentTypeMock(
+            doc_type="note", href="/tmp/copy.txt", title="copy",
+            tags={"copy"}, parts=[DocPart(THE_LOVELY_LADY, 4),
+                                  DocPart(sun, 5)]))
+        q = "SELECT COUNT(*) FROM doc_parts;"
+        self.assertEqual(self.k.db_con.execute(q).fetchone()[0], 5)
+        res = self.k.search_results("princess")
+        self.assertEqual({(r.href, r.elem_idx) for r in res},
+                         {("/tmp/lady.txt", 0), ("/tmp/copy.txt", 4)})
+        self.assertEqual(len(self.k.search_results("princess", dedup=True)),
+                         1)
+        res = self.k.search_results("princess", {"copy"}, dedup=True)
+        self.assertEqual([r.href for r in res], ["/tmp/copy.txt"])
+        for dedup, n in ((False, 4), (True, 2)):
+            hrefs, cursor = [], None
+            while True:
+                page = self.k.search_page("princess OR noon", page_size=1,
+                                          cursor=cursor, dedup=dedup)
+                hrefs.extend(r.href for r in page.results)
+                if page.cursor is None: break
+                cursor = page.cursor
+            self.assertEqual(len(hrefs), n)
+        self.k.delete_documents(["/tmp/lady.txt"])
+        self.assertEqual(self.k.db_con.execute(q).fetchone()[0], 5)
+        self.assertEqual([r.href for r in self.k.search_results("princess")],
+                         ["/tmp/copy.txt"])
+        # contents are deleted with their last reference
+        self.k.delete_documents(["/tmp/copy.txt"])
+        self.assertEqual(self.k.db_con.execute(q).fetchone()[0], 4)
+        self.assertEqual(len(list(self.k.search("princess"))), 0)
+        self.assertEqual(len(list(self.k.search("noon"))), 1)
+        self.k.db_con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts) "
+                               "VALUES('integrity-check');"))
+
+    def test_export_import(self):
+        self.test__upsert_doc_3_elem()
+        self.k._upsert_doc(DocumentTypeMock(
+            doc_type="note", href="/tmp/copy.txt", title="copy",
+            tags={"copy"}, parts=[DocPart(THE_LOVELY_LADY, 4),
+                                  DocPart("naïve café, ünïcode", 5)]))
+        self.k.set_fts_settings(automerge=2)
+        tables = ("SELECT * FROM documents ORDER BY id;",
+                  "SELECT * FROM doc_parts ORDER BY id;",
+                  "SELECT doc_id, elem_idx, part_id FROM doc_part_refs "
+                  "ORDER BY id;",
+                  "SELECT * FROM tags ORDER BY id;",
+                  "SELECT doc_id, tag_id FROM doc_tag ORDER BY doc_id;")
+        for compress in (False, True):
+            self.k.set_part_compression(compress)
+            out = io.StringIO()
+            self.assertEqual(self.k.export_index(out), 1 + 5 + 6 + 4)
+            k = Knovleks(defaultdict(DocumentTypeMock), ":memory:")
+            out.seek(0)
+            counts = k.import_index(read_records(out))
+            self.assertEqual(counts, {"tag": 5, "part": 6, "doc": 4})
+            self.assertEqual(k.compress_parts, compress)
+            for q in tables:
+                self.assertEqual(k.db_con.execute(q).fetchall(),
+                                 self.k.db_con.execute(q).fetchall())
+            self.assertEqual(k.fts_settings()["automerge"], 2)
+            self.assertEqual(k.search_results("swim OR princess"),
+                             self.k.search_results("swim OR princess"))
+            self.assertEqual(k.tag_filter_results({"excerpt"}),
+                             self.k.tag_filter_results({"excerpt"}))
+            k.db_con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts) "
+                              "VALUES('integrity-check');"))
+            # the FTS triggers are back
+            k._upsert_doc(EchoDocumentMock(href="/tmp/new.txt"))
+            self.assertEqual(len(k.search_results("content")), 1)
+            # only into an empty index
+            out.seek(0)
+            with self.assertRaises(ValueError):
+                k.import_index(read_records(out))
+        with self.assertRaises(ValueError):
+            next(read_records(['{"documents": []}']))
+
+    def test_import_corrupt(self):
+        """
+        Test that a corrupt record is reported with its line and that the
+        import is rolled back.
+        """
+        self.test__upsert_doc_3_elem()
+        out = io.StringIO()
+        self.k.export_index(out)
+        lines = out.getvalue().splitlines()
+        doc = json.loads(lines[-1])
+        del doc["href"]
+        cases = [(lines[:-1] + [json.dumps(doc)], "line 13: missing field"),
+                 (lines[:-1] + [lines[-1][:30]], "line 13: "),
+                 (lines[:3] + ['{"tag": "x", "id": "3"}'], "line 4: invalid"),
+                 (lines[:-1] + ['{"doc": 9, "nothing": 1}'], "line 13: "),
+                 (lines[:-1] + ['[1]'], "line 13: not a JSON object")]
+        k = Knovleks(defaultdict(DocumentTypeMock), ":memory:")
+        for corrupt, message in cases:
+            with self.assertRaisesRegex(ValueError, message):
+                k.import_index(read_records(corrupt))
+            self.assertEqual(k.db_con.execute(
+                "SELECT count(*) FROM documents;").fetchone(), (0, ))
+        self.assertEqual(k.import_index(read_records(lines))["doc"], 3)
+        self.assertEqual(k.search_results("swim"),
+                         self.k.search_results("swim"))
+        k.close()
+
+    def test_document_type_registry(self):
+        types = DocumentTypeRegistry(plugins=False)
+        self.assertEqual(set(types), {"note", "pdf", "website"})
+        self.assertEqual(types["note"].__name__, "NoteDocument")
+        self.assertNotIn("mock", types)
+        with self.assertRaises(KeyError):
+            types["mock"]
+        types.register("mock", DocumentTypeMock)
+        self.assertIs(types["mock"], DocumentTypeMock)
+        types.register("echo", f"{__name__}:EchoDocumentMock")
+        self.assertIs(types["echo"], EchoDocumentMock)
+
+    def test_stats(self):
+        self.assertEqual(stats.span("search"), stats.span("insert"))
+        stats.enable()
+        try:
+            k = Knovleks({"note": DocumentTypeMock}, ":memory:")
+            k.index_documents(self.docs)
+            list(k.search("sun"))
+            k.search_results("sun")
+            with k.reading() as con:
+                con.execute("SELECT 1;")
+            # the statement ends with the read
+            time.sleep(0.05)
+            collected = stats.summary()
+            spans = stats._stats.spans
+            statements = stats._stats.statements
+        finally:
+            stats.disable()
+        self.assertEqual(spans["insert"][0], len(self.docs))
+        for name in ("tags", "commit", "search", "search.rank",
+                     "search.fetch", "search.tags"):
+            self.assertIn(name, spans)
+        self.assertLess(statements["SELECT ?;"][2], 0.05)
+        # values are grouped, triggers count as part of their statement
+        insert = ("INSERT INTO doc_part_refs(doc_id, elem_idx, part_id) "
+                  "VALUES(...);")
+        self.assertEqual(statements[insert][0],
+                         sum(len(d.parts) for d in self.docs))
+        self.assertIn("search.fetch", collected)
+        self.assertEqual(stats.normalize_statement(
+            "SELECT * FROM t WHERE a IN (1, 2,3) AND b = 'x''y'"),
+            "SELECT * FROM t WHERE a IN (...) AND b = ?")
+
+
+class TestNoteDocument(unittest.TestCase):
+    NOTE = ("Intro\n\n# Sun\nThe sun shines.\n\n```\n# code\n```\n"
+            "## Rain\nIt rains.\n\nA lot.\n")
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "note.md")
+        with open(self.path, "w") as f:
+            f.write(self.NOTE)
+        self.k = Knovleks({"note": NoteDocument}, ":memory:")
+
+    def tearDown(self):
+        self.k.close()
+        self.tmp.cleanup()
+
+    def test_split_note(self):
+        lines = self.NOTE.splitlines(True)
+        parts = list(split_note(lines))
+        self.assertEqual([p.elem_idx for p in parts], [1, 3, 9])
+        self.assertEqual(parts[1].doccontent,
+                         "# Sun\nThe sun shines.\n\n```\n# code\n```\n")
+        # long sections are split at blank lines, long lines anywhere
+        parts = list(split_note(lines, 20))
+        self.assertEqual([p.elem_idx for p in parts], [1, 3, 4, 6, 9, 12])
+        self.assertEqual("".join(p.doccontent for p in parts), self.NOTE)
+        parts = list(split_note(["a" * 25 + "\n", "b\n"], 10))
+        self.assertEqual([(p.elem_idx, p.doccontent) for p in parts],
+                         [(1, "a" * 10), (1, "a" * 10), (1, "aaaaa\nb\n")])
+
+    def test_reindex_note(self):
+        self.k.index_document("note", self.path, "note", set())
+        res = self.k.search_results("rains")
+        self.assertEqual((len(res), res[0].elem_idx), (1, 9))
+        self.assertEqual(self.k.elem_label("note", 9), "line 9")
+        self.assertEqual(self.k.elem_label("pdf", 2), "page 2")
+        q = "SELECT id, elem_idx FROM doc_part_refs ORDER BY id;"
+        before = self.k.db_con.execute(q).fetchall()
+        with open(self.path, "w") as f:
+            f.write("New first line\n" + self.NOTE)
+        self.k.index_document("note", self.path, "note", set())
+        after = self.k.db_con.execute(q).fetchall()
+        # only the changed first part is rewritten, the others move
+        self.assertEqual(after[:2], [(before[1][0], 4), (before[2][0], 10)])
+        self.assertEqual(self.k.search_results("rains")[0].elem_idx, 10)
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.k = Knovleks(defaultdict(DocumentTypeMock),
+                          os.path.join(self.tmp.name, "index.db"))
+        self.k.index_documents(EchoDocumentMock(f"/tmp/doc{i}.txt")
+                               for i in range(5))
+
+    def tearDown(self):
+        self.k.close()
+        self.tmp.cleanup()
+
+    def test_wal(self):
+        mode = self.k.db_con.execute("PRAGMA journal_mode;").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_search_many_workers(self):
+        queries = [f"doc{i % 5}" for i in range(40)]
+        res = list(self.k.search_many(queries, workers=3, max_pending=4))
+        self.assertEqual([r.query.query for r in res], queries)
+        self.assertEqual([r.results[0].href for r in res],
+                         [f"/tmp/{q}.txt" for q in queries])
+
+    def test_tag_index_other_connection(self):
+        """
+        Test that the tag index notices tags written by another connection.
+        """
+        self.assertEqual(list(self.k.filter_by_tags({"t"})), [])
+        other = self.k.reader()
+        try:
+            other._upsert_doc(EchoDocumentMock("/tmp/doc9.txt", tags={"t"}))
+        finally:
+            other.close()
+        self.assertEqual([r[0] for r in self.k.filter_by_tags({"t"})],
+                         ["/tmp/doc9.txt"])
+        self.assertEqual(len(self.k.search_results("content", {"t"})), 1)
+
+    def test_read_during_write(self):
+        """
+        Test that searches from other threads neither block on nor see an
+        uncommitted write transaction.
+        """
+        hits = []
+        with self.k.writing():
+            self.k._upsert_docs([EchoDocumentMock("/tmp/doc9.txt")])
+            reader = threading.Thread(target=lambda: hits.extend(
+                self.k.search_results("content")))
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+            self.assertEqual(len(hits), 5)
+        self.assertEqual(len(self.k.search_results("content")), 6)
+
+    def test_concurrent_writers(self):
+        def index(n):
+            self.k.index_documents(
+                EchoDocumentMock(f"/tmp/t{n}/doc{i}.txt") for i in range(20))
+
+        threads = [threading.Thread(target=index, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.k.search_results("content")), 85)
+
+
+class TestFederated(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        paths = [os.path.join(self.tmp.name, f"{name}.db")
+                 for name in ("work", "archive")]
+        for path, name in zip(paths, ("work", "archive")):
+            k = Knovleks(defaultdict(DocumentTypeMock), path)
+            # equal contents, so that ranks are equal across the shards
+            k.index_documents(DocumentTypeMock(
+                doc_type="note", href=f"/{name}/doc{i}.txt", tags={name},
+                parts=[DocPart(f"common text {'rare ' * i}", 0)])
+                for i in range(4))
+            k.close()
+        self.fed = FederatedKnovleks([
+            Knovleks(defaultdict(DocumentTypeMock), paths[0]),
+            Knovleks(defaultdict(DocumentTypeMock), paths[1],
+                     read_only=True)])
+
+    def tearDown(self):
+        self.fed.close()
+        self.tmp.cleanup()
+
+    def test_read_only_directory(self):
+        """
+        Test that a shard in a directory without write access can be read,
+        although SQLite cannot create the -shm file of the WAL index there.
+        """
+        mount = os.path.join(self.tmp.name, "mount")
+        os.mkdir(mount)
+        path = os.path.join(mount, "index.db")
+        k = Knovleks(defaultdict(DocumentTypeMock), path)
+        k.index_documents([EchoDocumentMock("/tmp/doc.txt")])
+        k.close()
+        os.chmod(mount, 0o555)
+        try:
+            if os.access(mount, os.W_OK):
+                self.skipTest("the directory is writable anyway, e.g. by root")
+            k = Knovleks(defaultdict(DocumentTypeMock), path, read_only=True)
+            self.assertEqual(len(k.search_results("content")), 1)
+            with k.readers.connection() as con:
+                self.assertEqual(con.execute(
+                    "SELECT count(*) FROM documents;").fetchone(), (1, ))
+            k.close()
+        finally:
+            os.chmod(mount, 0o755)
+
+    def test_search(self):
+        keys = [key for key, _ in self.fed._search(
+            "rare", TagFilter(), None, None, None, None, False)]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual({key[1] for key in keys}, {0, 1})
+        res = self.fed.search_results("rare", limit=4)
+        self.assertEqual([r.href for r in res],
+                         ["/work/doc3.txt", "/archive/doc3.txt",
+                          "/work/doc2.txt", "/archive/doc2.txt"])
+        self.assertEqual([r.tags for r in res],
+                         [["work"], ["archive"], ["work"], ["archive"]])
+        res = self.fed.search_results("common", {"archive"})
+        self.assertEqual(len(res), 4)
+        self.assertEqual(len(list(self.fed.search("common"))), 8)
+        many = list(self.fed.search_many(["common", "rare"], workers=2))
+        self.assertEqual([len(r.results) for r in many], [8, 6])
+
+    def test_cache_stats(self):
+        self.assertIsNone(self.fed.cache_stats())
+        for shard in self.fed.shards:
+            shard.cache = ResultCache(4)
+        for _ in range(2):
+            self.fed.search_results("rare")
+        self.assertEqual(self.fed.cache_stats(),
+                         {"hits": 2, "misses": 2, "entries": 2, "size": 8})
+
+    def test_pages(self):
+        for query in ("common", "rare"):
+            expected = self.fed.search_results(query)
+            results, cursor = [], None
+            while True:
+                page = self.fed.search_page(query, page_size=3,
+                                            cursor=cursor)
+                results.extend(page.results)
+                if page.cursor is None: break
+                cursor = page.cursor
+            self.assertEqual(results, expected)
+        expected = self.fed.tag_filter_results(set(), any_tags={"work",
+                                                                "archive"})
+        self.assertEqual(len(expected), 8)
+        results, cursor = [], None
+        while True:
+            page = self.fed.tag_filter_page(set(), page_size=3,
+                                            cursor=cursor,
+                                            exclude_tags={"none"})
+            results.extend(page.results)
+            if page.cursor is None: break
+            cursor = page.cursor
+        self.assertEqual(results, expected)
+        with self.assertRaises(ValueError):
+            self.fed.search_page("rare", cursor=encode_cursor(1.0, 2, 0, 0))
+        with self.assertRaises(ValueError):
+            self.fed.tag_filter_page({"work"}, page_size=0)
+
+    def test_writes(self):
+        self.fed.index_documents([EchoDocumentMock("/work/new.txt")])
+        self.assertTrue(self.fed.shards[0].href_exists("/work/new.txt"))
+        self.assertTrue(self.fed.href_exists("/archive/doc1.txt"))
+        self.assertEqual(list(self.fed.get_tags_by_href("/archive/doc1.txt")),
+                         ["archive"])
+        with self.assertRaises(sqlite3.OperationalError):
+            self.fed.shards[1].index_documents(
+                [EchoDocumentMock("/archive/new.txt")])
+        path = os.path.join(self.tmp.name, "old.db")
+        con = sqlite3.connect(path)
+        con.execute(f"PRAGMA user_version = {SCHEMA_VERSION - 1};")
+        con.close()
+        with self.assertRaises(RuntimeError):
+            Knovleks(defaultdict(DocumentTypeMock), path, read_only=True)
+
+
+class TestQueryRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.k = Knovleks(defaultdict(DocumentTypeMock),
+                          os.path.join(self.tmp.name, "index.db"))
+        self.k.index_documents(EchoDocumentMock(f"/tmp/doc{i}.txt")
+                               for i in range(5))
+        self.runner = QueryRunner(self.k)
+
+    def tearDown(self):
+        self.runner.close()
+        self.tmp.cleanup()
+
+    def test_run(self):
+        results = asyncio.run(self.runner.run(
+            lambda k: k.search_results("doc3")))
+        self.assertEqual([r.href for r in results], ["/tmp/doc3.txt"])
+
+    def test_run_stale(self):
+        """
+        Test that only the results of the newest query are returned.
+        """
+        def slow(k):
+            time.sleep(0.2)
+            return k.search_results("doc1")
+
+        async def run_both():
+            return await asyncio.gather(
+                self.runner.run(slow),
+                self.runner.run(lambda k: k.search_results("doc2")))
+
+        stale, newest = asyncio.run(run_both())
+        self.assertIsNone(stale)
+        self.assertEqual([r.href for r in newest], ["/tmp/doc2.txt"])
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.types = {"note": EchoDocumentMock}
+        self.jobs = [IndexJob("note", f"/tmp/doc{i}.txt", tags={"t"})
+                     for i in range(20)]
+
+    def test_parse_documents_sequential(self):
+        docs = list(parse_documents(self.types, self.jobs))
+        self.assertEqual([d.href for d in docs],
+                         [j.href for j in self.jobs])
+
+    def test_parse_documents_pool(self):
+        """
+        Test that documents parsed in worker processes are handed back with
+        their parts and can be indexed by the writer.
+        """
+        k = Knovleks(self.types, ":memory:")
+        docs = parse_documents(self.types, self.jobs, workers=2,
+                               max_pending=3)
+        self.assertEqual(k.index_documents(docs, batch_size=7),
+                         len(self.jobs))
+        self.assertEqual(len(list(k.search("doc13"))), 1)
+        self.assertEqual(len(list(k.filter_by_tags({"t"}))), len(self.jobs))
+
+    def test_parse_documents_unknown_type(self):
+        jobs = self.jobs[:3] + [IndexJob("foo", "/tmp/x")] + self.jobs[3:6]
+        for workers in (1, 2):
+            errors = []
+            docs = list(parse_documents(
+                self.types, jobs, workers=workers,
+                on_error=lambda job, e: errors.append(job.href)))
+            self.assertEqual(len(docs), 6)
+            self.assertEqual(errors, ["/tmp/x"])
+
+    def test_parse_documents_pool_streamed_parts(self):
+        types = {"pdf": StreamDocumentMock}
+        jobs = [IndexJob("pdf", "/tmp/a.pdf"), IndexJob("pdf", "/tmp/b.pdf")]
+        docs = list(parse_documents(types, jobs, workers=2))
+        self.assertEqual([len(d.parts) for d in docs], [300, 300])
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmp.name, "index.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_migrate_first_release(self):
+        """
+        Test that a database of the first release with duplicates is upgraded
+        in place.
+        """
+        con = sqlite3.connect(self.db)
+        con.executescript(DB_SCHEME)
+        con.executescript("""
+            INSERT INTO documents(id, type, href, title)
+                VALUES (1, 'note', '/a', 'a'), (2, 'note', '/a', 'a'),
+                       (3, 'note', '/b', 'b');
+            INSERT INTO doc_parts(doc_id, elem_idx, doccontent)
+                VALUES (1, 0, 'first'), (2, 0, 'second'), (3, 0, 'third');
+            INSERT INTO tags(id, tag) VALUES (1, 'x'), (2, 'x'), (3, 'y');
+            INSERT INTO doc_tag(doc_id, tag_id)
+                VALUES (1, 1), (1, 2), (2, 3), (3, 2), (3, 3);
+        """)
+        con.commit()
+        con.close()
+
+        k = Knovleks({}, self.db)
+        con = k.db_con
+        self.assertEqual(schema_version(con), SCHEMA_VERSION)
+        self.assertEqual(
+            con.execute("SELECT href FROM documents ORDER BY id;").fetchall(),
+            [("/a",), ("/b",)])
+        self.assertEqual(len(list(k.search("second"))), 0)
+        self.assertEqual(len(list(k.search("first"))), 1)
+        self.assertEqual(
+            con.execute("SELECT tag FROM tags ORDER BY id;").fetchall(),
+            [("x",), ("y",)])
+        self.assertEqual(set(k.get_tags_by_href("/a")), {"x"})
+        self.assertEqual(set(k.get_tags_by_href("/b")), {"x", "y"})
+        plan = con.execute("EXPLAIN QUERY PLAN "
+                           "SELECT id FROM documents WHERE href = ?;",
+                           ("/a",)).fetchall()
+        self.assertIn("documents_href", str(plan))
+        with self.assertRaises(sqlite3.IntegrityError):
+            con.execute("INSERT INTO tags(tag) VALUES ('x');")
+        # reopening is a no-op
+        k.db_con.close()
+        self.assertEqual(schema_version(Knovleks({}, self.db).db_con),
+                         SCHEMA_VERSION)
+
+    def test_migrate_shared_parts(self):
+        """
+        Test that equal parts of a version 3 database are merged.
+        """
+        con = sqlite3.connect(self.db)
+        for migration in MIGRATIONS[:3]:
+            migration(con)
+        con.execute("PRAGMA user_version = 3;")
+        con.executescript("""
+            INSERT INTO documents(id, type, href, title)
+                VALUES (1, 'note', '/a', 'a'), (2, 'note', '/b', 'b');
+            INSERT INTO doc_parts(doc_id, elem_idx, doccontent, part_hash)
+                VALUES (1, 1, 'same text', 'h1'), (1, 2, 'own text', 'h2'),
+                       (2, 3, 'same text', 'h1');
+        """)
+        con.close()
+
+        k = Knovleks({}, self.db)
+        con = k.db_con
+        self.assertEqual(
+            con.execute("SELECT COUNT(*) FROM doc_parts;").fetchone()[0], 2)
+        res = k.search_results("same")
+        self.assertEqual({(r.href, r.elem_idx) for r in res},
+                         {("/a", 1), ("/b", 3)})
+        self.assertEqual(len(k.search_results("same", dedup=True)), 1)
+        self.assertEqual(len(k.search_results("own")), 1)
+        con.execute(("INSERT INTO doc_parts_fts(doc_parts_fts) "
+                     "VALUES('integrity-check');"))
+        k.close()
+
+
+class TestSkipUnchanged(unittest.TestCase):
+    def setUp(self):
+        self.types = {"note": FileDocumentMock}
+        self.k = Knovleks(self.types, ":memory:")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = [os.path.join(self.tmp.name, f"n{i}.txt")
+                      for i in range(3)]
+        for i, path in enumerate(self.files):
+            with open(path, "w") as f:
+                f.write(f"first line {i}\nsecond line\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def index(self, tags=frozenset()) -> int:
+        FileDocumentMock.parsed = 0
+        jobs = (IndexJob("note", p, tags=set(tags)) for p in self.files)
+        jobs = skip_unchanged(self.k, jobs)
+        self.k.index_documents(parse_documents(self.types, jobs))
+        return FileDocumentMock.parsed
+
+    def test_skip_unchanged(self):
+        self.assertEqual(self.index(), 3)
+        self.assertEqual(self.index(), 0)
+        # same content, new mtime: hashed but not parsed
+        os.utime(self.files[0], (0, 0))
+        self.assertEqual(self.index(), 0)
+        mtime = self.k.db_con.execute(
+            "SELECT mtime FROM documents WHERE href = ?;",
+            (self.files[0],)).fetchone()[0]
+        self.assertEqual(mtime, 0)
+        with open(self.files[1], "a") as f:
+            f.write("third line\n")
+        self.assertEqual(self.index(), 1)
+        self.assertEqual(len(list(self.k.search("third"))), 1)
+        # changed tags require an update
+        self.assertEqual(self.index({"new"}), 3)
+        self.assertEqual(len(list(self.k.filter_by_tags({"new"}))), 3)
+
+    def test_skip_unknown_type(self):
+        self.index()
+        failed = []
+        jobs = skip_unchanged(self.k, [IndexJob("bogus", self.files[0])])
+        docs = parse_documents(self.types, jobs,
+                               on_error=lambda job, e: failed.append(job))
+        self.assertEqual(list(docs), [])
+        self.assertEqual([job.href for job in failed], [self.files[0]])
+
+    def test_skip_unchanged_website(self):
+        """
+        Test that the keywords a website adds to its tags are no change.
+        """
+        types = {"website": KeywordWebsiteMock}
+        k = Knovleks(types, ":memory:")
+        text = "The quick brown fox jumps over the lazy dog. " * 20
+        html = ("<html><head><title>Foxes</title></head>"
+                f"<body><p>{text}</p></body></html>")
+
+        def index(tags=frozenset()) -> int:
+            KeywordWebsiteMock.parsed = 0
+            jobs = skip_unchanged(k, [IndexJob(
+                "website", "http://example.com/fox", tags=set(tags),
+                options={"html": html})])
+            k.index_documents(parse_documents(types, jobs))
+            return KeywordWebsiteMock.parsed
+
+        self.assertEqual(index({"animals"}), 1)
+        self.assertEqual(set(k.get_tags_by_href("http://example.com/fox")),
+                         {"animals", "fox"})
+        self.assertEqual(index({"animals"}), 0)
+        self.assertEqual(index({"animals", "new"}), 1)
+        k.close()
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.k = Knovleks({"note": FileDocumentMock}, ":memory:")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        os.mkdir(os.path.join(self.dir, "sub"))
+        self.write("sub/a.txt", "alpha\n")
+        self.write(".hidden.txt", "hidden\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, content: str) -> str:
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_apply(self):
+        """
+        Test that created, modified, renamed and deleted files are applied to
+        the index.
+        """
+        w = DirectoryWatcher(self.k, [self.dir], lambda p: "note",
+                             polling=True)
+        self.assertEqual(w.sync(), (1, 0))
+        b = self.write("b.txt", "bravo\n")
+        a = os.path.join(self.dir, "sub", "a.txt")
+        renamed = os.path.join(self.dir, "sub", "renamed.txt")
+        os.rename(a, renamed)
+        self.assertEqual(w.apply({a, b, renamed}), (2, 1))
+        self.assertEqual(len(list(self.k.search("alpha"))), 1)
+        self.assertTrue(self.k.href_exists(renamed))
+        os.remove(renamed)
+        os.rmdir(os.path.join(self.dir, "sub"))
+        self.assertEqual(w.apply({os.path.join(self.dir, "sub")}), (0, 1))
+        self.assertEqual(len(list(self.k.search("alpha"))), 0)
+        self.assertEqual(len(list(self.k.search("hidden"))), 0)
+
+    def test_run(self):
+        w = DirectoryWatcher(self.k, [self.dir], lambda p: "note",
+                             debounce=0.05)
+        stop = threading.Event()
+        batches = []
+
+        def on_batch(*args):
+            batches.append(args)
+            if len(batches) == 2:  # initial sync and the new file
+                stop.set()
+
+        w.on_batch = on_batch
+
+        def change():
+            time.sleep(0.2)
+            self.write("c.txt", "charlie\n")
+            stop.wait(5)
+            stop.set()
+
+        t = threading.Thread(target=change)
+        t.start()
+        w.run(stop)
+        t.join()
+        self.assertEqual(len(list(self.k.search("charlie"))), 1)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    active = 0
+    max_active = 0
+    failures = {"/flaky": 1}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            fail = cls.failures.get(self.path, 0) > 0
+            if fail:
+                cls.failures[self.path] -= 1
+        time.sleep(0.05)
+        with cls.lock:
+            cls.active -= 1
+        status = 503 if fail else (404 if self.path == "/missing" else 200)
+        body = f"<html><body>{self.path}</body></html>".encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_jobs(self):
+        """
+        Test that websites are downloaded with bounded per-host concurrency,
+        retried on 503, and that failures are reported and dropped.
+        """
+        jobs = [IndexJob("website", f"{self.url}/page{i}") for i in range(8)]
+        jobs += [IndexJob("website", f"{self.url}/flaky"),
+                 IndexJob("website", f"{self.url}/missing"),
+                 IndexJob("note", "/tmp/note.txt")]
+        errors = []
+        with WebsiteFetcher(workers=8, per_host=2, retries=2) as fetcher:
+            fetched = list(fetcher.fetch_jobs(
+                jobs, on_error=lambda job, e: errors.append(job.href)))
+        self.assertEqual(len(fetched), len(jobs) - 1)
+        self.assertEqual(errors, [f"{self.url}/missing"])
+        self.assertLessEqual(SlowHandler.max_active, 2)
+        for job in fetched:
+            if job.doc_type == "website":
+                self.assertIn(job.href[len(self.url):], job.options["html"])
+
+
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.k = Knovleks({"note": EchoDocumentMock},
+                          os.path.join(self.tmp.name, "index.db"))
+        self.k.index_documents(EchoDocumentMock(f"/tmp/doc{i}.txt",
+                                                tags={"t", f"t{i % 2}"})
+                               for i in range(5))
+
+        def index(jobs, force, on_error):
+            docs = parse_documents(self.k.supported_types, jobs,
+                                   on_error=on_error)
+            return self.k.index_documents(docs)
+
+        app = SearchService(self.k, index, lambda href: "note")
+        self.server = HTTPSearchServer(app, "127.0.0.1", 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.k.close()
+        self.tmp.cleanup()
+
+    def get(self, path, data=None):
+        body = None if data is None else json.dumps(data).encode()
+        try:
+            with urlopen(self.url + path, body) as resp:
+                return resp.status, json.load(resp)
+        except HTTPError as e:
+            return e.code, json.load(e)
+
+    def test_search(self):
+        status, res = self.get("/search?q=content&limit=3")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(res["results"]), 3)
+        status, rest = self.get(f"/search?q=content&cursor={res['cursor']}")
+        self.assertEqual(len(rest["results"]), 2)
+        self.assertIsNone(rest["cursor"])
+        status, page = self.get("/search?q=content&page_size=2&tag=t1")
+        self.assertEqual([r["tags"] for r in page["results"]],
+                         [["t", "t1"], ["t", "t1"]])
+        self.assertIsNone(page["cursor"])
+        self.assertEqual(self.get("/search?q=content&cursor=x")[0], 400)
+        self.assertEqual(self.get("/search")[0], 400)
+        self.assertEqual(self.get("/nope")[0], 404)
+
+    def test_tag_filter_and_tags(self):
+        status, res = self.get("/tag_filter?tag=t&tag=t0")
+        self.assertEqual(len(res["results"]), 3)
+        status, res = self.get("/tag_filter?exclude_tag=t0")
+        self.assertEqual(len(res["results"]), 2)
+        status, res = self.get("/search?q=content&any_tag=t1&any_tag=x")
+        self.assertEqual(len(res["results"]), 2)
+        status, res = self.get("/tags?href=/tmp/doc1.txt")
+        self.assertEqual(res["tags"], ["t", "t1"])
+
+    def test_index_and_metrics(self):
+        status, res = self.get("/index", {"documents": [
+            "/tmp/new.txt", {"href": "/tmp/new2.txt", "tags": ["n"]}]})
+        self.assertEqual((status, res["indexed"]), (200, 2))
+        status, res = self.get("/search?q=new2")
+        self.assertEqual(res["results"][0]["tags"], ["n"])
+        status, metrics = self.get("/metrics")
+        self.assertEqual(metrics["endpoints"]["/index"]["requests"], 1)
+        self.assertEqual(metrics["endpoints"]["/search"]["results"], 1)
+
 
 if __name__ == '__main__':
     unittest.main()